@@ -0,0 +1,264 @@
+import argparse
+import gzip
+import json
+import math
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import pandas as pd
+
+import carregamento
+import exportacao
+import leitura
+import tendencias
+from db_setup import DB_PATH, INDICADORES, PERIODOS_ACUMULADOS, PERIODOS_ANALISE
+from importacao import FORMATO_SEMANA
+from janelas import INDICADORES_JANELA
+from matrizes import GRANULARIDADES_COM_TOTAL, REGIOES_COM_IBERICA
+from variacoes import PERIODOS_VARIACAO
+
+# Endereço por omissão: só acessível a partir da própria máquina
+HOST_PADRAO = "127.0.0.1"
+PORTA_PADRAO = 8502
+
+# Respostas mais pequenas do que isto não são comprimidas
+TAMANHO_MINIMO_GZIP = 1024
+NIVEL_GZIP = 6
+
+# Segundos sem pedidos ao fim dos quais uma ligação keep-alive é fechada
+TEMPO_LIMITE_LIGACAO = 30
+
+# Linhas por página do histórico (por omissão e máximo)
+LIMITE_HISTORICO = 100
+LIMITE_HISTORICO_MAXIMO = 1000
+
+INDICADORES_API = INDICADORES + INDICADORES_JANELA
+PERIODOS_API = PERIODOS_ANALISE + PERIODOS_VARIACAO
+
+# Nomes dos campos das linhas devolvidas (pela ordem de exportacao.COLUNAS)
+CAMPOS = {
+    "semanas": ["semana", "regiao", "granularidade", "indicador", "periodo", "valor"],
+    "meses": ["mes", "regiao", "granularidade", "indicador", "periodo", "periodo_acumulado", "valor"],
+}
+
+class ErroPedido(Exception):
+    """Pedido inválido ou recurso inexistente (respondido com o estado HTTP indicado)."""
+
+    def __init__(self, estado, mensagem):
+        super().__init__(mensagem)
+        self.estado = estado
+
+# Estrutura em memória (com COGS, rotação, janelas e variações) do último instantâneo lido
+_cubo = {"id": None, "dados": None}
+_lock_cubo = threading.Lock()
+
+def _dados(instantaneo):
+    # Calculada uma vez por versão dos dados; os pedidos concorrentes esperam pelo mesmo cálculo
+    with _lock_cubo:
+        if _cubo["id"] != instantaneo.id:
+            _cubo["dados"] = carregamento.carregar_dados(instantaneo.conn)
+            _cubo["id"] = instantaneo.id
+        return _cubo["dados"]
+
+def _finito(valor):
+    # JSON não tem NaN nem infinitos (variações sem referência)
+    return valor if not isinstance(valor, float) or math.isfinite(valor) else None
+
+def _registos(df):
+    return df.astype(object).where(pd.notna(df), None).to_dict(orient="records")
+
+def _valores(consulta, nome, validos=None):
+    valores = [valor for parametro in consulta.get(nome, []) for valor in parametro.split(",") if valor]
+    invalidos = [valor for valor in valores if validos is not None and valor not in validos]
+    if invalidos:
+        raise ErroPedido(400, f"Valor inválido para {nome}: {', '.join(invalidos)}")
+    return valores
+
+def _valor(consulta, nome, validos=None, padrao=None):
+    valores = _valores(consulta, nome, validos)
+    if len(valores) > 1:
+        raise ErroPedido(400, f"{nome} só aceita um valor")
+    return valores[0] if valores else padrao
+
+def _recorte(instantaneo, consulta, tipo, chave):
+    dados = _dados(instantaneo)
+    if chave not in dados[tipo]:
+        raise ErroPedido(404, f"Sem dados para {chave}")
+    linhas = exportacao.linhas_cubo(
+        dados, tipo,
+        regioes=_valores(consulta, "regiao", REGIOES_COM_IBERICA) or None,
+        granularidades=_valores(consulta, "granularidade", GRANULARIDADES_COM_TOTAL) or None,
+        indicadores=_valores(consulta, "indicador", INDICADORES_API) or None,
+        periodos=_valores(consulta, "periodo", PERIODOS_API) or None,
+        chaves=[chave],
+    )
+    return {"linhas": [dict(zip(CAMPOS[tipo], map(_finito, linha))) for linha in linhas]}
+
+def indice(instantaneo, consulta):
+    dados = _dados(instantaneo)
+    return {
+        "semanas": sorted(dados["semanas"]),
+        "meses": sorted(dados["meses"]),
+        "regioes": REGIOES_COM_IBERICA,
+        "granularidades": GRANULARIDADES_COM_TOTAL,
+        "indicadores": INDICADORES_API,
+        "periodos": PERIODOS_API,
+        "periodos_acumulados": PERIODOS_ACUMULADOS,
+        "recursos": ["/semanas/{semana}", "/meses/{mes}", "/tendencias", "/historico"],
+    }
+
+def semana(instantaneo, consulta, chave):
+    return _recorte(instantaneo, consulta, "semanas", chave)
+
+def mes(instantaneo, consulta, chave):
+    return _recorte(instantaneo, consulta, "meses", chave)
+
+def tendencia(instantaneo, consulta):
+    indicador = _valor(consulta, "indicador", INDICADORES_API)
+    if indicador is None:
+        raise ErroPedido(400, "Falta o parâmetro indicador")
+    inicio, fim = _valor(consulta, "inicio"), _valor(consulta, "fim")
+    for limite in (inicio, fim):
+        if limite is not None and not FORMATO_SEMANA.match(limite):
+            raise ErroPedido(400, f"Semana inválida: {limite} (formato YYYY-WNN)")
+    regioes = _valores(consulta, "regiao", REGIOES_COM_IBERICA) or REGIOES_COM_IBERICA
+    granularidade = _valor(consulta, "granularidade", GRANULARIDADES_COM_TOTAL, "Total")
+    periodos = _valores(consulta, "periodo", PERIODOS_API) or PERIODOS_ANALISE
+    mensal = {None: None, "0": False, "1": True}.get(_valor(consulta, "mensal", ["0", "1"]))
+
+    # Como na página Tendências: os indicadores e períodos que não estão guardados vêm da estrutura
+    # em memória, os restantes de uma única consulta no mesmo instantâneo
+    if indicador in carregamento.INDICADORES_CALCULADOS_CARREGADOS or any(p not in PERIODOS_ANALISE for p in periodos):
+        dados = _dados(instantaneo)
+        semanas = sorted(dados["semanas"])
+        df = tendencias.tendencia_cubo(
+            dados, inicio or semanas[0], fim or semanas[-1], regioes, granularidade, indicador, periodos, mensal
+        ) if semanas else pd.DataFrame(columns=["chave", "regiao", "periodo", "valor"])
+    else:
+        if inicio is None or fim is None:
+            semanas = instantaneo.conn.execute('SELECT MIN(semana), MAX(semana) FROM dados_stock').fetchone()
+            inicio, fim = inicio or semanas[0], fim or semanas[1]
+        df = tendencias.ler_tendencia(
+            inicio, fim, regioes, granularidade, indicador, periodos, mensal=mensal, conn=instantaneo.conn
+        ) if inicio and fim else pd.DataFrame(columns=["chave", "regiao", "periodo", "valor"])
+    return {"indicador": indicador, "granularidade": granularidade, "linhas": _registos(df)}
+
+def historico(instantaneo, consulta):
+    try:
+        limite = min(max(int(_valor(consulta, "limite", padrao=LIMITE_HISTORICO)), 1), LIMITE_HISTORICO_MAXIMO)
+    except ValueError:
+        raise ErroPedido(400, "limite tem de ser um número inteiro")
+    cursor = _valor(consulta, "cursor")
+    if cursor is not None:
+        # Cursor devolvido na página anterior: "data_alteracao|id"
+        data_alteracao, _, id_alteracao = cursor.rpartition("|")
+        if not data_alteracao or not id_alteracao.isdigit():
+            raise ErroPedido(400, f"Cursor inválido: {cursor}")
+        cursor = (data_alteracao, int(id_alteracao))
+    df, proximo = leitura.ler_historico(
+        instantaneo.conn, limite, cursor,
+        semana=_valor(consulta, "semana"), regiao=_valor(consulta, "regiao"),
+        indicador=_valor(consulta, "indicador"), usuario=_valor(consulta, "usuario"),
+    )
+    df["lote_id"] = df["lote_id"].astype("Int64")
+    return {"linhas": _registos(df), "proximo_cursor": f"{proximo[0]}|{proximo[1]}" if proximo else None}
+
+# Recursos: primeiro segmento do caminho -> (função, número de segmentos seguintes)
+ROTAS = {
+    "": (indice, 0),
+    "semanas": (semana, 1),
+    "meses": (mes, 1),
+    "tendencias": (tendencia, 0),
+    "historico": (historico, 0),
+}
+
+def _corresponde(if_none_match, versao):
+    # If-None-Match com a versão atual (em qualquer das codificações) ou "*"
+    if not if_none_match:
+        return False
+    etiquetas = {etiqueta.strip().removeprefix("W/").strip('"') for etiqueta in if_none_match.split(",")}
+    return "*" in etiquetas or bool(etiquetas & {versao, f"{versao}-gzip"})
+
+class ManipuladorAPI(BaseHTTPRequestHandler):
+    """Pedidos GET/HEAD da API, só de leitura.
+
+    Cada pedido lê um leitura.Instantaneo; o ETag é o id do instantâneo (a versão dos dados), pelo
+    que um If-None-Match ainda atual é respondido com 304 sem calcular nada. As respostas são JSON,
+    comprimidas com gzip quando o cliente o aceita, e as ligações são mantidas entre pedidos (HTTP/1.1).
+    """
+
+    protocol_version = "HTTP/1.1"
+    server_version = "StockMonitorAPI/1.0"
+    timeout = TEMPO_LIMITE_LIGACAO
+
+    def do_GET(self):
+        partes = urlsplit(self.path)
+        segmentos = [unquote(segmento) for segmento in partes.path.strip("/").split("/")]
+        consulta = parse_qs(partes.query)
+
+        rota = ROTAS.get(segmentos[0])
+        if rota is None or len(segmentos) != rota[1] + 1:
+            return self._enviar(404, {"erro": f"Recurso inexistente: {partes.path}"})
+
+        gzip_aceite = "gzip" in self.headers.get("Accept-Encoding", "")
+        try:
+            with leitura.Instantaneo(self.server.db_path) as instantaneo:
+                etag = f'"{instantaneo.id}-gzip"' if gzip_aceite else f'"{instantaneo.id}"'
+                if _corresponde(self.headers.get("If-None-Match"), instantaneo.id):
+                    return self._enviar(304, etag=etag)
+                corpo = {"versao": instantaneo.id, **rota[0](instantaneo, consulta, *segmentos[1:])}
+        except ErroPedido as e:
+            return self._enviar(e.estado, {"erro": str(e)})
+        except Exception as e:
+            traceback.print_exc()
+            return self._enviar(500, {"erro": f"Erro interno: {e}"})
+
+        self._enviar(200, corpo, etag=etag, gzip_aceite=gzip_aceite)
+
+    do_HEAD = do_GET
+
+    def _enviar(self, estado, corpo=None, etag=None, gzip_aceite=False):
+        self.send_response(estado)
+        if etag:
+            self.send_header("ETag", etag)
+            # Os clientes podem guardar a resposta, mas revalidam-na sempre com If-None-Match
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Vary", "Accept-Encoding")
+        if corpo is None:
+            # 304: sem corpo
+            self.end_headers()
+            return
+
+        conteudo = json.dumps(corpo, ensure_ascii=False, default=lambda valor: valor.item()).encode("utf-8")
+        if gzip_aceite and len(conteudo) >= TAMANHO_MINIMO_GZIP:
+            conteudo = gzip.compress(conteudo, compresslevel=NIVEL_GZIP)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(conteudo)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(conteudo)
+
+def criar_servidor(host=HOST_PADRAO, porta=PORTA_PADRAO, db_path=DB_PATH):
+    """Servidor HTTP da API (uma thread por ligação), ainda por iniciar (serve_forever)."""
+    servidor = ThreadingHTTPServer((host, porta), ManipuladorAPI)
+    servidor.daemon_threads = True
+    servidor.db_path = db_path
+    return servidor
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="API HTTP (JSON, só de leitura) dos dados de stock.")
+    parser.add_argument("--host", default=HOST_PADRAO, help="Endereço a escutar")
+    parser.add_argument("--porta", type=int, default=PORTA_PADRAO, help="Porta a escutar")
+    args = parser.parse_args()
+
+    servidor = criar_servidor(args.host, args.porta)
+    print(f"API disponível em http://{args.host}:{args.porta}/")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
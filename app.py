@@ -2,11 +2,15 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from datetime import datetime, timedelta
+from datetime import datetime
 import json
 import os
 import csv
 import io
+import re
+import estrutura
+import importacao
+import registos
 
 # Configuração da página
 st.set_page_config(
@@ -35,71 +39,31 @@ PERIODOS_ANALISE = [
 
 PERIODOS_ACUMULADOS = ["YTD", "EOP"]
 
+# Níveis da estrutura de dados até ao indicador: período -> granularidade -> indicador
+NIVEIS_ESTRUTURA = 3
+
+# Indicadores a partir dos quais o COGS é calculado
+COMPONENTES_COGS = ["Vendas", "MFO", "Quebra"]
+
+# Calendário por omissão oferecido para seleção (sem alocar dados)
+NUM_SEMANAS_PADRAO = 12
+NUM_MESES_PADRAO = 3
+
+FORMATO_SEMANA = re.compile(r"^\d{4}-W\d{2}$")
+
+# Esta versão não tem o nível da região
+DIMENSOES_IMPORTACAO = ("chave", "granularidade", "indicador", "periodo")
+
 # Função para criar estrutura de dados inicial
+# As células só são alocadas quando escritas; as que faltam valem 0.0
 def criar_estrutura_dados():
     # Verificar se já existe um arquivo de dados
     if os.path.exists('dados_stock.json'):
         with open('dados_stock.json', 'r') as f:
-            return json.load(f)
+            return estrutura.criar_dados_esparsos(NIVEIS_ESTRUTURA, json.load(f))
     
     # Criar estrutura de dados vazia
-    dados = {
-        "semanas": {},
-        "meses": {}
-    }
-    
-    # Obter data atual
-    hoje = datetime.now()
-    
-    # Criar estrutura para as próximas 12 semanas
-    for i in range(12):
-        data_inicio = hoje + timedelta(weeks=i)
-        semana = data_inicio.strftime("%Y-W%W")
-        
-        dados["semanas"][semana] = {}
-        
-        for granularidade in GRANULARIDADES:
-            dados["semanas"][semana][granularidade] = {}
-            
-            for indicador in INDICADORES:
-                dados["semanas"][semana][granularidade][indicador] = {}
-                
-                for periodo in PERIODOS_ANALISE:
-                    dados["semanas"][semana][granularidade][indicador][periodo] = 0.0
-        
-        # Adicionar Total (será calculado automaticamente)
-        dados["semanas"][semana]["Total"] = {}
-        for indicador in INDICADORES:
-            dados["semanas"][semana]["Total"][indicador] = {}
-            for periodo in PERIODOS_ANALISE:
-                dados["semanas"][semana]["Total"][indicador][periodo] = 0.0
-    
-    # Criar estrutura para os próximos 3 meses
-    for i in range(3):
-        data_inicio = hoje.replace(day=1) + timedelta(days=32*i)
-        mes = data_inicio.strftime("%Y-%m")
-        
-        dados["meses"][mes] = {}
-        
-        for granularidade in GRANULARIDADES_COM_TOTAL:
-            dados["meses"][mes][granularidade] = {}
-            
-            for indicador in INDICADORES:
-                dados["meses"][mes][granularidade][indicador] = {}
-                
-                for periodo in PERIODOS_ANALISE:
-                    dados["meses"][mes][granularidade][indicador][periodo] = 0.0
-                    
-                for periodo_acumulado in PERIODOS_ACUMULADOS:
-                    dados["meses"][mes][granularidade][indicador][f"{periodo_acumulado}"] = {}
-                    for periodo in PERIODOS_ANALISE:
-                        dados["meses"][mes][granularidade][indicador][f"{periodo_acumulado}"][periodo] = 0.0
-    
-    # Salvar estrutura inicial
-    with open('dados_stock.json', 'w') as f:
-        json.dump(dados, f, indent=4)
-    
-    return dados
+    return estrutura.criar_dados_esparsos(NIVEIS_ESTRUTURA)
 
 # Função para salvar dados
 def salvar_dados(dados):
@@ -125,100 +89,126 @@ def calcular_total(dados, semana, indicador, periodo):
 
 # Função para atualizar todos os totais
 def atualizar_totais(dados):
-    # Para cada semana
-    for semana in dados["semanas"]:
-        # Para cada indicador
-        for indicador in INDICADORES:
+    # Para cada semana com dados
+    for semana, dados_semana in dados["semanas"].items():
+        # Indicadores presentes em alguma granularidade
+        indicadores = set()
+        for granularidade in GRANULARIDADES:
+            if granularidade in dados_semana:
+                indicadores.update(dados_semana[granularidade].keys())
+        
+        for indicador in indicadores:
             # Para cada período
             for periodo in PERIODOS_ANALISE:
                 # Calcular o total como soma das granularidades
-                dados["semanas"][semana]["Total"][indicador][periodo] = calcular_total(dados, semana, indicador, periodo)
+                dados_semana["Total"][indicador][periodo] = calcular_total(dados, semana, indicador, periodo)
     
     return dados
 
 # Função para atualizar COGS
 def atualizar_cogs(dados):
-    # Para cada semana
-    for semana in dados["semanas"]:
-        # Para cada granularidade
-        for granularidade in GRANULARIDADES_COM_TOTAL:
+    # Para cada semana com dados
+    for dados_semana in dados["semanas"].values():
+        # Para cada granularidade com dados
+        for dados_granularidade in dados_semana.values():
+            # Sem Vendas, MFO ou Quebra não há COGS a calcular
+            if not any(componente in dados_granularidade for componente in COMPONENTES_COGS):
+                continue
+            
             # Para cada período
             for periodo in PERIODOS_ANALISE:
                 # Calcular COGS = Vendas - MFO - Quebra
-                vendas = dados["semanas"][semana][granularidade]["Vendas"][periodo]
-                mfo = dados["semanas"][semana][granularidade]["MFO"][periodo]
-                quebra = dados["semanas"][semana][granularidade]["Quebra"][periodo]
-                dados["semanas"][semana][granularidade]["COGS"][periodo] = calcular_cogs(vendas, mfo, quebra)
+                vendas = dados_granularidade["Vendas"][periodo]
+                mfo = dados_granularidade["MFO"][periodo]
+                quebra = dados_granularidade["Quebra"][periodo]
+                dados_granularidade["COGS"][periodo] = calcular_cogs(vendas, mfo, quebra)
     
     return dados
 
 # Função para atualizar resumo mensal
 def atualizar_resumo_mensal(dados):
-    # Para cada mês
-    for mes in dados["meses"]:
-        # Encontrar semanas que pertencem a este mês
-        semanas_do_mes = []
-        for semana in dados["semanas"]:
-            # Extrair ano e número da semana
-            ano, num_semana = semana.split("-W")
-            # Converter para data (primeiro dia da semana)
-            data_semana = datetime.strptime(f"{ano}-{num_semana}-1", "%Y-%W-%w")
-            # Verificar se o mês da data corresponde ao mês atual
-            if data_semana.strftime("%Y-%m") == mes:
-                semanas_do_mes.append(semana)
+    # Agrupar as semanas com dados pelo mês a que pertencem
+    semanas_por_mes = {}
+    for semana in dados["semanas"]:
+        # Extrair ano e número da semana
+        ano, num_semana = semana.split("-W")
+        # Converter para data (primeiro dia da semana)
+        data_semana = datetime.strptime(f"{ano}-{num_semana}-1", "%Y-%W-%w")
+        semanas_por_mes.setdefault(data_semana.strftime("%Y-%m"), []).append(semana)
+    
+    # Para cada mês com semanas
+    for mes, semanas_do_mes in semanas_por_mes.items():
+        # Para cada granularidade/indicador presente nas semanas do mês
+        celulas = set()
+        for s in semanas_do_mes:
+            for granularidade, dados_granularidade in dados["semanas"][s].items():
+                for indicador in dados_granularidade:
+                    celulas.add((granularidade, indicador))
         
-        # Para cada granularidade
-        for granularidade in GRANULARIDADES_COM_TOTAL:
-            # Para cada indicador
-            for indicador in INDICADORES:
-                # Calcular média/soma das semanas para o mês
+        # Rotação depende dos valores mensais de Stock Liquido e COGS, por isso é calculada no fim
+        for granularidade, indicador in sorted(celulas, key=lambda celula: celula[1] == "Rotação"):
+            dados_indicador = dados["meses"][mes][granularidade][indicador]
+            
+            # Calcular média/soma das semanas para o mês
+            for periodo in PERIODOS_ANALISE:
+                valores = [dados["semanas"][s][granularidade][indicador][periodo] for s in semanas_do_mes]
+                # Para vendas, MFO, quebra e COGS, somamos os valores
+                if indicador in ["Vendas", "MFO", "Quebra", "COGS"]:
+                    dados_indicador[periodo] = sum(valores)
+                # Para stocks, calculamos a média
+                else:
+                    dados_indicador[periodo] = sum(valores) / len(valores)
+            
+            # Calcular rotação se for o indicador "Rotação"
+            if indicador == "Rotação":
                 for periodo in PERIODOS_ANALISE:
-                    valores = [dados["semanas"][s][granularidade][indicador][periodo] for s in semanas_do_mes]
-                    if valores:
-                        # Para vendas, MFO, quebra e COGS, somamos os valores
-                        if indicador in ["Vendas", "MFO", "Quebra", "COGS"]:
-                            dados["meses"][mes][granularidade][indicador][periodo] = sum(valores)
-                        # Para stocks, calculamos a média
-                        else:
-                            dados["meses"][mes][granularidade][indicador][periodo] = sum(valores) / len(valores)
-                
-                # Calcular rotação se for o indicador "Rotação"
-                if indicador == "Rotação":
-                    for periodo in PERIODOS_ANALISE:
-                        stock_liquido_medio = dados["meses"][mes][granularidade]["Stock Liquido"][periodo]
-                        cogs_acumulado = dados["meses"][mes][granularidade]["COGS"][periodo]
-                        dados["meses"][mes][granularidade]["Rotação"][periodo] = calcular_rotacao(stock_liquido_medio, cogs_acumulado)
+                    stock_liquido_medio = dados["meses"][mes][granularidade]["Stock Liquido"][periodo]
+                    cogs_acumulado = dados["meses"][mes][granularidade]["COGS"][periodo]
+                    dados_indicador[periodo] = calcular_rotacao(stock_liquido_medio, cogs_acumulado)
+            
+            # Atualizar YTD e EOP
+            for periodo in PERIODOS_ANALISE:
+                # EOP é o valor do final do período (último valor)
+                dados_indicador["EOP"][periodo] = dados_indicador[periodo]
                 
-                # Atualizar YTD e EOP
-                for periodo in PERIODOS_ANALISE:
-                    # EOP é o valor do final do período (último valor)
-                    dados["meses"][mes][granularidade][indicador]["EOP"][periodo] = dados["meses"][mes][granularidade][indicador][periodo]
-                    
-                    # YTD é acumulado desde o início do ano
-                    # Simplificação: usamos o mesmo valor para demonstração
-                    dados["meses"][mes][granularidade][indicador]["YTD"][periodo] = dados["meses"][mes][granularidade][indicador][periodo]
+                # YTD é acumulado desde o início do ano
+                # Simplificação: usamos o mesmo valor para demonstração
+                dados_indicador["YTD"][periodo] = dados_indicador[periodo]
     
     return dados
 
 # Função para processar importação de dados CSV
 def processar_importacao_csv(conteudo_csv):
-    dados_importados = []
+    # Registos em colunas (semana, granularidade, indicador, período, valor)
+    dados_importados = registos.ColunasStock(DIMENSOES_IMPORTACAO)
     csv_reader = csv.DictReader(io.StringIO(conteudo_csv))
     for row in csv_reader:
-        dados_importados.append(row)
+        dados_importados.acrescentar(
+            row.get("Semana"), row.get("Granularidade"),
+            row.get("Indicador"), row.get("Periodo"), float(row.get("Valor", 0))
+        )
     return dados_importados
 
+# Função para processar importação de folhas em formato largo (semanas ou indicadores em colunas)
+def processar_importacao_larga(conteudo, nome_ficheiro, mapeamento, planilha=None, intervalo=None):
+    grelha = importacao.ler_grelha(conteudo, nome_ficheiro, planilha, intervalo)
+    longo, nao_numericos = importacao.derreter_formato_largo(grelha, mapeamento)
+    return registos.ColunasStock.de_dataframe(longo, DIMENSOES_IMPORTACAO, ["semana", "granularidade", "indicador", "periodo"]), nao_numericos
+
 # Função para criar gráficos
 def criar_grafico(dados, periodo_tipo, periodo, granularidade, indicador, periodos_analise):
+    # Apenas os períodos com dados, por ordem cronológica
     if periodo_tipo == "semanas":
+        semanas = sorted(dados["semanas"])
         df = pd.DataFrame({
-            "Período": list(dados["semanas"].keys()),
-            **{p: [dados["semanas"][s][granularidade][indicador][p] for s in dados["semanas"]] for p in periodos_analise}
+            "Período": semanas,
+            **{p: [dados["semanas"][s][granularidade][indicador][p] for s in semanas] for p in periodos_analise}
         })
     else:  # meses
+        meses = sorted(dados["meses"])
         df = pd.DataFrame({
-            "Período": list(dados["meses"].keys()),
-            **{p: [dados["meses"][m][granularidade][indicador][p] for m in dados["meses"]] for p in periodos_analise}
+            "Período": meses,
+            **{p: [dados["meses"][m][granularidade][indicador][p] for m in meses] for p in periodos_analise}
         })
     
     fig = px.line(df, x="Período", y=periodos_analise, title=f"{indicador} - {granularidade}")
@@ -260,7 +250,7 @@ if pagina == "Visão Semanal":
     # Filtros
     col1, col2, col3 = st.columns(3)
     with col1:
-        semana_selecionada = st.selectbox("Selecione a Semana:", list(dados["semanas"].keys()))
+        semana_selecionada = st.selectbox("Selecione a Semana:", estrutura.opcoes_periodo(dados["semanas"], estrutura.proximas_semanas(NUM_SEMANAS_PADRAO)))
     with col2:
         granularidade_selecionada = st.selectbox("Selecione a Granularidade:", GRANULARIDADES_COM_TOTAL)
     with col3:
@@ -293,7 +283,7 @@ elif pagina == "Resumo Mensal":
     # Filtros
     col1, col2, col3 = st.columns(3)
     with col1:
-        mes_selecionado = st.selectbox("Selecione o Mês:", list(dados["meses"].keys()))
+        mes_selecionado = st.selectbox("Selecione o Mês:", estrutura.opcoes_periodo(dados["meses"], estrutura.proximos_meses(NUM_MESES_PADRAO)))
     with col2:
         granularidade_selecionada = st.selectbox("Selecione a Granularidade:", GRANULARIDADES_COM_TOTAL)
     with col3:
@@ -344,7 +334,7 @@ elif pagina == "Introdução de Dados":
     # Filtros
     col1, col2 = st.columns(2)
     with col1:
-        semana_selecionada = st.selectbox("Selecione a Semana:", list(dados["semanas"].keys()))
+        semana_selecionada = st.selectbox("Selecione a Semana:", estrutura.opcoes_periodo(dados["semanas"], estrutura.proximas_semanas(NUM_SEMANAS_PADRAO)))
     
     with col2:
         granularidade_selecionada = st.selectbox("Selecione a Granularidade:", GRANULARIDADES)
@@ -429,34 +419,58 @@ elif pagina == "Importação de Dados":
     Nota: Os valores de COGS e Rotação serão calculados automaticamente.
     """)
     
-    # Upload de arquivo CSV
-    uploaded_file = st.file_uploader("Escolha um arquivo CSV", type="csv")
+    formato_ficheiro = st.radio(
+        "Formato do ficheiro:",
+        ["Longo (uma linha por valor)", "Largo (semanas ou indicadores em colunas)"],
+        horizontal=True
+    )
     
-    if uploaded_file is not None:
-        # Ler o conteúdo do arquivo
-        conteudo = uploaded_file.getvalue().decode("utf-8")
+    if formato_ficheiro.startswith("Largo"):
+        # Mapeamento da folha: o que representam as colunas de valores e as dimensões em falta
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            formato_largo = st.selectbox(
+                "Colunas de valores:", importacao.FORMATOS_LARGOS,
+                format_func=lambda f: "Semanas" if f == "semanas_em_colunas" else "Indicadores (e períodos)"
+            )
+        with col2:
+            periodo_constante = st.selectbox("Período:", ["(na folha)"] + PERIODOS_ANALISE)
+        with col3:
+            intervalo = st.text_input("Intervalo de células:", help="Ex.: B3:N40 (a primeira linha tem os cabeçalhos)")
         
-        # Processar o CSV
+        constantes = {}
+        if periodo_constante != "(na folha)":
+            constantes["periodo"] = periodo_constante
+        mapeamento = {"formato": formato_largo, "constantes": constantes}
+    
+    # Upload de arquivo CSV (ou Excel, no formato largo)
+    uploaded_file = st.file_uploader(
+        "Escolha um arquivo CSV", type="csv" if formato_ficheiro.startswith("Longo") else ["csv", "xlsx"]
+    )
+    
+    if uploaded_file is not None:
+        # Processar o arquivo
         try:
-            dados_importados = processar_importacao_csv(conteudo)
+            if formato_ficheiro.startswith("Longo"):
+                dados_importados = processar_importacao_csv(uploaded_file.getvalue().decode("utf-8"))
+            else:
+                dados_importados, nao_numericos = processar_importacao_larga(
+                    uploaded_file.getvalue(), uploaded_file.name, mapeamento, intervalo=intervalo or None
+                )
+                if nao_numericos:
+                    st.warning(f"{nao_numericos} valores ignorados por não serem numéricos.")
             
             # Exibir prévia dos dados
             st.subheader("Prévia dos Dados")
-            df_preview = pd.DataFrame(dados_importados)
+            df_preview = dados_importados.para_dataframe(["Semana", "Granularidade", "Indicador", "Periodo"], "Valor")
             st.dataframe(df_preview, use_container_width=True)
             
             # Botão para confirmar importação
             if st.button("Confirmar Importação"):
                 # Atualizar dados com os valores importados
-                for row in dados_importados:
-                    semana = row.get("Semana")
-                    granularidade = row.get("Granularidade")
-                    indicador = row.get("Indicador")
-                    periodo = row.get("Periodo")
-                    valor = float(row.get("Valor", 0))
-                    
+                for semana, granularidade, indicador, periodo, valor in dados_importados:
                     # Verificar se os valores são válidos
-                    if (semana in dados["semanas"] and 
+                    if (semana and FORMATO_SEMANA.match(semana) and 
                         granularidade in GRANULARIDADES and 
                         indicador in INDICADORES and 
                         indicador not in ["Rotação", "COGS"] and 
@@ -470,13 +484,15 @@ elif pagina == "Importação de Dados":
                 # Atualizar COGS
                 dados = atualizar_cogs(dados)
                 
-                # Calcular rotação
-                for semana in dados["semanas"]:
-                    for granularidade in GRANULARIDADES_COM_TOTAL:
+                # Calcular rotação (apenas onde existe stock líquido)
+                for dados_semana in dados["semanas"].values():
+                    for dados_granularidade in dados_semana.values():
+                        if "Stock Liquido" not in dados_granularidade:
+                            continue
                         for periodo in PERIODOS_ANALISE:
-                            stock_liquido = dados["semanas"][semana][granularidade]["Stock Liquido"][periodo]
-                            cogs = dados["semanas"][semana][granularidade]["COGS"][periodo]
-                            dados["semanas"][semana][granularidade]["Rotação"][periodo] = calcular_rotacao(stock_liquido, cogs)
+                            stock_liquido = dados_granularidade["Stock Liquido"][periodo]
+                            cogs = dados_granularidade["COGS"][periodo]
+                            dados_granularidade["Rotação"][periodo] = calcular_rotacao(stock_liquido, cogs)
                 
                 # Atualizar resumo mensal
                 dados = atualizar_resumo_mensal(dados)
@@ -4,8 +4,29 @@ import plotly.express as px
 import plotly.graph_objects as go
 import json
 import os
-import sqlite3
-from datetime import datetime, timedelta, date
+import io
+from datetime import datetime, date, time
+import carregamento
+import cenarios
+import diagnosticos
+import escrita
+import estrutura
+import exportacao
+import importacao
+import janelas
+import leitura
+import matrizes
+import metas
+import perfil
+import projecao
+import reconstrucao
+import variacoes
+import sincronizacao
+import tendencias
+from carregamento import (
+    INDICADORES_CALCULADOS_CARREGADOS, NIVEIS_ESTRUTURA, calcular_dias_acumulados
+)
+from diagnosticos import medir_tempo
 
 # Constantes
 REGIOES = ["PT", "ES Mainland", "ES Canárias"]
@@ -30,41 +51,22 @@ PERIODOS_ANALISE = ["Budget", "Last Year", "Real + Projeção", "Introduzido"]
 
 PERIODOS_ACUMULADOS = ["YTD", "EOP"]
 
+# Indicadores semanais, incluindo as janelas móveis (calculadas ao carregar)
+INDICADORES_SEMANAIS = INDICADORES + janelas.INDICADORES_JANELA
+
+# Página de diagnósticos (oculta): ativada com ?diagnosticos=1 ou STOCK_DIAGNOSTICOS=1
+DIAGNOSTICOS_ATIVOS = os.environ.get("STOCK_DIAGNOSTICOS", "0") == "1"
+
 # Caminho para o banco de dados
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stock_monitor.db')
 
-# Função para calcular dias acumulados desde o início do ano
-def calcular_dias_acumulados(data_str):
-    # Converter string de semana para data
-    if "W" in data_str:  # Formato de semana
-        ano, semana = data_str.split("-W")
-        # Primeiro dia da semana
-        primeiro_dia_semana = datetime.strptime(f"{ano}-{semana}-1", "%Y-%W-%w").date()
-        # Último dia da semana (domingo)
-        ultimo_dia_semana = primeiro_dia_semana + timedelta(days=6)
-        data = ultimo_dia_semana
-    else:  # Formato de mês
-        ano, mes = data_str.split("-")
-        # Primeiro dia do próximo mês
-        if mes == "12":
-            primeiro_dia_proximo_mes = date(int(ano) + 1, 1, 1)
-        else:
-            primeiro_dia_proximo_mes = date(int(ano), int(mes) + 1, 1)
-        # Último dia do mês atual (um dia antes do primeiro dia do próximo mês)
-        ultimo_dia_mes = primeiro_dia_proximo_mes - timedelta(days=1)
-        data = ultimo_dia_mes
-    
-    # Primeiro dia do ano
-    primeiro_dia_ano = date(data.year, 1, 1)
-    
-    # Calcular dias acumulados
-    dias_acumulados = (data - primeiro_dia_ano).days + 1
-    
-    return dias_acumulados
-
-# Função para conectar ao banco de dados
-def conectar_bd():
-    return sqlite3.connect(DB_PATH)
+# Função para aplicar ao banco de dados existente as alterações de esquema (índices, triggers, views).
+# Executada uma vez por processo; as instruções em db_setup são idempotentes.
+@st.cache_resource
+def atualizar_esquema_bd():
+    from db_setup import criar_tabelas
+    criar_tabelas()
+    return True
 
 # Função para verificar se o banco de dados existe e está configurado
 def verificar_bd():
@@ -74,400 +76,91 @@ def verificar_bd():
         criar_tabelas()
         st.success("Banco de dados criado com sucesso!")
         return False
+    atualizar_esquema_bd()
     return True
 
-# Função para carregar dados do banco de dados
-def carregar_dados_bd():
-    if not verificar_bd():
-        return criar_estrutura_dados()
-    
-    dados = {"semanas": {}, "meses": {}}
-    conn = conectar_bd()
-    
+# Função para carregar dados do banco de dados (lidos pela ligação do instantâneo desta execução).
+# linhas_semanais substitui os valores semanais guardados (por ex. os de reconstrucao.linhas_semanais).
+@medir_tempo("carregar_dados_bd")
+def carregar_dados_bd(conn, linhas_semanais=None):
     try:
-        # Carregar dados semanais
-        df_semanas = pd.read_sql("""
-            SELECT semana, regiao, granularidade, indicador, periodo, valor
-            FROM dados_stock
-            UNION ALL
-            SELECT semana, regiao, granularidade, indicador, periodo, valor
-            FROM view_iberica_semanal
-            UNION ALL
-            SELECT semana, regiao, granularidade, indicador, periodo, valor
-            FROM view_total_semanal
-        """, conn)
-        
-        # Processar dados semanais
-        for _, row in df_semanas.iterrows():
-            semana = row['semana']
-            regiao = row['regiao']
-            granularidade = row['granularidade']
-            indicador = row['indicador']
-            periodo = row['periodo']
-            valor = row['valor']
-            
-            if semana not in dados["semanas"]:
-                dados["semanas"][semana] = {}
-            
-            if regiao not in dados["semanas"][semana]:
-                dados["semanas"][semana][regiao] = {}
-            
-            if granularidade not in dados["semanas"][semana][regiao]:
-                dados["semanas"][semana][regiao][granularidade] = {}
-            
-            if indicador not in dados["semanas"][semana][regiao][granularidade]:
-                dados["semanas"][semana][regiao][granularidade][indicador] = {}
-            
-            dados["semanas"][semana][regiao][granularidade][indicador][periodo] = valor
-        
-        # Carregar dados mensais
-        df_meses = pd.read_sql("""
-            SELECT mes, regiao, granularidade, indicador, periodo, periodo_acumulado, valor
-            FROM dados_stock_mensal
-        """, conn)
-        
-        # Processar dados mensais
-        for _, row in df_meses.iterrows():
-            mes = row['mes']
-            regiao = row['regiao']
-            granularidade = row['granularidade']
-            indicador = row['indicador']
-            periodo = row['periodo']
-            periodo_acumulado = row['periodo_acumulado']
-            valor = row['valor']
-            
-            if mes not in dados["meses"]:
-                dados["meses"][mes] = {}
-            
-            if regiao not in dados["meses"][mes]:
-                dados["meses"][mes][regiao] = {}
-            
-            if granularidade not in dados["meses"][mes][regiao]:
-                dados["meses"][mes][regiao][granularidade] = {}
-            
-            if indicador not in dados["meses"][mes][regiao][granularidade]:
-                dados["meses"][mes][regiao][granularidade][indicador] = {}
-            
-            if periodo_acumulado:
-                if periodo_acumulado not in dados["meses"][mes][regiao][granularidade][indicador]:
-                    dados["meses"][mes][regiao][granularidade][indicador][periodo_acumulado] = {}
-                
-                dados["meses"][mes][regiao][granularidade][indicador][periodo_acumulado][periodo] = valor
-            else:
-                dados["meses"][mes][regiao][granularidade][indicador][periodo] = valor
-    
+        dados = carregamento.ler_dados(conn, linhas_semanais)
     except Exception as e:
         st.error(f"Erro ao carregar dados do banco de dados: {e}")
         return criar_estrutura_dados()
     
-    finally:
-        conn.close()
-    
     # Atualizar cálculos automáticos
-    dados = atualizar_cogs(dados)
-    dados = atualizar_rotacao(dados)
-    
-    return dados
+    return carregamento.calcular_dados(dados)
 
 # Função para salvar dados no banco de dados
-def salvar_dados_bd(dados, semana=None, regiao=None, granularidade=None, indicador=None, periodo=None, valor=None):
+# celulas: tuplos (semana, regiao, granularidade, indicador, periodo, valor, versao_lida).
+# As escritas passam pela fila de escrita do processo; ConflitoEdicao é propagado para a página.
+@medir_tempo("salvar_dados_bd")
+def salvar_dados_bd(celulas):
     if not verificar_bd():
-        return False
-    
-    conn = conectar_bd()
-    cursor = conn.cursor()
+        return None
     
     try:
-        if semana and regiao and granularidade and indicador and periodo is not None and valor is not None:
-            # Inserir ou atualizar um valor específico
-            cursor.execute("""
-                INSERT INTO dados_stock (semana, regiao, granularidade, indicador, periodo, valor)
-                VALUES (?, ?, ?, ?, ?, ?)
-                ON CONFLICT(semana, regiao, granularidade, indicador, periodo) 
-                DO UPDATE SET valor = excluded.valor, data_atualizacao = CURRENT_TIMESTAMP
-            """, (semana, regiao, granularidade, indicador, periodo, valor))
-        else:
-            # Salvar todos os dados (não implementado nesta versão)
-            pass
-        
-        conn.commit()
-        return True
+        return escrita.gravar_celulas(celulas, DB_PATH)
+    
+    except escrita.ConflitoEdicao:
+        raise
     
     except Exception as e:
         st.error(f"Erro ao salvar dados no banco de dados: {e}")
-        return False
-    
-    finally:
-        conn.close()
+        return None
+
+# Função para ler as versões (valor, data_atualizacao) das células de um formulário, no mesmo
+# instantâneo dos valores mostrados
+def ler_versoes_bd(conn, celulas):
+    return escrita.ler_versoes(conn, celulas)
+
+# Matrizes do mapa de calor, calculadas uma vez por instantâneo dos dados (a chave é o id do
+# instantâneo; a ligação não entra no hash)
+@st.cache_data(max_entries=64, show_spinner=False)
+def matriz_regiao_granularidade_bd(id_instantaneo, _conn, semana, indicador, periodo):
+    return matrizes.matriz_regiao_granularidade(semana, indicador, periodo, DB_PATH, conn=_conn)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def matriz_semana_regiao_bd(id_instantaneo, _conn, semana_inicio, semana_fim, granularidade, indicador, periodo):
+    tendencia = tendencias.ler_tendencia(
+        semana_inicio, semana_fim, REGIOES_COM_IBERICA, granularidade, indicador, [periodo], DB_PATH, conn=_conn
+    )
+    return matrizes.matriz_semana_regiao(tendencia)
+
+# Comparação de cenários, calculada uma vez por instantâneo dos dados e versão dos cenários comparados
+@st.cache_data(max_entries=16, show_spinner=False)
+def comparar_cenarios_bd(id_instantaneo, _conn, versao_cenarios, nomes):
+    return cenarios.comparar_cenarios(nomes, DB_PATH, conn=_conn)
 
 # Função para criar estrutura de dados inicial
+# As células só são alocadas quando escritas; as que faltam valem 0.0
 def criar_estrutura_dados():
     # Verificar se já existe um arquivo de dados
     if os.path.exists("dados.json"):
         try:
             with open("dados.json", "r") as f:
-                return json.load(f)
+                return estrutura.criar_dados_esparsos(NIVEIS_ESTRUTURA, json.load(f))
         except:
             pass
     
     # Criar estrutura de dados vazia
-    dados = {"semanas": {}, "meses": {}}
-    
-    # Gerar semanas para o ano atual
-    ano_atual = datetime.now().year
-    for semana in range(1, 53):
-        semana_str = f"{ano_atual}-W{semana:02d}"
-        dados["semanas"][semana_str] = {}
-        
-        for regiao in REGIOES_COM_IBERICA:
-            dados["semanas"][semana_str][regiao] = {}
-            
-            for granularidade in GRANULARIDADES_COM_TOTAL:
-                dados["semanas"][semana_str][regiao][granularidade] = {}
-                
-                for indicador in INDICADORES:
-                    dados["semanas"][semana_str][regiao][granularidade][indicador] = {}
-                    
-                    for periodo in PERIODOS_ANALISE:
-                        dados["semanas"][semana_str][regiao][granularidade][indicador][periodo] = 0.0
-    
-    # Gerar meses para o ano atual
-    for mes in range(1, 13):
-        mes_str = f"{ano_atual}-{mes:02d}"
-        dados["meses"][mes_str] = {}
-        
-        for regiao in REGIOES_COM_IBERICA:
-            dados["meses"][mes_str][regiao] = {}
-            
-            for granularidade in GRANULARIDADES_COM_TOTAL:
-                dados["meses"][mes_str][regiao][granularidade] = {}
-                
-                for indicador in INDICADORES:
-                    dados["meses"][mes_str][regiao][granularidade][indicador] = {}
-                    
-                    for periodo in PERIODOS_ANALISE:
-                        dados["meses"][mes_str][regiao][granularidade][indicador][periodo] = 0.0
-                    
-                    for periodo_acumulado in PERIODOS_ACUMULADOS:
-                        dados["meses"][mes_str][regiao][granularidade][indicador][periodo_acumulado] = {}
-                        
-                        for periodo in PERIODOS_ANALISE:
-                            dados["meses"][mes_str][regiao][granularidade][indicador][periodo_acumulado][periodo] = 0.0
-    
-    return dados
-
-# Função para calcular COGS
-def calcular_cogs(vendas, mfo, quebra):
-    return vendas - mfo - quebra
-
-# Função para calcular rotação
-def calcular_rotacao(stock_liquido_medio, cogs_acumulado, dias_acumulados):
-    if stock_liquido_medio == 0 or cogs_acumulado == 0:
-        return 0
-    return (stock_liquido_medio / cogs_acumulado) * dias_acumulados
-
-# Função para calcular stock líquido médio YTD
-def calcular_stock_liquido_medio_ytd(dados, data_atual, regiao, granularidade, periodo):
-    # Converter data_atual para datetime
-    if "W" in data_atual:  # Formato de semana
-        ano, semana = data_atual.split("-W")
-        data = datetime.strptime(f"{ano}-{semana}-1", "%Y-%W-%w").date()
-    else:  # Formato de mês
-        data = datetime.strptime(data_atual + "-01", "%Y-%m-%d").date()
-    
-    # Primeiro dia do ano
-    primeiro_dia_ano = date(data.year, 1, 1)
-    
-    # Calcular média do stock líquido desde o início do ano até a data atual
-    stock_liquido_total = 0
-    count = 0
-    
-    # Para semanas
-    for semana in dados["semanas"]:
-        # Converter semana para data
-        ano_s, semana_s = semana.split("-W")
-        data_semana = datetime.strptime(f"{ano_s}-{semana_s}-1", "%Y-%W-%w").date()
-        
-        # Verificar se a semana está entre o início do ano e a data atual
-        if primeiro_dia_ano <= data_semana <= data:
-            stock_liquido_total += dados["semanas"][semana][regiao][granularidade]["Stock Liquido"][periodo]
-            count += 1
-    
-    # Se não houver dados, retornar 0
-    if count == 0:
-        return 0
-    
-    return stock_liquido_total / count
-
-# Função para calcular COGS acumulado YTD
-def calcular_cogs_acumulado_ytd(dados, data_atual, regiao, granularidade, periodo):
-    # Converter data_atual para datetime
-    if "W" in data_atual:  # Formato de semana
-        ano, semana = data_atual.split("-W")
-        data = datetime.strptime(f"{ano}-{semana}-1", "%Y-%W-%w").date()
-    else:  # Formato de mês
-        data = datetime.strptime(data_atual + "-01", "%Y-%m-%d").date()
-    
-    # Primeiro dia do ano
-    primeiro_dia_ano = date(data.year, 1, 1)
-    
-    # Calcular COGS acumulado desde o início do ano até a data atual
-    cogs_acumulado = 0
-    
-    # Para semanas
-    for semana in dados["semanas"]:
-        # Converter semana para data
-        ano_s, semana_s = semana.split("-W")
-        data_semana = datetime.strptime(f"{ano_s}-{semana_s}-1", "%Y-%W-%w").date()
-        
-        # Verificar se a semana está entre o início do ano e a data atual
-        if primeiro_dia_ano <= data_semana <= data:
-            cogs_acumulado += dados["semanas"][semana][regiao][granularidade]["COGS"][periodo]
-    
-    return cogs_acumulado
-
-# Função para atualizar COGS
-def atualizar_cogs(dados):
-    # Para cada semana
-    for semana in dados["semanas"]:
-        # Para cada região
-        for regiao in REGIOES_COM_IBERICA:
-            # Para cada granularidade
-            for granularidade in GRANULARIDADES_COM_TOTAL:
-                # Para cada período
-                for periodo in PERIODOS_ANALISE:
-                    # Obter valores
-                    vendas = dados["semanas"][semana][regiao][granularidade]["Vendas"][periodo]
-                    mfo = dados["semanas"][semana][regiao][granularidade]["MFO"][periodo]
-                    quebra = dados["semanas"][semana][regiao][granularidade]["Quebra"][periodo]
-                    
-                    # Calcular COGS
-                    dados["semanas"][semana][regiao][granularidade]["COGS"][periodo] = calcular_cogs(vendas, mfo, quebra)
-    
-    # Para cada mês
-    for mes in dados["meses"]:
-        # Para cada região
-        for regiao in REGIOES_COM_IBERICA:
-            # Para cada granularidade
-            for granularidade in GRANULARIDADES_COM_TOTAL:
-                # Para cada período
-                for periodo in PERIODOS_ANALISE:
-                    # Obter valores
-                    vendas = dados["meses"][mes][regiao][granularidade]["Vendas"][periodo]
-                    mfo = dados["meses"][mes][regiao][granularidade]["MFO"][periodo]
-                    quebra = dados["meses"][mes][regiao][granularidade]["Quebra"][periodo]
-                    
-                    # Calcular COGS
-                    dados["meses"][mes][regiao][granularidade]["COGS"][periodo] = calcular_cogs(vendas, mfo, quebra)
-                
-                # Para cada período acumulado
-                for periodo_acumulado in PERIODOS_ACUMULADOS:
-                    for periodo in PERIODOS_ANALISE:
-                        # Obter valores
-                        vendas = dados["meses"][mes][regiao][granularidade]["Vendas"][periodo_acumulado][periodo]
-                        mfo = dados["meses"][mes][regiao][granularidade]["MFO"][periodo_acumulado][periodo]
-                        quebra = dados["meses"][mes][regiao][granularidade]["Quebra"][periodo_acumulado][periodo]
-                        
-                        # Calcular COGS
-                        dados["meses"][mes][regiao][granularidade]["COGS"][periodo_acumulado][periodo] = calcular_cogs(vendas, mfo, quebra)
-    
-    return dados
-
-# Função para atualizar rotação
-def atualizar_rotacao(dados):
-    # Para cada semana
-    for semana in dados["semanas"]:
-        # Calcular dias acumulados para esta semana
-        dias_acumulados = calcular_dias_acumulados(semana)
-        
-        # Para cada região
-        for regiao in REGIOES_COM_IBERICA:
-            # Para cada granularidade
-            for granularidade in GRANULARIDADES_COM_TOTAL:
-                # Para cada período
-                for periodo in PERIODOS_ANALISE:
-                    # Para EOP semanal: usar stock líquido médio daquela semana
-                    stock_liquido_medio = dados["semanas"][semana][regiao][granularidade]["Stock Liquido"][periodo]
-                    
-                    # Calcular COGS acumulado YTD
-                    cogs_acumulado = calcular_cogs_acumulado_ytd(dados, semana, regiao, granularidade, periodo)
-                    
-                    # Calcular rotação = (Stock Líquido médio / COGS acumulado) * Dias acumulados
-                    dados["semanas"][semana][regiao][granularidade]["Rotação"][periodo] = calcular_rotacao(stock_liquido_medio, cogs_acumulado, dias_acumulados)
-    
-    # Para cada mês
-    for mes in dados["meses"]:
-        # Calcular dias acumulados para este mês
-        dias_acumulados = calcular_dias_acumulados(mes)
-        
-        # Para cada região
-        for regiao in REGIOES_COM_IBERICA:
-            # Para cada granularidade
-            for granularidade in GRANULARIDADES_COM_TOTAL:
-                # Para cada período
-                for periodo in PERIODOS_ANALISE:
-                    # Para EOP mensal: usar stock líquido médio daquele mês
-                    stock_liquido_medio = dados["meses"][mes][regiao][granularidade]["Stock Liquido"][periodo]
-                    
-                    # Calcular COGS acumulado YTD
-                    cogs_acumulado = calcular_cogs_acumulado_ytd(dados, mes, regiao, granularidade, periodo)
-                    
-                    # Calcular rotação = (Stock Líquido médio / COGS acumulado) * Dias acumulados
-                    dados["meses"][mes][regiao][granularidade]["Rotação"][periodo] = calcular_rotacao(stock_liquido_medio, cogs_acumulado, dias_acumulados)
-                
-                # Para cada período acumulado
-                for periodo in PERIODOS_ANALISE:
-                    # Para YTD: usar stock líquido médio desde o início do ano
-                    stock_liquido_medio_ytd = calcular_stock_liquido_medio_ytd(dados, mes, regiao, granularidade, periodo)
-                    
-                    # Calcular COGS acumulado YTD
-                    cogs_acumulado = calcular_cogs_acumulado_ytd(dados, mes, regiao, granularidade, periodo)
-                    
-                    # Calcular rotação YTD = (Stock Líquido médio YTD / COGS acumulado) * Dias acumulados
-                    dados["meses"][mes][regiao][granularidade]["Rotação"]["YTD"][periodo] = calcular_rotacao(stock_liquido_medio_ytd, cogs_acumulado, dias_acumulados)
-                    
-                    # Para EOP: usar stock líquido médio do mês
-                    dados["meses"][mes][regiao][granularidade]["Rotação"]["EOP"][periodo] = dados["meses"][mes][regiao][granularidade]["Rotação"][periodo]
-    
-    return dados
+    return estrutura.criar_dados_esparsos(NIVEIS_ESTRUTURA)
 
 # Função para obter histórico de alterações
-def obter_historico_alteracoes(limite=100):
+@medir_tempo("obter_historico_alteracoes")
+def obter_historico_alteracoes(conn, limite=100, cursor=None, semana=None, regiao=None, indicador=None, usuario=None):
+    # Paginação por keyset: o cursor é o par (data_alteracao, id) da última linha da página anterior.
+    # Devolve (DataFrame, cursor da página seguinte ou None).
     if not verificar_bd():
-        return []
-    
-    conn = conectar_bd()
+        return [], None
     
     try:
-        df = pd.read_sql(f"""
-            SELECT 
-                id,
-                tabela,
-                semana_ou_mes,
-                regiao,
-                granularidade,
-                indicador,
-                periodo,
-                periodo_acumulado,
-                valor_antigo,
-                valor_novo,
-                usuario,
-                datetime(data_alteracao) as data_alteracao
-            FROM 
-                historico_alteracoes
-            ORDER BY 
-                data_alteracao DESC
-            LIMIT {limite}
-        """, conn)
-        
-        return df
+        return leitura.ler_historico(conn, limite, cursor, semana, regiao, indicador, usuario)
     
     except Exception as e:
         st.error(f"Erro ao obter histórico de alterações: {e}")
-        return []
-    
-    finally:
-        conn.close()
+        return [], None
 
 # Configuração da página
 st.set_page_config(
@@ -477,225 +170,948 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Carregar dados
-dados = carregar_dados_bd()
+# Perfilagem opcional desta execução (STOCK_PERFIL=1 ou ?perfil=1); sem custo quando desativada
+estado_perfil = perfil.iniciar_perfil() if perfil.perfil_ativo(st.query_params) else None
 
-# Sidebar
-st.sidebar.title("Ferramenta de Monitorização de Stock")
+# Instantâneo de leitura desta execução (aberto mais abaixo, fechado no finally)
+instantaneo = None
 
-# Seleção de região
-regiao_selecionada = st.sidebar.selectbox("Selecione a Região:", REGIOES_COM_IBERICA)
+# O resto da execução: o instantâneo é fechado e o perfil guardado mesmo com st.rerun(), st.stop() ou uma exceção
+try:
+    # Iniciar medição desta execução do script
+    diagnosticos.iniciar_execucao()
 
-# Seleção de página
-pagina = st.sidebar.radio("Selecione a Página:", ["Visão Semanal", "Resumo Mensal", "Introdução de Dados", "Histórico de Alterações"])
+    # Instantâneo de leitura: todas as leituras desta execução (dados, matrizes, tendências, cenários,
+    # histórico) veem o mesmo estado da base de dados, mesmo com escritas concorrentes
+    bd_existente = verificar_bd()
+    instantaneo = leitura.Instantaneo(DB_PATH)
 
-# Visão Semanal
-if pagina == "Visão Semanal":
-    st.header(f"Visão Semanal - {regiao_selecionada}")
-    
-    # Filtros
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        semana_selecionada = st.selectbox("Selecione a Semana:", list(dados["semanas"].keys()))
-    
-    with col2:
-        granularidade_selecionada = st.selectbox("Selecione a Granularidade:", GRANULARIDADES_COM_TOTAL)
-    
-    with col3:
-        indicador_selecionado = st.selectbox("Selecione o Indicador:", INDICADORES)
-    
-    # Seleção de períodos para comparação
-    periodos_selecionados = st.multiselect("Selecione os Períodos para Comparação:", PERIODOS_ANALISE, default=PERIODOS_ANALISE)
-    
-    if periodos_selecionados:
-        # Preparar dados para o gráfico
-        valores = []
-        for periodo in periodos_selecionados:
-            valor = dados["semanas"][semana_selecionada][regiao_selecionada][granularidade_selecionada][indicador_selecionado][periodo]
-            valores.append({"Período": periodo, "Valor": valor})
-        
-        df = pd.DataFrame(valores)
-        
-        # Criar gráfico
-        fig = px.bar(
-            df, 
-            x="Período", 
-            y="Valor", 
-            title=f"{indicador_selecionado} - {semana_selecionada} - {regiao_selecionada} - {granularidade_selecionada}",
-            color="Período"
+    # Sidebar
+    st.sidebar.title("Ferramenta de Monitorização de Stock")
+
+    # Seleção de região
+    regiao_selecionada = st.sidebar.selectbox("Selecione a Região:", REGIOES_COM_IBERICA)
+
+    # Dados numa data passada: os valores semanais são reconstruídos a partir do histórico de alterações
+    instante_reconstrucao = None
+    if bd_existente and st.sidebar.checkbox("Ver os dados numa data passada"):
+        col_data, col_hora = st.sidebar.columns(2)
+        data_reconstrucao = col_data.date_input("Data (UTC):", value=date.today(), max_value=date.today())
+        hora_reconstrucao = col_hora.time_input("Hora (UTC):", value=time(23, 59))
+        instante_reconstrucao = datetime.combine(data_reconstrucao, hora_reconstrucao)
+
+    # Carregar dados
+    if instante_reconstrucao:
+        with medir_tempo("reconstruir_instante"):
+            linhas_reconstruidas, reconstrucao_info = reconstrucao.linhas_semanais(instantaneo.conn, instante_reconstrucao)
+            dados = carregar_dados_bd(instantaneo.conn, linhas_reconstruidas)
+        origem_reconstrucao = (
+            f"do ponto de controlo de {reconstrucao_info['data_ponto_controlo']}" if reconstrucao_info["ponto_controlo"]
+            else "dos dados atuais"
         )
+        st.sidebar.caption(
+            f"Valores semanais em {reconstrucao_info['instante']} UTC, revertendo o histórico a partir {origem_reconstrucao}. "
+            "Os dados mensais são os atuais."
+        )
+        if reconstrucao_info["historico_desde"] and reconstrucao_info["instante"] < reconstrucao_info["historico_desde"]:
+            st.sidebar.warning(
+                f"O histórico guardado começa em {reconstrucao_info['historico_desde']}: "
+                "alterações anteriores (arquivadas) não são revertidas."
+            )
+        elif reconstrucao_info["compactado_ate"] and reconstrucao_info["instante"] < reconstrucao_info["compactado_ate"]:
+            st.sidebar.warning(
+                f"O histórico anterior a {reconstrucao_info['compactado_ate']} foi compactado (uma alteração por célula e dia): "
+                "nos dias com várias alterações, os valores são os do início do dia e não os desse instante."
+            )
+    else:
+        dados = carregar_dados_bd(instantaneo.conn) if bd_existente else criar_estrutura_dados()
+
+    # Cenário de simulação: as suas células sobrepõem-se aos dados reais em todas as páginas
+    if "cenario_pedido" in st.session_state:
+        st.session_state["cenario_ativo"] = st.session_state.pop("cenario_pedido")
+    opcoes_cenario = [None] + sorted(
+        {cenario["nome"] for cenario in cenarios.listar_cenarios(DB_PATH, conn=instantaneo.conn)} | set(st.session_state.get("cenarios_novos", []))
+    )
+    if st.session_state.get("cenario_ativo") not in opcoes_cenario:
+        st.session_state["cenario_ativo"] = None
+    cenario_ativo = st.sidebar.selectbox("Cenário:", opcoes_cenario, format_func=lambda nome: nome or "Dados reais", key="cenario_ativo")
+    if cenario_ativo:
+        with medir_tempo("aplicar_cenario"):
+            dados = cenarios.aplicar_cenario(dados, cenarios.ler_cenario(cenario_ativo, DB_PATH, conn=instantaneo.conn))
+        st.sidebar.caption("Valores do cenário sobrepostos aos dados reais (que não são alterados).")
+
+    # Num cenário ou numa data passada, as páginas usam só os dados carregados (e não consultas à base de dados)
+    dados_do_cubo = bool(cenario_ativo or instante_reconstrucao)
+    st.sidebar.caption(f"Dados: instantâneo {instantaneo.id} ({instantaneo.lido_em:%H:%M:%S})")
+
+    # Seleção de página
+    paginas = ["Visão Semanal", "Resumo Mensal", "Tendências", "Mapa de Calor", "Comparação de Cenários", "Introdução de Dados", "Importação de Dados", "Exportação de Dados", "Histórico de Alterações"]
+    if DIAGNOSTICOS_ATIVOS or st.query_params.get("diagnosticos") == "1":
+        paginas.append("Diagnósticos")
+    pagina = st.sidebar.radio("Selecione a Página:", paginas)
+
+    # Visão Semanal
+    if pagina == "Visão Semanal":
+        st.header(f"Visão Semanal - {regiao_selecionada}")
         
-        st.plotly_chart(fig, use_container_width=True)
+        # Filtros
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            semana_selecionada = st.selectbox("Selecione a Semana:", estrutura.opcoes_periodo(dados["semanas"], estrutura.semanas_do_ano()))
         
-        # Tabela de dados
-        st.subheader("Dados Detalhados")
-        st.dataframe(df)
-    else:
-        st.warning("Selecione pelo menos um período para visualização.")
+        with col2:
+            granularidade_selecionada = st.selectbox("Selecione a Granularidade:", GRANULARIDADES_COM_TOTAL)
+        
+        with col3:
+            indicador_selecionado = st.selectbox("Selecione o Indicador:", INDICADORES_SEMANAIS)
+        
+        # Seleção de períodos para comparação
+        periodos_selecionados = st.multiselect("Selecione os Períodos para Comparação:", PERIODOS_ANALISE, default=PERIODOS_ANALISE)
+        
+        if periodos_selecionados:
+            # Preparar dados para o gráfico
+            valores = []
+            for periodo in periodos_selecionados:
+                valor = dados["semanas"][semana_selecionada][regiao_selecionada][granularidade_selecionada][indicador_selecionado][periodo]
+                valores.append({"Período": periodo, "Valor": valor})
+            
+            df = pd.DataFrame(valores)
+            
+            # Criar gráfico
+            with medir_tempo("grafico_semanal"):
+                fig = px.bar(
+                    df, 
+                    x="Período", 
+                    y="Valor", 
+                    title=f"{indicador_selecionado} - {semana_selecionada} - {regiao_selecionada} - {granularidade_selecionada}",
+                    color="Período"
+                )
+            
+            st.plotly_chart(fig, use_container_width=True)
+            
+            # Tabela de dados
+            st.subheader("Dados Detalhados")
+            st.dataframe(df)
+        else:
+            st.warning("Selecione pelo menos um período para visualização.")
+        
+        # Variações do real face ao Budget e ao Last Year
+        st.subheader("Variações")
+        dados_indicador = dados["semanas"][semana_selecionada][regiao_selecionada][granularidade_selecionada][indicador_selecionado]
+        for coluna, sufixo in zip(st.columns(len(variacoes.REFERENCIAS_VARIACAO)), variacoes.REFERENCIAS_VARIACAO):
+            # dict.get: as células sem variação (sem real ou referência, ou referência 0 na %) mostram "—" e não 0
+            absoluta = dados_indicador.get(f"Real vs {sufixo}")
+            percentual = dados_indicador.get(f"Real vs {sufixo} %")
+            with coluna:
+                st.metric(
+                    f"Real vs {sufixo}",
+                    "—" if absoluta is None else f"{absoluta:,.2f}",
+                    None if percentual is None else f"{percentual:.1f}%"
+                )
 
-# Resumo Mensal
-elif pagina == "Resumo Mensal":
-    st.header(f"Resumo Mensal - {regiao_selecionada}")
-    
-    # Filtros
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        mes_selecionado = st.selectbox("Selecione o Mês:", list(dados["meses"].keys()))
-    
-    with col2:
-        granularidade_selecionada = st.selectbox("Selecione a Granularidade:", GRANULARIDADES_COM_TOTAL)
-    
-    with col3:
-        tipo_periodo = st.selectbox("Selecione o Tipo de Período:", ["Mensal", "YTD", "EOP"])
-    
-    # Preparar dados para os gráficos
-    dados_tabela = []
-    
-    for indicador in INDICADORES:
-        for periodo in PERIODOS_ANALISE:
-            if tipo_periodo == "Mensal":
-                valor = dados["meses"][mes_selecionado][regiao_selecionada][granularidade_selecionada][indicador][periodo]
-            else:  # YTD ou EOP
-                valor = dados["meses"][mes_selecionado][regiao_selecionada][granularidade_selecionada][indicador][tipo_periodo][periodo]
+    # Resumo Mensal
+    elif pagina == "Resumo Mensal":
+        st.header(f"Resumo Mensal - {regiao_selecionada}")
+        
+        # Filtros
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            mes_selecionado = st.selectbox("Selecione o Mês:", estrutura.opcoes_periodo(dados["meses"], estrutura.meses_do_ano()))
+        
+        with col2:
+            granularidade_selecionada = st.selectbox("Selecione a Granularidade:", GRANULARIDADES_COM_TOTAL)
+        
+        with col3:
+            tipo_periodo = st.selectbox("Selecione o Tipo de Período:", ["Mensal", "YTD", "EOP"])
+        
+        # Preparar dados para os gráficos
+        dados_tabela = []
+        
+        for indicador in INDICADORES:
+            for periodo in PERIODOS_ANALISE:
+                if tipo_periodo == "Mensal":
+                    valor = dados["meses"][mes_selecionado][regiao_selecionada][granularidade_selecionada][indicador][periodo]
+                else:  # YTD ou EOP
+                    valor = dados["meses"][mes_selecionado][regiao_selecionada][granularidade_selecionada][indicador][tipo_periodo][periodo]
+                
+                dados_tabela.append({
+                    "Indicador": indicador,
+                    "Período": periodo,
+                    "Valor": valor
+                })
+        
+        df_tabela = pd.DataFrame(dados_tabela)
+        
+        # Criar gráficos para cada indicador
+        st.subheader(f"Gráficos - {tipo_periodo}")
+        
+        # Organizar gráficos em colunas
+        col1, col2 = st.columns(2)
+        
+        for i, indicador in enumerate(INDICADORES):
+            df_indicador = df_tabela[df_tabela["Indicador"] == indicador]
             
-            dados_tabela.append({
-                "Indicador": indicador,
-                "Período": periodo,
-                "Valor": valor
-            })
-    
-    df_tabela = pd.DataFrame(dados_tabela)
-    
-    # Criar gráficos para cada indicador
-    st.subheader(f"Gráficos - {tipo_periodo}")
-    
-    # Organizar gráficos em colunas
-    col1, col2 = st.columns(2)
-    
-    for i, indicador in enumerate(INDICADORES):
-        df_indicador = df_tabela[df_tabela["Indicador"] == indicador]
-        
-        fig = px.bar(
-            df_indicador, 
-            x="Período", 
-            y="Valor", 
-            title=f"{indicador}",
-            color="Período"
-        )
+            with medir_tempo("grafico_mensal"):
+                fig = px.bar(
+                    df_indicador, 
+                    x="Período", 
+                    y="Valor", 
+                    title=f"{indicador}",
+                    color="Período"
+                )
+            
+            if i % 2 == 0:
+                with col1:
+                    st.plotly_chart(fig, use_container_width=True)
+            else:
+                with col2:
+                    st.plotly_chart(fig, use_container_width=True)
         
-        if i % 2 == 0:
-            with col1:
-                st.plotly_chart(fig, use_container_width=True)
-        else:
-            with col2:
-                st.plotly_chart(fig, use_container_width=True)
-    
-    # Tabela de dados
-    st.subheader("Dados Detalhados")
-    
-    df_tabela = pd.DataFrame(dados_tabela)
-    st.dataframe(df_tabela, use_container_width=True)
+        # Tabela de dados
+        st.subheader("Dados Detalhados")
+        
+        df_tabela = pd.DataFrame(dados_tabela)
+        st.dataframe(df_tabela, use_container_width=True)
+        
+        # Variações de cada indicador (Real vs Budget e Real vs LY)
+        st.subheader("Variações")
+        
+        dados_variacoes = []
+        for indicador in INDICADORES:
+            dados_indicador = dados["meses"][mes_selecionado][regiao_selecionada][granularidade_selecionada][indicador]
+            if tipo_periodo != "Mensal":
+                dados_indicador = dados_indicador[tipo_periodo]
+            dados_variacoes.append({"Indicador": indicador, **{p: dados_indicador.get(p) for p in variacoes.PERIODOS_VARIACAO}})
+        
+        # Células sem variação ficam vazias (e não a 0)
+        st.dataframe(pd.DataFrame(dados_variacoes).style.format(na_rep="—", precision=2), use_container_width=True)
 
-elif pagina == "Introdução de Dados":
-    st.header("Introdução de Dados para Simulação")
-    
-    # Verificar se a região selecionada é Ibérica
-    if regiao_selecionada == "Ibérica":
-        st.warning("A região Ibérica é calculada automaticamente como soma das regiões PT, ES Mainland e ES Canárias. Não é possível introduzir dados diretamente para esta região.")
-    else:
+    elif pagina == "Tendências":
+        st.header("Tendências")
+        
         # Filtros
+        semanas_disponiveis = estrutura.opcoes_periodo(dados["semanas"], estrutura.semanas_do_ano())
         col1, col2 = st.columns(2)
         with col1:
-            semana_selecionada = st.selectbox("Selecione a Semana:", list(dados["semanas"].keys()))
+            semana_inicio, semana_fim = st.select_slider(
+                "Intervalo de semanas:", semanas_disponiveis, value=(semanas_disponiveis[0], semanas_disponiveis[-1])
+            )
+        with col2:
+            regioes_tendencia = st.multiselect("Regiões:", REGIOES_COM_IBERICA, default=[regiao_selecionada])
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            granularidade_tendencia = st.selectbox("Granularidade:", GRANULARIDADES_COM_TOTAL, index=GRANULARIDADES_COM_TOTAL.index("Total"))
+        with col2:
+            indicador_tendencia = st.selectbox("Indicador:", INDICADORES_SEMANAIS)
+        with col3:
+            periodos_tendencia = st.multiselect("Períodos:", PERIODOS_ANALISE, default=["Budget", "Real + Projeção"])
+        
+        if regioes_tendencia and periodos_tendencia:
+            # Uma consulta por intervalo (agregada por mês em intervalos longos); a Rotação (incluindo
+            # as janelas móveis) não está guardada e vem dos dados já carregados, tal como tudo num cenário
+            # ou numa data passada
+            with medir_tempo("ler_tendencia"):
+                argumentos = (semana_inicio, semana_fim, regioes_tendencia, granularidade_tendencia, indicador_tendencia, periodos_tendencia)
+                if indicador_tendencia in INDICADORES_CALCULADOS_CARREGADOS or dados_do_cubo:
+                    df_tendencia = tendencias.tendencia_cubo(dados, *argumentos)
+                else:
+                    df_tendencia = tendencias.ler_tendencia(*argumentos, db_path=DB_PATH, conn=instantaneo.conn)
             
-            # Calcular e mostrar dias acumulados
-            dias_acumulados = calcular_dias_acumulados(semana_selecionada)
-            st.info(f"Dias acumulados desde o início do ano: {dias_acumulados} dias")
+            if df_tendencia.empty:
+                st.info("Sem dados para o intervalo selecionado.")
+            else:
+                mensal = "-W" not in df_tendencia["chave"].iloc[0]
+                if mensal:
+                    st.caption(f"Intervalo com mais de {tendencias.MAX_PONTOS} semanas: valores agregados por mês.")
+                
+                # Scatter em WebGL, para séries longas com várias regiões e períodos
+                with medir_tempo("grafico_tendencia"):
+                    fig = px.line(
+                        df_tendencia,
+                        x="chave",
+                        y="valor",
+                        color="regiao",
+                        line_dash="periodo",
+                        render_mode="webgl",
+                        labels={"chave": "Mês" if mensal else "Semana", "valor": "Valor", "regiao": "Região", "periodo": "Período"},
+                        title=f"{indicador_tendencia} - {granularidade_tendencia} ({semana_inicio} a {semana_fim})"
+                    )
+                
+                st.plotly_chart(fig, use_container_width=True)
+        else:
+            st.warning("Selecione pelo menos uma região e um período.")
+
+    elif pagina == "Mapa de Calor":
+        st.header("Mapa de Calor")
+        
+        # Filtros
+        tipo_matriz = st.radio("Matriz:", ["Região × Granularidade", "Semana × Região"], horizontal=True)
+        semanas_disponiveis = estrutura.opcoes_periodo(dados["semanas"], estrutura.semanas_do_ano())
         
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            indicador_matriz = st.selectbox("Indicador:", INDICADORES_SEMANAIS)
         with col2:
-            granularidade_selecionada = st.selectbox("Selecione a Granularidade:", GRANULARIDADES)
-            st.info("O Total é calculado automaticamente como soma das outras granularidades.")
+            periodo_matriz = st.selectbox("Período:", PERIODOS_ANALISE)
+        with col3:
+            if tipo_matriz == "Região × Granularidade":
+                semana_matriz = st.selectbox("Semana:", semanas_disponiveis)
+            else:
+                granularidade_matriz = st.selectbox("Granularidade:", GRANULARIDADES_COM_TOTAL, index=GRANULARIDADES_COM_TOTAL.index("Total"))
+        
+        # A matriz completa vem de uma consulta (em cache até à próxima escrita); a Rotação (incluindo
+        # as janelas móveis) não está guardada e vem dos dados já carregados, tal como tudo num cenário
+        # ou numa data passada
+        with medir_tempo("matriz_mapa_calor"):
+            if tipo_matriz == "Região × Granularidade":
+                titulo = f"{indicador_matriz} - {periodo_matriz} - {semana_matriz}"
+                if indicador_matriz in INDICADORES_CALCULADOS_CARREGADOS or dados_do_cubo:
+                    matriz = matrizes.matriz_regiao_granularidade_cubo(dados, semana_matriz, indicador_matriz, periodo_matriz)
+                else:
+                    matriz = matriz_regiao_granularidade_bd(instantaneo.id, instantaneo.conn, semana_matriz, indicador_matriz, periodo_matriz)
+            else:
+                semana_inicio, semana_fim = st.select_slider(
+                    "Intervalo de semanas:", semanas_disponiveis, value=(semanas_disponiveis[0], semanas_disponiveis[-1])
+                )
+                titulo = f"{indicador_matriz} - {periodo_matriz} - {granularidade_matriz} ({semana_inicio} a {semana_fim})"
+                if indicador_matriz in INDICADORES_CALCULADOS_CARREGADOS or dados_do_cubo:
+                    matriz = matrizes.matriz_semana_regiao(tendencias.tendencia_cubo(
+                        dados, semana_inicio, semana_fim, REGIOES_COM_IBERICA, granularidade_matriz, indicador_matriz, [periodo_matriz]
+                    ))
+                else:
+                    matriz = matriz_semana_regiao_bd(
+                        instantaneo.id, instantaneo.conn, semana_inicio, semana_fim, granularidade_matriz, indicador_matriz, periodo_matriz
+                    )
         
-        # Formulário para introdução de dados
-        with st.form("formulario_dados"):
-            st.subheader(f"Introduzir Dados para {semana_selecionada} - {regiao_selecionada} - {granularidade_selecionada}")
+        if matriz.empty:
+            st.info("Sem dados para a seleção.")
+        else:
+            fig = px.imshow(
+                matriz.T if tipo_matriz == "Semana × Região" else matriz,
+                text_auto=".2f" if matriz.size <= 100 else False,
+                aspect="auto",
+                color_continuous_scale="Blues",
+                title=titulo
+            )
+            st.plotly_chart(fig, use_container_width=True)
             
-            # Criar campos para cada indicador (exceto COGS e Rotação que são calculados)
-            valores = {}
-            for indicador in INDICADORES:
-                if indicador not in ["COGS", "Rotação"]:
-                    valores[indicador] = {}
-                    st.subheader(indicador)
-                    
-                    for periodo in PERIODOS_ANALISE:
-                        valor_atual = dados["semanas"][semana_selecionada][regiao_selecionada][granularidade_selecionada][indicador][periodo]
-                        valores[indicador][periodo] = st.number_input(
-                            f"{periodo}", 
-                            value=float(valor_atual),
-                            format="%.2f",
-                            key=f"{indicador}_{periodo}"
+            st.subheader("Dados Detalhados")
+            st.dataframe(matriz, use_container_width=True)
+
+    elif instante_reconstrucao and pagina in ["Comparação de Cenários", "Introdução de Dados", "Importação de Dados"]:
+        st.header(pagina)
+        st.info("Esta página usa os dados atuais: desative \"Ver os dados numa data passada\" na barra lateral.")
+
+    elif pagina == "Comparação de Cenários":
+        st.header(f"Comparação de Cenários - {regiao_selecionada}")
+        
+        lista_cenarios = cenarios.listar_cenarios(DB_PATH, conn=instantaneo.conn)
+        if not lista_cenarios:
+            st.info("Ainda não existem cenários guardados. Crie um na página Introdução de Dados.")
+        else:
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                nomes_comparados = st.multiselect("Cenários:", [cenario["nome"] for cenario in lista_cenarios], default=[cenario["nome"] for cenario in lista_cenarios])
+            with col2:
+                granularidade_comparacao = st.selectbox("Granularidade:", GRANULARIDADES_COM_TOTAL, index=GRANULARIDADES_COM_TOTAL.index("Total"))
+            with col3:
+                indicador_comparacao = st.selectbox("Indicador:", cenarios.INDICADORES_COMPARACAO, index=cenarios.INDICADORES_COMPARACAO.index("Rotação"))
+            
+            # Budget, Real + Projeção, Introduzido e todos os cenários numa única passagem vetorizada
+            versao_cenarios = tuple(
+                (cenario["nome"], cenario["celulas"], cenario["data_atualizacao"])
+                for cenario in lista_cenarios if cenario["nome"] in nomes_comparados
+            )
+            with medir_tempo("comparar_cenarios"):
+                comparacao = comparar_cenarios_bd(instantaneo.id, instantaneo.conn, versao_cenarios, tuple(nomes_comparados))
+            comparacao = comparacao[(comparacao["regiao"] == regiao_selecionada) & (comparacao["granularidade"] == granularidade_comparacao)]
+            
+            semanas_comparacao = sorted(comparacao["semana"].unique())
+            if not semanas_comparacao:
+                st.info("Sem dados para comparar.")
+            else:
+                semana_inicio, semana_fim = st.select_slider(
+                    "Intervalo de semanas:", semanas_comparacao, value=(semanas_comparacao[0], semanas_comparacao[-1])
+                )
+                comparacao = comparacao[(comparacao["semana"] >= semana_inicio) & (comparacao["semana"] <= semana_fim)]
+                
+                fig = px.line(
+                    comparacao,
+                    x="semana",
+                    y=indicador_comparacao,
+                    color="versao",
+                    render_mode="webgl",
+                    labels={"semana": "Semana", "versao": "Versão"},
+                    title=f"{indicador_comparacao} - {regiao_selecionada} - {granularidade_comparacao} ({semana_inicio} a {semana_fim})"
+                )
+                st.plotly_chart(fig, use_container_width=True)
+                
+                # Resumo na última semana do intervalo, face ao Budget e ao Real + Projeção
+                st.subheader(f"Resumo em {semana_fim}")
+                resumo = comparacao[comparacao["semana"] == semana_fim].set_index("versao")[cenarios.INDICADORES_COMPARACAO]
+                for referencia in ["Budget", "Real + Projeção"]:
+                    resumo[f"Rotação vs {referencia}"] = resumo["Rotação"] - resumo.loc[referencia, "Rotação"]
+                    resumo[f"Stock vs {referencia}"] = resumo["Stock Liquido"] - resumo.loc[referencia, "Stock Liquido"]
+                st.dataframe(resumo, use_container_width=True)
+                
+                st.subheader("Dados Detalhados")
+                st.dataframe(
+                    comparacao.pivot_table(index="semana", columns="versao", values=indicador_comparacao, sort=False),
+                    use_container_width=True
+                )
+
+    elif pagina == "Introdução de Dados":
+        st.header("Introdução de Dados para Simulação")
+        
+        # Projeção do Real + Projeção nas semanas sem valores reais (também: python projecao.py)
+        with st.expander("Projeção das semanas restantes"):
+            st.caption(
+                "Preenche o Real + Projeção das semanas seguintes à última semana com valores reais, até ao fim do ano. "
+                "Os valores projetados nunca substituem valores introduzidos ou importados, e são substituídos por eles."
+            )
+            metodo_projecao = st.selectbox(
+                "Método:", list(projecao.METODOS_PROJECAO), format_func=projecao.METODOS_PROJECAO.get,
+                index=list(projecao.METODOS_PROJECAO).index(projecao.METODO_PADRAO)
+            )
+            reajustar_projecao = st.checkbox("Reajustar todas as séries (mesmo sem novos valores reais)")
+            if st.button("Atualizar projeção"):
+                try:
+                    resultado = projecao.projetar(metodo_projecao, forcar=reajustar_projecao, db_path=DB_PATH)
+                    if resultado["ajustadas"]:
+                        st.success(
+                            f"{resultado['ajustadas']} de {resultado['series']} séries projetadas (lote {resultado['lote_id']}): "
+                            f"{resultado['inseridas']} novos valores, {resultado['alteradas']} alterados."
                         )
+                    else:
+                        st.info("Nenhuma série tem novos valores reais desde a última projeção.")
+                except Exception as e:
+                    st.error(f"Erro ao calcular a projeção: {str(e)}")
+        
+        # Cenários de simulação: os valores gravados num cenário não alteram os dados reais
+        with st.expander("Cenários de simulação"):
+            novo_cenario = st.text_input("Nome do novo cenário:").strip()
+            if st.button("Criar cenário") and novo_cenario:
+                st.session_state.setdefault("cenarios_novos", []).append(novo_cenario)
+                st.session_state["cenario_pedido"] = novo_cenario
+                st.rerun()
+            if cenario_ativo and st.button(f"Apagar cenário '{cenario_ativo}'"):
+                cenarios.apagar_cenario(cenario_ativo, DB_PATH)
+                st.session_state["cenarios_novos"] = [c for c in st.session_state.get("cenarios_novos", []) if c != cenario_ativo]
+                st.session_state["cenario_pedido"] = None
+                st.rerun()
+        
+        if cenario_ativo:
+            st.info(f"Cenário ativo: {cenario_ativo}. Os valores gravados ficam no cenário e não alteram os dados reais.")
+        
+        # Verificar se a região selecionada é Ibérica
+        if regiao_selecionada == "Ibérica":
+            st.warning("A região Ibérica é calculada automaticamente como soma das regiões PT, ES Mainland e ES Canárias. Não é possível introduzir dados diretamente para esta região.")
+        else:
+            # Filtros
+            col1, col2 = st.columns(2)
+            with col1:
+                semana_selecionada = st.selectbox("Selecione a Semana:", estrutura.opcoes_periodo(dados["semanas"], estrutura.semanas_do_ano()))
+                
+                # Calcular e mostrar dias acumulados
+                dias_acumulados = calcular_dias_acumulados(semana_selecionada)
+                st.info(f"Dias acumulados desde o início do ano: {dias_acumulados} dias")
             
-            # Botão para salvar
-            submitted = st.form_submit_button("Salvar Dados")
+            with col2:
+                granularidade_selecionada = st.selectbox("Selecione a Granularidade:", GRANULARIDADES)
+                st.info("O Total é calculado automaticamente como soma das outras granularidades.")
             
-            if submitted:
-                # Salvar os dados introduzidos
-                for indicador in valores:
-                    for periodo in valores[indicador]:
-                        valor = valores[indicador][periodo]
+            # Células editáveis do formulário e respetivas versões atuais
+            celulas_formulario = [
+                (semana_selecionada, regiao_selecionada, granularidade_selecionada, indicador, periodo)
+                for indicador in INDICADORES if indicador not in ["COGS", "Rotação"]
+                for periodo in PERIODOS_ANALISE
+            ]
+            versoes_atuais = ler_versoes_bd(instantaneo.conn, celulas_formulario)
+            
+            # O formulário submetido foi preenchido com as versões lidas na execução anterior
+            versoes_lidas = st.session_state.get("versoes_formulario", {})
+            
+            # Formulário para introdução de dados
+            with st.form("formulario_dados"):
+                st.subheader(f"Introduzir Dados para {semana_selecionada} - {regiao_selecionada} - {granularidade_selecionada}")
+                
+                # Criar campos para cada indicador (exceto COGS e Rotação que são calculados)
+                valores = {}
+                for indicador in INDICADORES:
+                    if indicador not in ["COGS", "Rotação"]:
+                        valores[indicador] = {}
+                        st.subheader(indicador)
                         
-                        # Salvar no banco de dados
-                        sucesso = salvar_dados_bd(
-                            dados,
-                            semana=semana_selecionada,
-                            regiao=regiao_selecionada,
-                            granularidade=granularidade_selecionada,
-                            indicador=indicador,
-                            periodo=periodo,
-                            valor=valor
+                        for periodo in PERIODOS_ANALISE:
+                            valor_atual = dados["semanas"][semana_selecionada][regiao_selecionada][granularidade_selecionada][indicador][periodo]
+                            valores[indicador][periodo] = st.number_input(
+                                f"{periodo}", 
+                                value=float(valor_atual),
+                                format="%.2f",
+                                key=f"{indicador}_{periodo}"
+                            )
+                
+                # Botão para salvar
+                submitted = st.form_submit_button("Salvar Dados")
+                
+                if submitted:
+                    # Gravar apenas as células alteradas, numa única transação, com verificação de versão
+                    alteracoes = []
+                    for celula in celulas_formulario:
+                        semana, regiao, granularidade, indicador, periodo = celula
+                        valor = valores[indicador][periodo]
+                        if cenario_ativo:
+                            # Num cenário, compara-se com o valor mostrado (dados reais com o cenário aplicado)
+                            if valor != dados["semanas"][semana][regiao][granularidade][indicador][periodo]:
+                                alteracoes.append((*celula, valor, None))
+                            continue
+                        valor_lido, versao_lida = versoes_lidas.get(celula, versoes_atuais[celula])
+                        if valor != (valor_lido or 0.0):
+                            alteracoes.append((*celula, valor, versao_lida))
+                    
+                    try:
+                        if cenario_ativo:
+                            if alteracoes:
+                                cenarios.gravar_cenario(cenario_ativo, [celula[:-1] for celula in alteracoes], db_path=DB_PATH)
+                            novas_versoes = {}
+                        else:
+                            novas_versoes = salvar_dados_bd(alteracoes) if alteracoes else {}
+                    except escrita.ConflitoEdicao as e:
+                        novas_versoes = None
+                        st.error(
+                            f"Não foi possível gravar: {len(e.conflitos)} valor(es) foram alterados por outro utilizador "
+                            "desde que o formulário foi aberto. Nada foi gravado; reveja os valores atuais e volte a gravar."
                         )
+                        st.dataframe(pd.DataFrame([
+                            {
+                                "Indicador": conflito["celula"][3],
+                                "Período": conflito["celula"][4],
+                                "Valor atual": conflito["valor_atual"],
+                                "O seu valor": conflito["valor_novo"],
+                                "Alterado em": conflito["versao_atual"],
+                            }
+                            for conflito in e.conflitos
+                        ]), use_container_width=True)
+                    
+                    if novas_versoes is not None:
+                        versoes_atuais.update(novas_versoes)
+                        # Atualizar dados em memória (também os agregados Ibérica e Total), recalculando COGS,
+                        # Rotação, janelas móveis e variações das séries afetadas
+                        dados = cenarios.aplicar_cenario(dados, [celula[:-1] for celula in alteracoes])
                         
-                        if sucesso:
-                            # Atualizar dados em memória
-                            dados["semanas"][semana_selecionada][regiao_selecionada][granularidade_selecionada][indicador][periodo] = valor
-                
-                # Recalcular COGS e Rotação
-                dados = atualizar_cogs(dados)
-                dados = atualizar_rotacao(dados)
+                        if not alteracoes:
+                            st.success("Nenhum valor foi alterado.")
+                        else:
+                            st.success(f"Dados salvos no cenário {cenario_ativo}!" if cenario_ativo else "Dados salvos com sucesso!")
+                        
+                        # Mostrar valores calculados
+                        st.subheader("Valores Calculados")
+                        
+                        col1, col2 = st.columns(2)
+                        
+                        with col1:
+                            st.subheader("COGS")
+                            for periodo in PERIODOS_ANALISE:
+                                valor = dados["semanas"][semana_selecionada][regiao_selecionada][granularidade_selecionada]["COGS"][periodo]
+                                st.metric(f"{periodo}", f"{valor:.2f}")
+                        
+                        with col2:
+                            st.subheader("Rotação")
+                            for periodo in PERIODOS_ANALISE:
+                                valor = dados["semanas"][semana_selecionada][regiao_selecionada][granularidade_selecionada]["Rotação"][periodo]
+                                st.metric(f"{periodo}", f"{valor:.2f}")
+            
+            # Versões que o utilizador vê agora; são as usadas para verificar a próxima gravação
+            st.session_state["versoes_formulario"] = versoes_atuais
+            
+            # Meta de rotação: stock e vendas necessários, obtidos invertendo a fórmula da rotação
+            # para todas as séries e semanas de uma vez
+            with st.expander("Meta de rotação"):
+                col1, col2 = st.columns(2)
+                with col1:
+                    periodo_ajustado = st.selectbox("Período a ajustar:", PERIODOS_ANALISE, index=PERIODOS_ANALISE.index("Introduzido"))
+                with col2:
+                    origem_meta = st.radio("Meta:", [f"Rotação do {metas.PERIODO_META}", "Valor fixo"], horizontal=True)
+                    meta_fixa = st.number_input("Rotação pretendida (dias):", value=30.0, format="%.2f") if origem_meta == "Valor fixo" else None
                 
-                st.success("Dados salvos com sucesso!")
+                with medir_tempo("resolver_metas"):
+                    solucoes = metas.resolver_metas(dados, periodo_ajustado, meta=meta_fixa)
+                solucoes_semana = solucoes[solucoes["semana"] == semana_selecionada].set_index(["regiao", "granularidade"]).drop(columns="semana")
                 
-                # Mostrar valores calculados
-                st.subheader("Valores Calculados")
+                if (regiao_selecionada, granularidade_selecionada) in solucoes_semana.index:
+                    solucao = solucoes_semana.loc[(regiao_selecionada, granularidade_selecionada)]
+                    formatar = lambda valor: "—" if pd.isna(valor) else f"{valor:,.2f}"
+                    col1, col2, col3, col4 = st.columns(4)
+                    col1.metric("Rotação atual", formatar(solucao["Rotação"]))
+                    col2.metric("Meta", formatar(solucao["Meta"]))
+                    col3.metric(
+                        "Stock Liquido necessário", formatar(solucao["Stock Liquido necessário"]),
+                        formatar(solucao["Stock Liquido necessário"] - solucao["Stock Liquido"])
+                    )
+                    col4.metric(
+                        "Vendas necessárias", formatar(solucao["Vendas necessárias"]),
+                        formatar(solucao["Vendas necessárias"] - solucao["Vendas"])
+                    )
                 
-                col1, col2 = st.columns(2)
+                st.caption(
+                    f"Stock necessário mantendo o COGS; Vendas necessárias mantendo o stock, o MFO, a Quebra e as outras semanas. "
+                    f"Todas as séries em {semana_selecionada}:"
+                )
+                st.dataframe(solucoes_semana, use_container_width=True)
+
+    elif pagina == "Importação de Dados":
+        st.header("Importação Massiva de Dados")
+        
+        formato_ficheiro = st.radio(
+            "Formato do ficheiro:",
+            ["Longo (uma linha por valor)", "Largo (semanas ou indicadores em colunas)"],
+            horizontal=True
+        )
+        
+        if formato_ficheiro.startswith("Longo"):
+            st.info("""
+            Utilize esta página para importar dados em massa. 
+        
+            O arquivo CSV deve ter o seguinte formato:
+            - Semana (formato: YYYY-WXX)
+            - Região (PT, ES Mainland, ES Canárias)
+            - Granularidade (Core, New Business, Services + Others, B2B)
+            - Indicador (Stock Liquido, Stock Provision, Stock in Transit, Stock Bruto, Vendas, MFO, Quebra)
+            - Período (Budget, Last Year, Real + Projeção, Introduzido)
+            - Valor (número decimal)
+        
+            Exemplo:
+            ```
+            Semana,Região,Granularidade,Indicador,Periodo,Valor
+            2025-W22,PT,Core,Stock Liquido,Introduzido,1000.5
+            2025-W22,PT,Core,Vendas,Introduzido,500.25
+            ```
+        
+            Nota: Os valores de COGS, Rotação, Total e Ibérica serão calculados automaticamente.
+            A importação é registada no histórico como um único lote.
+            """)
+        
+            # Upload de arquivo CSV
+            uploaded_file = st.file_uploader("Escolha um arquivo CSV", type="csv")
+        
+            if uploaded_file is not None:
+                # Ler o conteúdo do arquivo
+                conteudo = uploaded_file.getvalue().decode("utf-8")
+            
+                try:
+                    # Prévia dos primeiros registos
+                    st.subheader("Prévia dos Dados")
+                    df_preview = pd.read_csv(io.StringIO(conteudo), nrows=100)
+                    st.dataframe(df_preview, use_container_width=True)
                 
-                with col1:
-                    st.subheader("COGS")
-                    for periodo in PERIODOS_ANALISE:
-                        valor = dados["semanas"][semana_selecionada][regiao_selecionada][granularidade_selecionada]["COGS"][periodo]
-                        st.metric(f"{periodo}", f"{valor:.2f}")
+                    # Botão para confirmar importação
+                    if st.button("Confirmar Importação"):
+                        linhas_invalidas = []
+                        resultado = escrita.executar_na_fila(
+                            importacao.importar_em_massa,
+                            importacao.ler_csv_importacao(conteudo, linhas_invalidas),
+                            origem="importacao_csv"
+                        )
+                    
+                        st.success(
+                            f"Dados importados com sucesso! Lote {resultado['lote_id']}: "
+                            f"{resultado['inseridas']} novos valores, {resultado['alteradas']} alterados "
+                            f"({resultado['recebidas']} linhas válidas)."
+                        )
+                    
+                        if linhas_invalidas:
+                            st.warning(f"{len(linhas_invalidas)} linhas ignoradas por serem inválidas (ex.: linhas {linhas_invalidas[:10]}).")
+            
+                except Exception as e:
+                    st.error(f"Erro ao processar o arquivo: {str(e)}")
+        
+        else:
+            st.info("""
+            Folhas de planeamento em formato largo (CSV ou Excel), por exemplo:
+            - semanas em colunas: `Região, Granularidade, Indicador, 2025-W22, 2025-W23, ...`
+            - indicadores em colunas: `Semana, Região, Granularidade, Vendas | Budget, Vendas | Introduzido, ...`
+            
+            O intervalo de células (ex.: `B3:N40`) limita a leitura à tabela; a primeira linha do intervalo
+            tem os cabeçalhos. Dimensões que não estão na folha (ex.: o período) são indicadas abaixo.
+            A configuração pode ser guardada e reutilizada em importações seguintes.
+            """)
+            
+            # Configurações guardadas (configuracao_excel) ou uma nova
+            configuracoes = {"Nova configuração": {}}
+            for configuracao in importacao.ler_configuracoes_excel():
+                nome = configuracao["nome_arquivo"] or configuracao["caminho_arquivo"] or "sem nome"
+                configuracoes[f"{configuracao['id']} - {nome} ({configuracao['planilha'] or 'primeira folha'})"] = configuracao
+            
+            configuracao = configuracoes[st.selectbox("Configuração:", list(configuracoes))]
+            mapeamento = importacao.ler_mapeamento(configuracao.get("mapeamento_colunas"))
+            sem_constante = "(na folha)"
+            
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                formato_largo = st.selectbox(
+                    "Colunas de valores:", importacao.FORMATOS_LARGOS,
+                    index=importacao.FORMATOS_LARGOS.index(mapeamento["formato"]),
+                    format_func=lambda f: "Semanas" if f == "semanas_em_colunas" else "Indicadores (e períodos)"
+                )
+            with col2:
+                planilha = st.text_input("Folha (Excel):", value=configuracao.get("planilha") or "")
+            with col3:
+                intervalo = st.text_input("Intervalo de células:", value=configuracao.get("intervalo_celulas") or "")
+            
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                opcoes_periodo = [sem_constante] + PERIODOS_ANALISE
+                periodo_constante = st.selectbox(
+                    "Período:", opcoes_periodo,
+                    index=opcoes_periodo.index(mapeamento["constantes"].get("periodo", sem_constante))
+                )
+            with col2:
+                opcoes_regiao = [sem_constante] + REGIOES
+                regiao_constante = st.selectbox(
+                    "Região:", opcoes_regiao,
+                    index=opcoes_regiao.index(mapeamento["constantes"].get("regiao", sem_constante))
+                )
+            with col3:
+                separador = st.text_input("Separador indicador/período:", value=mapeamento["separador"])
+            
+            constantes = {
+                dimensao: valor for dimensao, valor in mapeamento["constantes"].items()
+                if dimensao not in ("periodo", "regiao")
+            }
+            if periodo_constante != sem_constante:
+                constantes["periodo"] = periodo_constante
+            if regiao_constante != sem_constante:
+                constantes["regiao"] = regiao_constante
+            mapeamento = {
+                "formato": formato_largo,
+                "colunas": mapeamento["colunas"],
+                "constantes": constantes,
+                "separador": separador or importacao.SEPARADOR_PADRAO,
+            }
+            
+            # Livro local sincronizado periodicamente (python sincronizacao.py) ou a pedido
+            caminho_arquivo = st.text_input("Caminho do livro local (sincronização):", value=configuracao.get("caminho_arquivo") or "")
+            if configuracao.get("caminho_arquivo") and st.button("Sincronizar agora"):
+                try:
+                    resultado = sincronizacao.sincronizar_configuracao(configuracao)
+                    if resultado["estado"] == "inalterado":
+                        st.info("O livro não foi alterado desde a última sincronização.")
+                    else:
+                        st.success(
+                            f"Livro sincronizado! Lote {resultado['lote_id']}: "
+                            f"{resultado['inseridas']} novos valores, {resultado['alteradas']} alterados."
+                        )
+                except Exception as e:
+                    st.error(f"Erro ao sincronizar o livro: {str(e)}")
+            
+            uploaded_file = st.file_uploader("Escolha um arquivo CSV ou Excel", type=["csv", "xlsx"], key="ficheiro_largo")
+            
+            if uploaded_file is not None:
+                try:
+                    grelha = importacao.ler_grelha(uploaded_file.getvalue(), uploaded_file.name, planilha or None, intervalo or None)
+                    longo, nao_numericos = importacao.derreter_formato_largo(grelha, mapeamento)
+                    validas, invalidas = importacao.filtrar_linhas_validas(longo)
+                    
+                    st.subheader("Prévia dos Dados")
+                    st.caption(f"{len(grelha)} linhas na folha → {len(longo)} valores, dos quais {len(validas)} válidos.")
+                    st.dataframe(validas.head(100), use_container_width=True)
+                    
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        if st.button("Guardar configuração"):
+                            configuracao_id = importacao.guardar_configuracao_excel(
+                                configuracao.get("id"),
+                                nome_arquivo=uploaded_file.name,
+                                caminho_arquivo=caminho_arquivo or None,
+                                planilha=planilha or None,
+                                intervalo_celulas=intervalo or None,
+                                mapeamento_colunas=mapeamento
+                            )
+                            st.success(f"Configuração {configuracao_id} guardada.")
+                    
+                    with col2:
+                        confirmar = st.button("Confirmar Importação", key="confirmar_largo")
+                    
+                    if confirmar:
+                        resultado = escrita.executar_na_fila(
+                            importacao.importar_em_massa,
+                            validas.itertuples(index=False, name=None),
+                            origem="importacao_larga"
+                        )
+                        
+                        st.success(
+                            f"Dados importados com sucesso! Lote {resultado['lote_id']}: "
+                            f"{resultado['inseridas']} novos valores, {resultado['alteradas']} alterados "
+                            f"({resultado['recebidas']} linhas válidas)."
+                        )
+                    
+                    if invalidas or nao_numericos:
+                        st.warning(
+                            f"{invalidas} valores ignorados por não corresponderem a células editáveis e "
+                            f"{nao_numericos} por não serem numéricos."
+                        )
                 
-                with col2:
-                    st.subheader("Rotação")
-                    for periodo in PERIODOS_ANALISE:
-                        valor = dados["semanas"][semana_selecionada][regiao_selecionada][granularidade_selecionada]["Rotação"][periodo]
-                        st.metric(f"{periodo}", f"{valor:.2f}")
+                except Exception as e:
+                    st.error(f"Erro ao processar o arquivo: {str(e)}")
 
-elif pagina == "Histórico de Alterações":
-    st.header("Histórico de Alterações")
-    
-    # Filtros
-    col1, col2 = st.columns(2)
-    with col1:
-        limite = st.slider("Número de registros a exibir:", 10, 500, 100)
+    elif pagina == "Exportação de Dados":
+        st.header("Exportação de Dados")
+        
+        # Recorte a exportar (filtros vazios incluem todos os valores)
+        col1, col2 = st.columns(2)
+        with col1:
+            tipo_exportacao = st.radio("Dados:", ["semanas", "meses"], format_func=lambda t: "Semanais" if t == "semanas" else "Mensais", horizontal=True)
+        with col2:
+            formato_exportacao = st.radio("Formato:", exportacao.formatos_disponiveis(), format_func=str.upper, horizontal=True)
+        
+        anos_disponiveis = sorted({chave[:4] for chave in dados[tipo_exportacao]})
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            regioes_exportacao = st.multiselect("Regiões:", REGIOES_COM_IBERICA)
+            anos_exportacao = st.multiselect("Anos:", anos_disponiveis)
+        with col2:
+            granularidades_exportacao = st.multiselect("Granularidades:", GRANULARIDADES_COM_TOTAL)
+            periodos_exportacao = st.multiselect("Períodos:", PERIODOS_ANALISE + variacoes.PERIODOS_VARIACAO)
+        with col3:
+            indicadores_exportacao = st.multiselect("Indicadores:", INDICADORES_SEMANAIS if tipo_exportacao == "semanas" else INDICADORES)
+        
+        filtros_exportacao = {
+            "regioes": regioes_exportacao or None,
+            "granularidades": granularidades_exportacao or None,
+            "indicadores": indicadores_exportacao or None,
+            "periodos": periodos_exportacao or None,
+            "anos": anos_exportacao or None,
+        }
+        
+        # O ficheiro só é gerado quando o botão é clicado (numa thread à parte), lendo a base de dados
+        # em lotes para um ficheiro temporário; os indicadores calculados (e, num cenário ou numa data
+        # passada, todos os valores) vêm dos dados já carregados. A leitura usa um instantâneo próprio
+        # (a ligação desta execução já estará fechada): se os dados mudaram entretanto, exporta-se o
+        # que está na página.
+        id_instantaneo_pagina = instantaneo.id
+        
+        def gerar_exportacao():
+            with leitura.Instantaneo(DB_PATH) as instantaneo_exportacao:
+                if dados_do_cubo or instantaneo_exportacao.id != id_instantaneo_pagina:
+                    linhas = exportacao.linhas_cubo(dados, tipo_exportacao, **filtros_exportacao)
+                else:
+                    linhas = exportacao.linhas_recorte(
+                        dados, tipo_exportacao, db_path=DB_PATH, conn=instantaneo_exportacao.conn, **filtros_exportacao
+                    )
+                return exportacao.exportar(linhas, tipo_exportacao, formato_exportacao)
+        
+        st.download_button(
+            label=f"Exportar {formato_exportacao.upper()}",
+            data=gerar_exportacao,
+            file_name=f"stock_{tipo_exportacao}.{formato_exportacao}",
+            mime=exportacao.FORMATOS[formato_exportacao]
+        )
+        
+        if len(exportacao.formatos_disponiveis()) < len(exportacao.FORMATOS):
+            st.caption("Parquet requer o pyarrow e Excel o xlsxwriter.")
+
+    elif pagina == "Histórico de Alterações":
+        st.header("Histórico de Alterações")
+        
+        # Filtros
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            filtro_semana = st.selectbox("Semana/Mês:", ["Todas"] + estrutura.opcoes_periodo(dados["semanas"], estrutura.semanas_do_ano()) + estrutura.opcoes_periodo(dados["meses"], estrutura.meses_do_ano()))
+        with col2:
+            filtro_regiao = st.selectbox("Região:", ["Todas"] + REGIOES)
+        with col3:
+            filtro_indicador = st.selectbox("Indicador:", ["Todos"] + INDICADORES)
+        with col4:
+            filtro_usuario = st.text_input("Utilizador:")
+        
+        limite = st.slider("Número de registros por página:", 10, 500, 100)
+        
+        filtros = {
+            "semana": None if filtro_semana == "Todas" else filtro_semana,
+            "regiao": None if filtro_regiao == "Todas" else filtro_regiao,
+            "indicador": None if filtro_indicador == "Todos" else filtro_indicador,
+            "usuario": filtro_usuario.strip() or None,
+        }
+        
+        # Pilha de cursores das páginas visitadas; reiniciada quando os filtros mudam
+        chave_filtros = (tuple(filtros.values()), limite)
+        if st.session_state.get("historico_filtros") != chave_filtros:
+            st.session_state["historico_filtros"] = chave_filtros
+            st.session_state["historico_cursores"] = [None]
+        
+        cursores = st.session_state["historico_cursores"]
+        
+        # Obter histórico
+        historico, proximo_cursor = obter_historico_alteracoes(instantaneo.conn, limite, cursores[-1], **filtros)
+        
+        if len(historico) > 0:
+            # Exibir histórico
+            st.caption(f"Página {len(cursores)}")
+            st.dataframe(historico, use_container_width=True)
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                if len(cursores) > 1 and st.button("← Página anterior"):
+                    cursores.pop()
+                    st.rerun()
+            with col2:
+                if proximo_cursor is not None and st.button("Página seguinte →"):
+                    cursores.append(proximo_cursor)
+                    st.rerun()
+        else:
+            st.info("Nenhuma alteração registrada ainda.")
+
+    elif pagina == "Diagnósticos":
+        st.header("Diagnósticos de Desempenho")
+        
+        # Estatísticas por etapa (p50/p95 e número de chamadas)
+        st.subheader("Tempos por Etapa")
+        estatisticas = diagnosticos.estatisticas_por_etapa()
+        
+        if estatisticas:
+            st.dataframe(pd.DataFrame(estatisticas), use_container_width=True)
+        else:
+            st.info("Ainda não existem medições registadas.")
+        
+        # Últimas execuções do script
+        st.subheader("Últimas Execuções")
+        num_execucoes = st.slider("Número de execuções a exibir:", 1, diagnosticos.CAPACIDADE_EXECUCOES, 10)
+        execucoes = diagnosticos.ultimas_execucoes(num_execucoes)
+        
+        if execucoes:
+            df_execucoes = pd.DataFrame([
+                {"Execução": e["id"], "Página": e["pagina"], "Início": e["inicio"], "Total (ms)": e["total_ms"], **e["etapas"]}
+                for e in execucoes
+            ])
+            st.dataframe(df_execucoes, use_container_width=True)
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button(
+                label="Exportar Diagnósticos (JSON)",
+                data=diagnosticos.exportar_json(),
+                file_name=f"diagnosticos_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+                mime="application/json"
+            )
+        with col2:
+            if st.button("Limpar Medições"):
+                diagnosticos.limpar()
+                st.rerun()
+finally:
+    # Fechar medição desta execução (também as que terminam com st.rerun() ou st.stop())
+    diagnosticos.terminar_execucao(globals().get("pagina"))
     
-    # Obter histórico
-    historico = obter_historico_alteracoes(limite)
+    # Terminar a transação de leitura (libera o snapshot para o checkpoint do WAL), também quando
+    # a execução termina antes do fim (st.rerun(), st.stop() ou uma exceção)
+    if instantaneo is not None:
+        instantaneo.fechar()
     
-    if len(historico) > 0:
-        # Exibir histórico
-        st.dataframe(historico, use_container_width=True)
-    else:
-        st.info("Nenhuma alteração registrada ainda.")
+    # Guardar o perfil desta execução, identificado pela página e seleções
+    if estado_perfil is not None:
+        selecoes = {
+            nome: globals().get(nome)
+            for nome in ["regiao_selecionada", "semana_selecionada", "mes_selecionado", "granularidade_selecionada", "indicador_selecionado", "tipo_periodo"]
+        }
+        ficheiros_perfil = perfil.terminar_perfil(estado_perfil, globals().get("pagina"), selecoes)
+        st.sidebar.caption(f"Perfil guardado em: {os.path.basename(ficheiros_perfil[0])}")
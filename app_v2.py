@@ -7,6 +7,14 @@ import json
 import os
 import csv
 import io
+import re
+import estrutura
+import exportacao
+import importacao
+import escrita
+import registos
+import tarefas
+import variacoes
 
 # Configuração da página
 st.set_page_config(
@@ -41,6 +49,24 @@ PERIODOS_ANALISE = [
 
 PERIODOS_ACUMULADOS = ["YTD", "EOP"]
 
+# Níveis da estrutura de dados até ao indicador: período -> região -> granularidade -> indicador
+NIVEIS_ESTRUTURA = 4
+
+# Indicadores a partir dos quais o COGS é calculado
+COMPONENTES_COGS = ["Vendas", "MFO", "Quebra"]
+
+# Calendário por omissão oferecido para seleção (sem alocar dados)
+NUM_SEMANAS_PADRAO = 12
+NUM_MESES_PADRAO = 3
+
+FORMATO_SEMANA = re.compile(r"^\d{4}-W\d{2}$")
+
+# Ficheiro de dados (também é a chave que serializa as tarefas em segundo plano sobre ele)
+ARQUIVO_DADOS = 'dados_stock_v2.json'
+
+# Intervalo (segundos) entre atualizações do progresso de uma importação
+INTERVALO_PROGRESSO = 1.0
+
 # Função para calcular dias acumulados desde o início do ano
 def calcular_dias_acumulados(data_str):
     # Converter string de semana para data
@@ -71,114 +97,24 @@ def calcular_dias_acumulados(data_str):
     return dias_acumulados
 
 # Função para criar estrutura de dados inicial
+# As células só são alocadas quando escritas; as que faltam valem 0.0
 def criar_estrutura_dados():
     # Verificar se já existe um arquivo de dados
-    if os.path.exists('dados_stock_v2.json'):
-        with open('dados_stock_v2.json', 'r') as f:
-            return json.load(f)
+    if os.path.exists(ARQUIVO_DADOS):
+        with open(ARQUIVO_DADOS, 'r') as f:
+            return estrutura.criar_dados_esparsos(NIVEIS_ESTRUTURA, json.load(f))
     
     # Criar estrutura de dados vazia
-    dados = {
-        "semanas": {},
-        "meses": {}
-    }
-    
-    # Obter data atual
-    hoje = datetime.now()
-    
-    # Criar estrutura para as próximas 12 semanas
-    for i in range(12):
-        data_inicio = hoje + timedelta(weeks=i)
-        semana = data_inicio.strftime("%Y-W%W")
-        
-        dados["semanas"][semana] = {}
-        
-        # Para cada região
-        for regiao in REGIOES:
-            dados["semanas"][semana][regiao] = {}
-            
-            # Para cada granularidade
-            for granularidade in GRANULARIDADES:
-                dados["semanas"][semana][regiao][granularidade] = {}
-                
-                # Para cada indicador
-                for indicador in INDICADORES:
-                    dados["semanas"][semana][regiao][granularidade][indicador] = {}
-                    
-                    # Para cada período
-                    for periodo in PERIODOS_ANALISE:
-                        dados["semanas"][semana][regiao][granularidade][indicador][periodo] = 0.0
-            
-            # Adicionar Total para cada região (será calculado automaticamente)
-            dados["semanas"][semana][regiao]["Total"] = {}
-            for indicador in INDICADORES:
-                dados["semanas"][semana][regiao]["Total"][indicador] = {}
-                for periodo in PERIODOS_ANALISE:
-                    dados["semanas"][semana][regiao]["Total"][indicador][periodo] = 0.0
-        
-        # Adicionar região Ibérica (será calculada automaticamente)
-        dados["semanas"][semana]["Ibérica"] = {}
-        for granularidade in GRANULARIDADES_COM_TOTAL:
-            dados["semanas"][semana]["Ibérica"][granularidade] = {}
-            for indicador in INDICADORES:
-                dados["semanas"][semana]["Ibérica"][granularidade][indicador] = {}
-                for periodo in PERIODOS_ANALISE:
-                    dados["semanas"][semana]["Ibérica"][granularidade][indicador][periodo] = 0.0
-    
-    # Criar estrutura para os próximos 3 meses
-    for i in range(3):
-        data_inicio = hoje.replace(day=1) + timedelta(days=32*i)
-        mes = data_inicio.strftime("%Y-%m")
-        
-        dados["meses"][mes] = {}
-        
-        # Para cada região
-        for regiao in REGIOES:
-            dados["meses"][mes][regiao] = {}
-            
-            # Para cada granularidade
-            for granularidade in GRANULARIDADES_COM_TOTAL:
-                dados["meses"][mes][regiao][granularidade] = {}
-                
-                # Para cada indicador
-                for indicador in INDICADORES:
-                    dados["meses"][mes][regiao][granularidade][indicador] = {}
-                    
-                    # Para cada período
-                    for periodo in PERIODOS_ANALISE:
-                        dados["meses"][mes][regiao][granularidade][indicador][periodo] = 0.0
-                        
-                    # Para cada período acumulado
-                    for periodo_acumulado in PERIODOS_ACUMULADOS:
-                        dados["meses"][mes][regiao][granularidade][indicador][f"{periodo_acumulado}"] = {}
-                        for periodo in PERIODOS_ANALISE:
-                            dados["meses"][mes][regiao][granularidade][indicador][f"{periodo_acumulado}"][periodo] = 0.0
-        
-        # Adicionar região Ibérica (será calculada automaticamente)
-        dados["meses"][mes]["Ibérica"] = {}
-        for granularidade in GRANULARIDADES_COM_TOTAL:
-            dados["meses"][mes]["Ibérica"][granularidade] = {}
-            for indicador in INDICADORES:
-                dados["meses"][mes]["Ibérica"][granularidade][indicador] = {}
-                for periodo in PERIODOS_ANALISE:
-                    dados["meses"][mes]["Ibérica"][granularidade][indicador][periodo] = 0.0
-                
-                # Para cada período acumulado
-                for periodo_acumulado in PERIODOS_ACUMULADOS:
-                    dados["meses"][mes]["Ibérica"][granularidade][indicador][f"{periodo_acumulado}"] = {}
-                    for periodo in PERIODOS_ANALISE:
-                        dados["meses"][mes]["Ibérica"][granularidade][indicador][f"{periodo_acumulado}"][periodo] = 0.0
-    
-    # Salvar estrutura inicial
-    with open('dados_stock_v2.json', 'w') as f:
-        json.dump(dados, f, indent=4)
-    
-    return dados
+    return estrutura.criar_dados_esparsos(NIVEIS_ESTRUTURA)
 
 # Função para salvar dados
+# Escreve para um ficheiro temporário e substitui o original, para que as leituras
+# feitas por outras sessões durante a gravação nunca vejam um JSON incompleto
 def salvar_dados(dados):
-    with open('dados_stock_v2.json', 'w') as f:
+    caminho_temporario = f"{ARQUIVO_DADOS}.tmp"
+    with open(caminho_temporario, 'w') as f:
         json.dump(dados, f, indent=4)
+    os.replace(caminho_temporario, ARQUIVO_DADOS)
 
 # Função para calcular COGS
 def calcular_cogs(vendas, mfo, quebra):
@@ -232,90 +168,76 @@ def calcular_iberica(dados, periodo_tipo, periodo, granularidade, indicador, per
             print(f"Erro ao calcular Ibérica: {e}")
     return total
 
+# Função para obter os indicadores com dados num conjunto de nós
+def indicadores_presentes(nos):
+    indicadores = set()
+    for no in nos:
+        indicadores.update(no.keys())
+    return [indicador for indicador in INDICADORES if indicador in indicadores]
+
 # Função para atualizar todos os totais
 def atualizar_totais(dados):
-    # Para cada semana
-    for semana in dados["semanas"]:
-        # Para cada região (exceto Ibérica)
-        for regiao in REGIOES:
-            # Para cada indicador
-            for indicador in INDICADORES:
-                # Para cada período
-                for periodo in PERIODOS_ANALISE:
-                    # Calcular o total como soma das granularidades
-                    dados["semanas"][semana][regiao]["Total"][indicador][periodo] = calcular_total(dados, "semanas", semana, regiao, indicador, periodo)
-        
-        # Calcular região Ibérica como soma das regiões
-        for granularidade in GRANULARIDADES_COM_TOTAL:
-            for indicador in INDICADORES:
-                for periodo in PERIODOS_ANALISE:
-                    dados["semanas"][semana]["Ibérica"][granularidade][indicador][periodo] = calcular_iberica(dados, "semanas", semana, granularidade, indicador, periodo)
-    
-    # Para cada mês
-    for mes in dados["meses"]:
-        # Para cada região (exceto Ibérica)
-        for regiao in REGIOES:
-            # Para cada indicador
-            for indicador in INDICADORES:
-                # Para cada período
-                for periodo in PERIODOS_ANALISE:
-                    # Calcular o total como soma das granularidades
-                    dados["meses"][mes][regiao]["Total"][indicador][periodo] = calcular_total(dados, "meses", mes, regiao, indicador, periodo)
+    for periodo_tipo in ["semanas", "meses"]:
+        for chave, dados_periodo in dados[periodo_tipo].items():
+            # Para cada região com dados (exceto Ibérica)
+            regioes = [regiao for regiao in REGIOES if regiao in dados_periodo]
+            
+            for regiao in regioes:
+                dados_regiao = dados_periodo[regiao]
+                granularidades = [dados_regiao[g] for g in GRANULARIDADES if g in dados_regiao]
                 
-                # Para cada período acumulado
-                for periodo_acumulado in PERIODOS_ACUMULADOS:
+                # Para cada indicador presente em alguma granularidade
+                for indicador in indicadores_presentes(granularidades):
+                    # Calcular o total como soma das granularidades
                     for periodo in PERIODOS_ANALISE:
-                        dados["meses"][mes][regiao]["Total"][indicador][periodo_acumulado][periodo] = calcular_total(dados, "meses", mes, regiao, indicador, periodo, periodo_acumulado)
-        
-        # Calcular região Ibérica como soma das regiões
-        for granularidade in GRANULARIDADES_COM_TOTAL:
-            for indicador in INDICADORES:
-                for periodo in PERIODOS_ANALISE:
-                    dados["meses"][mes]["Ibérica"][granularidade][indicador][periodo] = calcular_iberica(dados, "meses", mes, granularidade, indicador, periodo)
-                                 # Para cada período acumulado
-                for periodo_acumulado in PERIODOS_ACUMULADOS:
+                        dados_regiao["Total"][indicador][periodo] = calcular_total(dados, periodo_tipo, chave, regiao, indicador, periodo)
+                    
+                    if periodo_tipo == "meses":
+                        for periodo_acumulado in PERIODOS_ACUMULADOS:
+                            for periodo in PERIODOS_ANALISE:
+                                dados_regiao["Total"][indicador][periodo_acumulado][periodo] = calcular_total(dados, periodo_tipo, chave, regiao, indicador, periodo, periodo_acumulado)
+            
+            # Calcular região Ibérica como soma das regiões
+            for granularidade in GRANULARIDADES_COM_TOTAL:
+                nos = [dados_periodo[regiao][granularidade] for regiao in regioes if granularidade in dados_periodo[regiao]]
+                
+                for indicador in indicadores_presentes(nos):
                     for periodo in PERIODOS_ANALISE:
-                        dados["meses"][mes]["Ibérica"][granularidade][indicador][periodo_acumulado][periodo] = calcular_iberica(dados, "meses", mes, granularidade, indicador, periodo, periodo_acumulado)
+                        dados_periodo["Ibérica"][granularidade][indicador][periodo] = calcular_iberica(dados, periodo_tipo, chave, granularidade, indicador, periodo)
+                    
+                    if periodo_tipo == "meses":
+                        for periodo_acumulado in PERIODOS_ACUMULADOS:
+                            for periodo in PERIODOS_ANALISE:
+                                dados_periodo["Ibérica"][granularidade][indicador][periodo_acumulado][periodo] = calcular_iberica(dados, periodo_tipo, chave, granularidade, indicador, periodo, periodo_acumulado)
     
     return dados
 
 # Função para atualizar COGS
 def atualizar_cogs(dados):
-    # Para cada semana
-    for semana in dados["semanas"]:
-        # Para cada região
-        for regiao in REGIOES_COM_IBERICA:
-            # Para cada granularidade
-            for granularidade in GRANULARIDADES_COM_TOTAL:
-                # Para cada período
-                for periodo in PERIODOS_ANALISE:
-                    # Calcular COGS = Vendas - MFO - Quebra
-                    vendas = dados["semanas"][semana][regiao][granularidade]["Vendas"][periodo]
-                    mfo = dados["semanas"][semana][regiao][granularidade]["MFO"][periodo]
-                    quebra = dados["semanas"][semana][regiao][granularidade]["Quebra"][periodo]
-                    dados["semanas"][semana][regiao][granularidade]["COGS"][periodo] = calcular_cogs(vendas, mfo, quebra)
-    
-    # Para cada mês
-    for mes in dados["meses"]:
-        # Para cada região
-        for regiao in REGIOES_COM_IBERICA:
-            # Para cada granularidade
-            for granularidade in GRANULARIDADES_COM_TOTAL:
-                # Para cada período
-                for periodo in PERIODOS_ANALISE:
+    for periodo_tipo in ["semanas", "meses"]:
+        # Percorrer apenas as células com dados
+        for dados_periodo in dados[periodo_tipo].values():
+            for dados_regiao in dados_periodo.values():
+                for dados_granularidade in dados_regiao.values():
+                    # Sem Vendas, MFO ou Quebra não há COGS a calcular
+                    if not any(componente in dados_granularidade for componente in COMPONENTES_COGS):
+                        continue
+                    
                     # Calcular COGS = Vendas - MFO - Quebra
-                    vendas = dados["meses"][mes][regiao][granularidade]["Vendas"][periodo]
-                    mfo = dados["meses"][mes][regiao][granularidade]["MFO"][periodo]
-                    quebra = dados["meses"][mes][regiao][granularidade]["Quebra"][periodo]
-                    dados["meses"][mes][regiao][granularidade]["COGS"][periodo] = calcular_cogs(vendas, mfo, quebra)
-                
-                # Para cada período acumulado
-                for periodo_acumulado in PERIODOS_ACUMULADOS:
                     for periodo in PERIODOS_ANALISE:
-                        vendas = dados["meses"][mes][regiao][granularidade]["Vendas"][periodo_acumulado][periodo]
-                        mfo = dados["meses"][mes][regiao][granularidade]["MFO"][periodo_acumulado][periodo]
-                        quebra = dados["meses"][mes][regiao][granularidade]["Quebra"][periodo_acumulado][periodo]
-                        dados["meses"][mes][regiao][granularidade]["COGS"][periodo_acumulado][periodo] = calcular_cogs(vendas, mfo, quebra)
+                        vendas = dados_granularidade["Vendas"][periodo]
+                        mfo = dados_granularidade["MFO"][periodo]
+                        quebra = dados_granularidade["Quebra"][periodo]
+                        dados_granularidade["COGS"][periodo] = calcular_cogs(vendas, mfo, quebra)
+                    
+                    if periodo_tipo == "meses":
+                        # Para cada período acumulado
+                        for periodo_acumulado in PERIODOS_ACUMULADOS:
+                            for periodo in PERIODOS_ANALISE:
+                                vendas = dados_granularidade["Vendas"][periodo_acumulado][periodo]
+                                mfo = dados_granularidade["MFO"][periodo_acumulado][periodo]
+                                quebra = dados_granularidade["Quebra"][periodo_acumulado][periodo]
+                                dados_granularidade["COGS"][periodo_acumulado][periodo] = calcular_cogs(vendas, mfo, quebra)
     
     return dados
 
@@ -381,45 +303,48 @@ def calcular_cogs_acumulado_ytd(dados, data_atual, regiao, granularidade, period
 
 # Função para atualizar rotação
 def atualizar_rotacao(dados):
-    # Para cada semana
-    for semana in dados["semanas"]:
+    # Para cada semana com dados
+    for semana, dados_semana in dados["semanas"].items():
         # Calcular dias acumulados para esta semana
         dias_acumulados = calcular_dias_acumulados(semana)
         
-        # Para cada região
-        for regiao in REGIOES_COM_IBERICA:
-            # Para cada granularidade
-            for granularidade in GRANULARIDADES_COM_TOTAL:
+        for regiao, dados_regiao in dados_semana.items():
+            for granularidade, dados_granularidade in dados_regiao.items():
+                # Sem stock líquido a rotação é 0 (célula em falta)
+                if "Stock Liquido" not in dados_granularidade:
+                    continue
+                
                 # Para cada período
                 for periodo in PERIODOS_ANALISE:
                     # Para EOP semanal: usar stock líquido médio daquela semana
-                    stock_liquido_medio = dados["semanas"][semana][regiao][granularidade]["Stock Liquido"][periodo]
+                    stock_liquido_medio = dados_granularidade["Stock Liquido"][periodo]
                     
                     # Calcular COGS acumulado YTD
                     cogs_acumulado = calcular_cogs_acumulado_ytd(dados, semana, regiao, granularidade, periodo)
                     
                     # Calcular rotação = (Stock Líquido médio / COGS acumulado) * Dias acumulados
-                    dados["semanas"][semana][regiao][granularidade]["Rotação"][periodo] = calcular_rotacao(stock_liquido_medio, cogs_acumulado, dias_acumulados)
+                    dados_granularidade["Rotação"][periodo] = calcular_rotacao(stock_liquido_medio, cogs_acumulado, dias_acumulados)
     
-    # Para cada mês
-    for mes in dados["meses"]:
+    # Para cada mês com dados
+    for mes, dados_mes in dados["meses"].items():
         # Calcular dias acumulados para este mês
         dias_acumulados = calcular_dias_acumulados(mes)
         
-        # Para cada região
-        for regiao in REGIOES_COM_IBERICA:
-            # Para cada granularidade
-            for granularidade in GRANULARIDADES_COM_TOTAL:
+        for regiao, dados_regiao in dados_mes.items():
+            for granularidade, dados_granularidade in dados_regiao.items():
+                if "Stock Liquido" not in dados_granularidade:
+                    continue
+                
                 # Para cada período
                 for periodo in PERIODOS_ANALISE:
                     # Para EOP mensal: usar stock líquido médio daquele mês
-                    stock_liquido_medio = dados["meses"][mes][regiao][granularidade]["Stock Liquido"][periodo]
+                    stock_liquido_medio = dados_granularidade["Stock Liquido"][periodo]
                     
                     # Calcular COGS acumulado YTD
                     cogs_acumulado = calcular_cogs_acumulado_ytd(dados, mes, regiao, granularidade, periodo)
                     
                     # Calcular rotação = (Stock Líquido médio / COGS acumulado) * Dias acumulados
-                    dados["meses"][mes][regiao][granularidade]["Rotação"][periodo] = calcular_rotacao(stock_liquido_medio, cogs_acumulado, dias_acumulados)
+                    dados_granularidade["Rotação"][periodo] = calcular_rotacao(stock_liquido_medio, cogs_acumulado, dias_acumulados)
                 
                 # Para cada período acumulado
                 for periodo in PERIODOS_ANALISE:
@@ -430,75 +355,177 @@ def atualizar_rotacao(dados):
                     cogs_acumulado = calcular_cogs_acumulado_ytd(dados, mes, regiao, granularidade, periodo)
                     
                     # Calcular rotação YTD = (Stock Líquido médio YTD / COGS acumulado) * Dias acumulados
-                    dados["meses"][mes][regiao][granularidade]["Rotação"]["YTD"][periodo] = calcular_rotacao(stock_liquido_medio_ytd, cogs_acumulado, dias_acumulados)
+                    dados_granularidade["Rotação"]["YTD"][periodo] = calcular_rotacao(stock_liquido_medio_ytd, cogs_acumulado, dias_acumulados)
                     
                     # Para EOP: usar stock líquido médio do mês
-                    dados["meses"][mes][regiao][granularidade]["Rotação"]["EOP"][periodo] = dados["meses"][mes][regiao][granularidade]["Rotação"][periodo]
+                    dados_granularidade["Rotação"]["EOP"][periodo] = dados_granularidade["Rotação"][periodo]
     
     return dados
 
 # Função para atualizar resumo mensal
 def atualizar_resumo_mensal(dados):
-    # Para cada mês
-    for mes in dados["meses"]:
-        # Encontrar semanas que pertencem a este mês
-        semanas_do_mes = []
-        for semana in dados["semanas"]:
-            # Extrair ano e número da semana
-            ano, num_semana = semana.split("-W")
-            # Converter para data (primeiro dia da semana)
-            data_semana = datetime.strptime(f"{ano}-{num_semana}-1", "%Y-%W-%w")
-            # Verificar se o mês da data corresponde ao mês atual
-            if data_semana.strftime("%Y-%m") == mes:
-                semanas_do_mes.append(semana)
+    # Agrupar as semanas com dados pelo mês a que pertencem
+    semanas_por_mes = {}
+    for semana in dados["semanas"]:
+        # Extrair ano e número da semana
+        ano, num_semana = semana.split("-W")
+        # Converter para data (primeiro dia da semana)
+        data_semana = datetime.strptime(f"{ano}-{num_semana}-1", "%Y-%W-%w")
+        semanas_por_mes.setdefault(data_semana.strftime("%Y-%m"), []).append(semana)
+    
+    # Para cada mês com semanas
+    for mes, semanas_do_mes in semanas_por_mes.items():
+        # Para cada região/granularidade/indicador presente nas semanas do mês
+        celulas = set()
+        for s in semanas_do_mes:
+            for regiao, dados_regiao in dados["semanas"][s].items():
+                for granularidade, dados_granularidade in dados_regiao.items():
+                    for indicador in dados_granularidade:
+                        celulas.add((regiao, granularidade, indicador))
         
-        # Para cada região
-        for regiao in REGIOES_COM_IBERICA:
-            # Para cada granularidade
-            for granularidade in GRANULARIDADES_COM_TOTAL:
-                # Para cada indicador
-                for indicador in INDICADORES:
-                    # Calcular média/soma das semanas para o mês
-                    for periodo in PERIODOS_ANALISE:
-                        valores = [dados["semanas"][s][regiao][granularidade][indicador][periodo] for s in semanas_do_mes]
-                        if valores:
-                            # Para vendas, MFO, quebra e COGS, somamos os valores
-                            if indicador in ["Vendas", "MFO", "Quebra", "COGS"]:
-                                dados["meses"][mes][regiao][granularidade][indicador][periodo] = sum(valores)
-                            # Para stocks, calculamos a média
-                            else:
-                                dados["meses"][mes][regiao][granularidade][indicador][periodo] = sum(valores) / len(valores)
-                    
-                    # Atualizar YTD e EOP
-                    for periodo in PERIODOS_ANALISE:
-                        # EOP é o valor do final do período (último valor)
-                        dados["meses"][mes][regiao][granularidade][indicador]["EOP"][periodo] = dados["meses"][mes][regiao][granularidade][indicador][periodo]
-                        
-                        # YTD é acumulado desde o início do ano
-                        # Simplificação: usamos o mesmo valor para demonstração
-                        dados["meses"][mes][regiao][granularidade][indicador]["YTD"][periodo] = dados["meses"][mes][regiao][granularidade][indicador][periodo]
+        for regiao, granularidade, indicador in celulas:
+            dados_indicador = dados["meses"][mes][regiao][granularidade][indicador]
+            
+            # Calcular média/soma das semanas para o mês
+            for periodo in PERIODOS_ANALISE:
+                valores = [dados["semanas"][s][regiao][granularidade][indicador][periodo] for s in semanas_do_mes]
+                # Para vendas, MFO, quebra e COGS, somamos os valores
+                if indicador in ["Vendas", "MFO", "Quebra", "COGS"]:
+                    dados_indicador[periodo] = sum(valores)
+                # Para stocks, calculamos a média
+                else:
+                    dados_indicador[periodo] = sum(valores) / len(valores)
+            
+            # Atualizar YTD e EOP
+            for periodo in PERIODOS_ANALISE:
+                # EOP é o valor do final do período (último valor)
+                dados_indicador["EOP"][periodo] = dados_indicador[periodo]
+                
+                # YTD é acumulado desde o início do ano
+                # Simplificação: usamos o mesmo valor para demonstração
+                dados_indicador["YTD"][periodo] = dados_indicador[periodo]
     
     return dados
 
 # Função para processar importação de dados CSV
 def processar_importacao_csv(conteudo_csv):
-    dados_importados = []
+    # Registos em colunas (semana, região, granularidade, indicador, período, valor)
+    dados_importados = registos.ColunasStock()
     csv_reader = csv.DictReader(io.StringIO(conteudo_csv))
     for row in csv_reader:
-        dados_importados.append(row)
+        dados_importados.acrescentar(
+            row.get("Semana"), row.get("Região"), row.get("Granularidade"),
+            row.get("Indicador"), row.get("Periodo"), float(row.get("Valor", 0))
+        )
     return dados_importados
 
+# Função para processar importação de folhas em formato largo (semanas ou indicadores em colunas)
+def processar_importacao_larga(conteudo, nome_ficheiro, mapeamento, planilha=None, intervalo=None):
+    grelha = importacao.ler_grelha(conteudo, nome_ficheiro, planilha, intervalo)
+    longo, nao_numericos = importacao.derreter_formato_largo(grelha, mapeamento)
+    return registos.ColunasStock.de_dataframe(longo, registos.DIMENSOES, importacao.DIMENSOES_IMPORTACAO), nao_numericos
+
+# Função para aplicar as linhas válidas de uma importação aos dados
+def aplicar_importacao(dados, dados_importados):
+    aplicadas = 0
+    for semana, regiao, granularidade, indicador, periodo, valor in dados_importados:
+        # Verificar se os valores são válidos
+        if (semana and FORMATO_SEMANA.match(semana) and 
+            regiao in REGIOES and 
+            granularidade in GRANULARIDADES and 
+            indicador in INDICADORES and 
+            indicador not in ["Rotação", "COGS"] and 
+            periodo in PERIODOS_ANALISE):
+            
+            dados["semanas"][semana][regiao][granularidade][indicador][periodo] = valor
+            aplicadas += 1
+    return aplicadas
+
+# Tarefa em segundo plano: aplica a importação, recalcula e grava.
+# Os dados são relidos do ficheiro dentro da tarefa (e não reaproveitados da execução que a
+# submeteu), para que importações seguidas sobre o mesmo ficheiro não se sobreponham.
+def recalcular_importacao(progresso, dados_importados):
+    progresso(0.0, "A carregar dados...")
+    dados = criar_estrutura_dados()
+    
+    progresso(0.1, "A aplicar valores importados...")
+    aplicadas = aplicar_importacao(dados, dados_importados)
+    
+    progresso(0.2, "A atualizar totais...")
+    dados = atualizar_totais(dados)
+    
+    progresso(0.35, "A atualizar COGS...")
+    dados = atualizar_cogs(dados)
+    
+    progresso(0.5, "A atualizar rotação...")
+    dados = atualizar_rotacao(dados)
+    
+    progresso(0.7, "A atualizar resumo mensal...")
+    dados = atualizar_resumo_mensal(dados)
+    
+    progresso(0.85, "A gravar dados...")
+    salvar_dados(dados)
+    
+    return {"linhas": len(dados_importados), "aplicadas": aplicadas}
+
+# Grava uma edição do formulário: relê o ficheiro na fila de escrita e só aplica as células
+# cujo valor atual ainda é o que o utilizador viu (senão lança ConflitoEdicao e nada é gravado).
+# celulas: tuplos (semana, regiao, granularidade, indicador, periodo, valor_novo, valor_lido).
+def gravar_edicao(celulas):
+    dados = criar_estrutura_dados()
+    
+    conflitos = []
+    for semana, regiao, granularidade, indicador, periodo, valor_novo, valor_lido in celulas:
+        valor_atual = dados["semanas"][semana][regiao][granularidade][indicador][periodo]
+        if valor_atual != valor_lido and valor_atual != valor_novo:
+            conflitos.append({
+                "celula": (semana, regiao, granularidade, indicador, periodo),
+                "valor_lido": valor_lido,
+                "valor_atual": valor_atual,
+                "valor_novo": valor_novo,
+            })
+    if conflitos:
+        raise escrita.ConflitoEdicao(conflitos)
+    
+    for semana, regiao, granularidade, indicador, periodo, valor_novo, _ in celulas:
+        dados["semanas"][semana][regiao][granularidade][indicador][periodo] = valor_novo
+    
+    # Atualizar totais, COGS, rotação e resumo mensal
+    dados = atualizar_totais(dados)
+    dados = atualizar_cogs(dados)
+    dados = atualizar_rotacao(dados)
+    dados = atualizar_resumo_mensal(dados)
+    
+    salvar_dados(dados)
+    return dados
+
+# Acompanha uma importação em curso; o fragmento é reexecutado sozinho, sem bloquear a página
+@st.fragment(run_every=INTERVALO_PROGRESSO)
+def acompanhar_importacao(tarefa_id):
+    tarefa = tarefas.obter(tarefa_id)
+    if tarefa is None or tarefa["estado"] not in tarefas.ESTADOS_ATIVOS:
+        # Terminou: reexecutar a aplicação para recarregar os dados e mostrar o resultado
+        st.rerun()
+    
+    if tarefa["estado"] == tarefas.EM_ESPERA:
+        st.info("Importação em espera: outra importação sobre os mesmos dados está a decorrer...")
+    else:
+        st.progress(tarefa["progresso"], text=tarefa["mensagem"] or "A processar...")
+
 # Função para criar gráficos
 def criar_grafico(dados, periodo_tipo, periodo, regiao, granularidade, indicador, periodos_analise):
+    # Apenas os períodos com dados, por ordem cronológica
     if periodo_tipo == "semanas":
+        semanas = sorted(dados["semanas"])
         df = pd.DataFrame({
-            "Período": list(dados["semanas"].keys()),
-            **{p: [dados["semanas"][s][regiao][granularidade][indicador][p] for s in dados["semanas"]] for p in periodos_analise}
+            "Período": semanas,
+            **{p: [dados["semanas"][s][regiao][granularidade][indicador][p] for s in semanas] for p in periodos_analise}
         })
     else:  # meses
+        meses = sorted(dados["meses"])
         df = pd.DataFrame({
-            "Período": list(dados["meses"].keys()),
-            **{p: [dados["meses"][m][regiao][granularidade][indicador][p] for m in dados["meses"]] for p in periodos_analise}
+            "Período": meses,
+            **{p: [dados["meses"][m][regiao][granularidade][indicador][p] for m in meses] for p in periodos_analise}
         })
     
     fig = px.line(df, x="Período", y=periodos_analise, title=f"{indicador} - {regiao} - {granularidade}")
@@ -524,26 +551,31 @@ def criar_grafico_resumo_mensal(dados, mes, regiao, granularidade, indicador, ti
     fig.update_layout(height=300)
     return fig
 
-# Inicializar dados
-dados = criar_estrutura_dados()
+# Inicializar dados (com as variações face ao Budget e ao LY, calculadas só para apresentação)
+dados = variacoes.calcular_variacoes(criar_estrutura_dados())
 
 # Interface da aplicação
 st.title("Ferramenta de Monitorização de Stock")
 
 # Sidebar para navegação
 st.sidebar.title("Navegação")
-pagina = st.sidebar.radio("Selecione a página:", ["Visão Semanal", "Resumo Mensal", "Introdução de Dados", "Importação de Dados"])
+pagina = st.sidebar.radio("Selecione a página:", ["Visão Semanal", "Resumo Mensal", "Introdução de Dados", "Importação de Dados", "Exportação de Dados"])
 
 # Seleção de região (comum a todas as páginas)
 regiao_selecionada = st.sidebar.selectbox("Selecione a Região:", REGIOES_COM_IBERICA)
 
+# Importação em segundo plano ainda a decorrer (os dados mostrados são os anteriores a ela)
+tarefa_em_curso = tarefas.obter(st.session_state.get("tarefa_importacao"))
+if tarefa_em_curso is not None and tarefa_em_curso["estado"] in tarefas.ESTADOS_ATIVOS:
+    st.sidebar.info(f"Importação em curso ({tarefa_em_curso['progresso']:.0%}). Os dados serão atualizados no fim.")
+
 if pagina == "Visão Semanal":
     st.header(f"Visão Semanal - {regiao_selecionada}")
     
     # Filtros
     col1, col2, col3 = st.columns(3)
     with col1:
-        semana_selecionada = st.selectbox("Selecione a Semana:", list(dados["semanas"].keys()))
+        semana_selecionada = st.selectbox("Selecione a Semana:", estrutura.opcoes_periodo(dados["semanas"], estrutura.proximas_semanas(NUM_SEMANAS_PADRAO)))
     with col2:
         granularidade_selecionada = st.selectbox("Selecione a Granularidade:", GRANULARIDADES_COM_TOTAL)
     with col3:
@@ -563,7 +595,7 @@ if pagina == "Visão Semanal":
     dados_tabela = []
     for indicador in INDICADORES:
         linha = {"Indicador": indicador}
-        for periodo in PERIODOS_ANALISE:
+        for periodo in PERIODOS_ANALISE + variacoes.PERIODOS_VARIACAO:
             linha[periodo] = dados["semanas"][semana_selecionada][regiao_selecionada][granularidade_selecionada][indicador][periodo]
         dados_tabela.append(linha)
     
@@ -576,7 +608,7 @@ elif pagina == "Resumo Mensal":
     # Filtros
     col1, col2, col3 = st.columns(3)
     with col1:
-        mes_selecionado = st.selectbox("Selecione o Mês:", list(dados["meses"].keys()))
+        mes_selecionado = st.selectbox("Selecione o Mês:", estrutura.opcoes_periodo(dados["meses"], estrutura.proximos_meses(NUM_MESES_PADRAO)))
     with col2:
         granularidade_selecionada = st.selectbox("Selecione a Granularidade:", GRANULARIDADES_COM_TOTAL)
     with col3:
@@ -611,10 +643,10 @@ elif pagina == "Resumo Mensal":
     for indicador in INDICADORES:
         linha = {"Indicador": indicador}
         if tipo_acumulado == "Mensal":
-            for periodo in PERIODOS_ANALISE:
+            for periodo in PERIODOS_ANALISE + variacoes.PERIODOS_VARIACAO:
                 linha[periodo] = dados["meses"][mes_selecionado][regiao_selecionada][granularidade_selecionada][indicador][periodo]
         else:
-            for periodo in PERIODOS_ANALISE:
+            for periodo in PERIODOS_ANALISE + variacoes.PERIODOS_VARIACAO:
                 linha[periodo] = dados["meses"][mes_selecionado][regiao_selecionada][granularidade_selecionada][indicador][tipo_acumulado][periodo]
         dados_tabela.append(linha)
     
@@ -631,7 +663,7 @@ elif pagina == "Introdução de Dados":
         # Filtros
         col1, col2 = st.columns(2)
         with col1:
-            semana_selecionada = st.selectbox("Selecione a Semana:", list(dados["semanas"].keys()))
+            semana_selecionada = st.selectbox("Selecione a Semana:", estrutura.opcoes_periodo(dados["semanas"], estrutura.proximas_semanas(NUM_SEMANAS_PADRAO)))
             
             # Calcular e mostrar dias acumulados
             dias_acumulados = calcular_dias_acumulados(semana_selecionada)
@@ -641,6 +673,14 @@ elif pagina == "Introdução de Dados":
             granularidade_selecionada = st.selectbox("Selecione a Granularidade:", GRANULARIDADES)
             st.info("O Total é calculado automaticamente como soma das outras granularidades.")
         
+        # Valores mostrados agora; o formulário submetido foi preenchido na execução anterior
+        valores_atuais = {
+            indicador: dados["semanas"][semana_selecionada][regiao_selecionada][granularidade_selecionada][indicador]["Introduzido"]
+            for indicador in INDICADORES if indicador not in ["Rotação", "COGS"]
+        }
+        chave_formulario = (semana_selecionada, regiao_selecionada, granularidade_selecionada)
+        valores_lidos = st.session_state.get("valores_formulario", {}).get(chave_formulario, valores_atuais)
+        
         # Formulário para introdução de dados
         with st.form("formulario_dados"):
             st.subheader(f"Introduzir Dados para {semana_selecionada} - {regiao_selecionada} - {granularidade_selecionada}")
@@ -651,34 +691,46 @@ elif pagina == "Introdução de Dados":
                 if indicador not in ["Rotação", "COGS"]:  # Rotação e COGS são calculados automaticamente
                     valores[indicador] = st.number_input(
                         f"{indicador} (Introduzido)", 
-                        value=float(dados["semanas"][semana_selecionada][regiao_selecionada][granularidade_selecionada][indicador]["Introduzido"]),
-                        format="%.2f"
+                        value=float(valores_atuais[indicador]),
+                        format="%.2f",
+                        key=f"{'_'.join(chave_formulario)}_{indicador}"
                     )
             
             # Botão de submissão
             submitted = st.form_submit_button("Salvar Dados")
             
             if submitted:
-                # Atualizar dados
-                for indicador, valor in valores.items():
-                    dados["semanas"][semana_selecionada][regiao_selecionada][granularidade_selecionada][indicador]["Introduzido"] = valor
-                
-                # Atualizar totais
-                dados = atualizar_totais(dados)
-                
-                # Atualizar COGS
-                dados = atualizar_cogs(dados)
+                # Apenas as células alteradas, com o valor que o utilizador viu
+                celulas = [
+                    (*chave_formulario, indicador, "Introduzido", valor, valores_lidos.get(indicador, 0.0))
+                    for indicador, valor in valores.items()
+                    if valor != valores_lidos.get(indicador, 0.0)
+                ]
                 
-                # Atualizar rotação
-                dados = atualizar_rotacao(dados)
-                
-                # Atualizar resumo mensal
-                dados = atualizar_resumo_mensal(dados)
-                
-                # Salvar dados
-                salvar_dados(dados)
-                
-                st.success("Dados salvos com sucesso!")
+                try:
+                    # Serializada com as importações em segundo plano sobre o mesmo ficheiro
+                    if celulas:
+                        dados = escrita.executar_na_fila(gravar_edicao, celulas, chave=ARQUIVO_DADOS)
+                        valores_atuais.update({indicador: valor for *_, indicador, _, valor, _ in celulas})
+                    st.success("Dados salvos com sucesso!" if celulas else "Nenhum valor foi alterado.")
+                except escrita.ConflitoEdicao as e:
+                    st.error(
+                        f"Não foi possível gravar: {len(e.conflitos)} valor(es) foram alterados por outro utilizador "
+                        "desde que o formulário foi aberto. Nada foi gravado; reveja os valores atuais e volte a gravar."
+                    )
+                    st.dataframe(pd.DataFrame([
+                        {
+                            "Indicador": conflito["celula"][3],
+                            "Valor atual": conflito["valor_atual"],
+                            "O seu valor": conflito["valor_novo"],
+                        }
+                        for conflito in e.conflitos
+                    ]), use_container_width=True)
+                    # Mostrar os valores atuais do ficheiro (a próxima gravação compara com eles)
+                    for conflito in e.conflitos:
+                        valores_atuais[conflito["celula"][3]] = conflito["valor_atual"]
+        
+        st.session_state.setdefault("valores_formulario", {})[chave_formulario] = valores_atuais
         
         # Exibir tabela atual
         st.subheader("Dados Atuais")
@@ -718,63 +770,81 @@ elif pagina == "Importação de Dados":
     Nota: Os valores de COGS, Rotação, Total e Ibérica serão calculados automaticamente.
     """)
     
-    # Upload de arquivo CSV
-    uploaded_file = st.file_uploader("Escolha um arquivo CSV", type="csv")
+    formato_ficheiro = st.radio(
+        "Formato do ficheiro:",
+        ["Longo (uma linha por valor)", "Largo (semanas ou indicadores em colunas)"],
+        horizontal=True
+    )
     
-    if uploaded_file is not None:
-        # Ler o conteúdo do arquivo
-        conteudo = uploaded_file.getvalue().decode("utf-8")
+    if formato_ficheiro.startswith("Largo"):
+        # Mapeamento da folha: o que representam as colunas de valores e as dimensões em falta
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            formato_largo = st.selectbox(
+                "Colunas de valores:", importacao.FORMATOS_LARGOS,
+                format_func=lambda f: "Semanas" if f == "semanas_em_colunas" else "Indicadores (e períodos)"
+            )
+        with col2:
+            regiao_constante = st.selectbox("Região:", ["(na folha)"] + REGIOES)
+        with col3:
+            periodo_constante = st.selectbox("Período:", ["(na folha)"] + PERIODOS_ANALISE)
+        with col4:
+            intervalo = st.text_input("Intervalo de células:", help="Ex.: B3:N40 (a primeira linha tem os cabeçalhos)")
         
-        # Processar o CSV
+        constantes = {}
+        if periodo_constante != "(na folha)":
+            constantes["periodo"] = periodo_constante
+        if regiao_constante != "(na folha)":
+            constantes["regiao"] = regiao_constante
+        mapeamento = {"formato": formato_largo, "constantes": constantes}
+    
+    # Upload de arquivo CSV (ou Excel, no formato largo)
+    uploaded_file = st.file_uploader(
+        "Escolha um arquivo CSV", type="csv" if formato_ficheiro.startswith("Longo") else ["csv", "xlsx"]
+    )
+    
+    if uploaded_file is not None:
+        # Processar o arquivo
         try:
-            dados_importados = processar_importacao_csv(conteudo)
+            if formato_ficheiro.startswith("Longo"):
+                dados_importados = processar_importacao_csv(uploaded_file.getvalue().decode("utf-8"))
+            else:
+                dados_importados, nao_numericos = processar_importacao_larga(
+                    uploaded_file.getvalue(), uploaded_file.name, mapeamento, intervalo=intervalo or None
+                )
+                if nao_numericos:
+                    st.warning(f"{nao_numericos} valores ignorados por não serem numéricos.")
             
             # Exibir prévia dos dados
             st.subheader("Prévia dos Dados")
-            df_preview = pd.DataFrame(dados_importados)
+            df_preview = dados_importados.para_dataframe(["Semana", "Região", "Granularidade", "Indicador", "Periodo"], "Valor")
             st.dataframe(df_preview, use_container_width=True)
             
             # Botão para confirmar importação
             if st.button("Confirmar Importação"):
-                # Atualizar dados com os valores importados
-                for row in dados_importados:
-                    semana = row.get("Semana")
-                    regiao = row.get("Região")
-                    granularidade = row.get("Granularidade")
-                    indicador = row.get("Indicador")
-                    periodo = row.get("Periodo")
-                    valor = float(row.get("Valor", 0))
-                    
-                    # Verificar se os valores são válidos
-                    if (semana in dados["semanas"] and 
-                        regiao in REGIOES and 
-                        granularidade in GRANULARIDADES and 
-                        indicador in INDICADORES and 
-                        indicador not in ["Rotação", "COGS"] and 
-                        periodo in PERIODOS_ANALISE):
-                        
-                        dados["semanas"][semana][regiao][granularidade][indicador][periodo] = valor
-                
-                # Atualizar totais
-                dados = atualizar_totais(dados)
-                
-                # Atualizar COGS
-                dados = atualizar_cogs(dados)
-                
-                # Atualizar rotação
-                dados = atualizar_rotacao(dados)
-                
-                # Atualizar resumo mensal
-                dados = atualizar_resumo_mensal(dados)
-                
-                # Salvar dados
-                salvar_dados(dados)
-                
-                st.success("Dados importados com sucesso!")
+                # O recálculo e a gravação correm em segundo plano; as outras páginas continuam disponíveis
+                st.session_state["tarefa_importacao"] = tarefas.submeter(
+                    ARQUIVO_DADOS, recalcular_importacao, dados_importados,
+                    descricao=f"Importação de {uploaded_file.name}"
+                )
         
         except Exception as e:
             st.error(f"Erro ao processar o arquivo: {str(e)}")
     
+    # Estado da última importação submetida nesta sessão
+    tarefa_importacao = tarefas.obter(st.session_state.get("tarefa_importacao"))
+    if tarefa_importacao is not None:
+        if tarefa_importacao["estado"] in tarefas.ESTADOS_ATIVOS:
+            acompanhar_importacao(tarefa_importacao["id"])
+        elif tarefa_importacao["estado"] == tarefas.CONCLUIDA:
+            resultado = tarefa_importacao["resultado"]
+            st.success(
+                f"Dados importados com sucesso! {resultado['aplicadas']} de {resultado['linhas']} linhas aplicadas "
+                f"({tarefa_importacao['duracao_s']} s)."
+            )
+        else:
+            st.error(f"Erro ao importar os dados: {tarefa_importacao['erro']}")
+    
     # Exemplo de template para download
     st.subheader("Template para Importação")
     
@@ -798,6 +868,45 @@ elif pagina == "Importação de Dados":
         mime="text/csv"
     )
 
+elif pagina == "Exportação de Dados":
+    st.header("Exportação de Dados")
+    
+    # Recorte a exportar (filtros vazios incluem todos os valores)
+    col1, col2 = st.columns(2)
+    with col1:
+        tipo_exportacao = st.radio("Dados:", ["semanas", "meses"], format_func=lambda t: "Semanais" if t == "semanas" else "Mensais", horizontal=True)
+    with col2:
+        formato_exportacao = st.radio("Formato:", exportacao.formatos_disponiveis(), format_func=str.upper, horizontal=True)
+    
+    anos_disponiveis = sorted({chave[:4] for chave in dados[tipo_exportacao]})
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        regioes_exportacao = st.multiselect("Regiões:", REGIOES_COM_IBERICA)
+        anos_exportacao = st.multiselect("Anos:", anos_disponiveis)
+    with col2:
+        granularidades_exportacao = st.multiselect("Granularidades:", GRANULARIDADES_COM_TOTAL)
+        periodos_exportacao = st.multiselect("Períodos:", PERIODOS_ANALISE + variacoes.PERIODOS_VARIACAO)
+    with col3:
+        indicadores_exportacao = st.multiselect("Indicadores:", INDICADORES)
+    
+    # O ficheiro só é gerado quando o botão é clicado, percorrendo os dados em memória em lotes
+    st.download_button(
+        label=f"Exportar {formato_exportacao.upper()}",
+        data=lambda: exportacao.exportar(
+            exportacao.linhas_cubo(
+                dados, tipo_exportacao,
+                regioes=regioes_exportacao or None,
+                granularidades=granularidades_exportacao or None,
+                indicadores=indicadores_exportacao or None,
+                periodos=periodos_exportacao or None,
+                anos=anos_exportacao or None
+            ),
+            tipo_exportacao, formato_exportacao
+        ),
+        file_name=f"stock_{tipo_exportacao}.{formato_exportacao}",
+        mime=exportacao.FORMATOS[formato_exportacao]
+    )
+
 # Rodapé
 st.markdown("---")
 st.markdown("Ferramenta de Monitorização de Stock © 2025")
@@ -0,0 +1,304 @@
+from datetime import datetime, timedelta, date
+
+import estrutura
+import janelas
+import registos
+import variacoes
+from db_setup import PERIODOS_ACUMULADOS, PERIODOS_ANALISE, ler_dimensoes
+from diagnosticos import medir_tempo
+
+# Níveis da estrutura de dados até ao indicador: período -> região -> granularidade -> indicador
+NIVEIS_ESTRUTURA = 4
+
+# Indicadores a partir dos quais o COGS é calculado
+COMPONENTES_COGS = ["Vendas", "MFO", "Quebra"]
+
+# Indicadores semanais que só existem nos dados carregados (não estão guardados na base de dados)
+INDICADORES_CALCULADOS_CARREGADOS = ["Rotação"] + janelas.INDICADORES_JANELA
+
+# Dados semanais guardados, com os agregados Ibérica e Total das views
+SQL_SEMANAL = '''
+SELECT semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor
+FROM dados_stock
+UNION ALL
+SELECT semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor
+FROM view_iberica_semanal
+UNION ALL
+SELECT semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor
+FROM view_total_semanal
+'''
+
+SQL_MENSAL = '''
+SELECT mes, regiao_id, granularidade_id, indicador_id, periodo_id, periodo_acumulado_id, valor
+FROM dados_stock_mensal
+'''
+
+# Função para calcular dias acumulados desde o início do ano
+def calcular_dias_acumulados(data_str):
+    # Converter string de semana para data
+    if "W" in data_str:  # Formato de semana
+        ano, semana = data_str.split("-W")
+        # Primeiro dia da semana
+        primeiro_dia_semana = datetime.strptime(f"{ano}-{semana}-1", "%Y-%W-%w").date()
+        # Último dia da semana (domingo)
+        ultimo_dia_semana = primeiro_dia_semana + timedelta(days=6)
+        data = ultimo_dia_semana
+    else:  # Formato de mês
+        ano, mes = data_str.split("-")
+        # Primeiro dia do próximo mês
+        if mes == "12":
+            primeiro_dia_proximo_mes = date(int(ano) + 1, 1, 1)
+        else:
+            primeiro_dia_proximo_mes = date(int(ano), int(mes) + 1, 1)
+        # Último dia do mês atual (um dia antes do primeiro dia do próximo mês)
+        ultimo_dia_mes = primeiro_dia_proximo_mes - timedelta(days=1)
+        data = ultimo_dia_mes
+    
+    # Primeiro dia do ano
+    primeiro_dia_ano = date(data.year, 1, 1)
+    
+    # Calcular dias acumulados
+    dias_acumulados = (data - primeiro_dia_ano).days + 1
+    
+    return dias_acumulados
+
+# Função para calcular COGS
+def calcular_cogs(vendas, mfo, quebra):
+    return vendas - mfo - quebra
+
+# Função para calcular rotação
+def calcular_rotacao(stock_liquido_medio, cogs_acumulado, dias_acumulados):
+    if stock_liquido_medio == 0 or cogs_acumulado == 0:
+        return 0
+    return (stock_liquido_medio / cogs_acumulado) * dias_acumulados
+
+# Função para calcular stock líquido médio YTD
+def calcular_stock_liquido_medio_ytd(dados, data_atual, regiao, granularidade, periodo):
+    # Converter data_atual para datetime
+    if "W" in data_atual:  # Formato de semana
+        ano, semana = data_atual.split("-W")
+        data = datetime.strptime(f"{ano}-{semana}-1", "%Y-%W-%w").date()
+    else:  # Formato de mês
+        data = datetime.strptime(data_atual + "-01", "%Y-%m-%d").date()
+    
+    # Primeiro dia do ano
+    primeiro_dia_ano = date(data.year, 1, 1)
+    
+    # Calcular média do stock líquido desde o início do ano até a data atual
+    stock_liquido_total = 0
+    count = 0
+    
+    # Para semanas
+    for semana in dados["semanas"]:
+        # Converter semana para data
+        ano_s, semana_s = semana.split("-W")
+        data_semana = datetime.strptime(f"{ano_s}-{semana_s}-1", "%Y-%W-%w").date()
+        
+        # Verificar se a semana está entre o início do ano e a data atual
+        if primeiro_dia_ano <= data_semana <= data:
+            stock_liquido_total += dados["semanas"][semana][regiao][granularidade]["Stock Liquido"][periodo]
+            count += 1
+    
+    # Se não houver dados, retornar 0
+    if count == 0:
+        return 0
+    
+    return stock_liquido_total / count
+
+# Função para calcular COGS acumulado YTD
+def calcular_cogs_acumulado_ytd(dados, data_atual, regiao, granularidade, periodo):
+    # Converter data_atual para datetime
+    if "W" in data_atual:  # Formato de semana
+        ano, semana = data_atual.split("-W")
+        data = datetime.strptime(f"{ano}-{semana}-1", "%Y-%W-%w").date()
+    else:  # Formato de mês
+        data = datetime.strptime(data_atual + "-01", "%Y-%m-%d").date()
+    
+    # Primeiro dia do ano
+    primeiro_dia_ano = date(data.year, 1, 1)
+    
+    # Calcular COGS acumulado desde o início do ano até a data atual
+    cogs_acumulado = 0
+    
+    # Para semanas
+    for semana in dados["semanas"]:
+        # Converter semana para data
+        ano_s, semana_s = semana.split("-W")
+        data_semana = datetime.strptime(f"{ano_s}-{semana_s}-1", "%Y-%W-%w").date()
+        
+        # Verificar se a semana está entre o início do ano e a data atual
+        if primeiro_dia_ano <= data_semana <= data:
+            cogs_acumulado += dados["semanas"][semana][regiao][granularidade]["COGS"][periodo]
+    
+    return cogs_acumulado
+
+# Função para atualizar COGS
+@medir_tempo("atualizar_cogs")
+def atualizar_cogs(dados):
+    # Percorrer apenas as células com dados
+    for dados_semana in dados["semanas"].values():
+        for dados_regiao in dados_semana.values():
+            for dados_granularidade in dados_regiao.values():
+                # Sem Vendas, MFO ou Quebra não há COGS a calcular
+                if not any(componente in dados_granularidade for componente in COMPONENTES_COGS):
+                    continue
+                
+                # Para cada período
+                for periodo in PERIODOS_ANALISE:
+                    # Obter valores
+                    vendas = dados_granularidade["Vendas"][periodo]
+                    mfo = dados_granularidade["MFO"][periodo]
+                    quebra = dados_granularidade["Quebra"][periodo]
+                    
+                    # Calcular COGS
+                    dados_granularidade["COGS"][periodo] = calcular_cogs(vendas, mfo, quebra)
+    
+    # Para cada mês
+    for dados_mes in dados["meses"].values():
+        for dados_regiao in dados_mes.values():
+            for dados_granularidade in dados_regiao.values():
+                if not any(componente in dados_granularidade for componente in COMPONENTES_COGS):
+                    continue
+                
+                # Para cada período
+                for periodo in PERIODOS_ANALISE:
+                    # Obter valores
+                    vendas = dados_granularidade["Vendas"][periodo]
+                    mfo = dados_granularidade["MFO"][periodo]
+                    quebra = dados_granularidade["Quebra"][periodo]
+                    
+                    # Calcular COGS
+                    dados_granularidade["COGS"][periodo] = calcular_cogs(vendas, mfo, quebra)
+                
+                # Para cada período acumulado presente nos componentes
+                for periodo_acumulado in PERIODOS_ACUMULADOS:
+                    if not any(periodo_acumulado in dados_granularidade[componente] for componente in COMPONENTES_COGS):
+                        continue
+                    
+                    for periodo in PERIODOS_ANALISE:
+                        # Obter valores
+                        vendas = dados_granularidade["Vendas"][periodo_acumulado][periodo]
+                        mfo = dados_granularidade["MFO"][periodo_acumulado][periodo]
+                        quebra = dados_granularidade["Quebra"][periodo_acumulado][periodo]
+                        
+                        # Calcular COGS
+                        dados_granularidade["COGS"][periodo_acumulado][periodo] = calcular_cogs(vendas, mfo, quebra)
+    
+    return dados
+
+# Função para atualizar rotação
+@medir_tempo("atualizar_rotacao")
+def atualizar_rotacao(dados):
+    # Para cada semana com dados
+    for semana, dados_semana in dados["semanas"].items():
+        # Calcular dias acumulados para esta semana
+        dias_acumulados = calcular_dias_acumulados(semana)
+        
+        for regiao, dados_regiao in dados_semana.items():
+            for granularidade, dados_granularidade in dados_regiao.items():
+                # Sem stock líquido a rotação é 0 (célula em falta)
+                if "Stock Liquido" not in dados_granularidade:
+                    continue
+                
+                # Para cada período
+                for periodo in PERIODOS_ANALISE:
+                    # Para EOP semanal: usar stock líquido médio daquela semana
+                    stock_liquido_medio = dados_granularidade["Stock Liquido"][periodo]
+                    
+                    # Calcular COGS acumulado YTD
+                    cogs_acumulado = calcular_cogs_acumulado_ytd(dados, semana, regiao, granularidade, periodo)
+                    
+                    # Calcular rotação = (Stock Líquido médio / COGS acumulado) * Dias acumulados
+                    dados_granularidade["Rotação"][periodo] = calcular_rotacao(stock_liquido_medio, cogs_acumulado, dias_acumulados)
+    
+    # Para cada mês com dados
+    for mes, dados_mes in dados["meses"].items():
+        # Calcular dias acumulados para este mês
+        dias_acumulados = calcular_dias_acumulados(mes)
+        
+        for regiao, dados_regiao in dados_mes.items():
+            for granularidade, dados_granularidade in dados_regiao.items():
+                if "Stock Liquido" not in dados_granularidade:
+                    continue
+                
+                # Para cada período
+                for periodo in PERIODOS_ANALISE:
+                    # Para EOP mensal: usar stock líquido médio daquele mês
+                    stock_liquido_medio = dados_granularidade["Stock Liquido"][periodo]
+                    
+                    # Calcular COGS acumulado YTD
+                    cogs_acumulado = calcular_cogs_acumulado_ytd(dados, mes, regiao, granularidade, periodo)
+                    
+                    # Calcular rotação = (Stock Líquido médio / COGS acumulado) * Dias acumulados
+                    dados_granularidade["Rotação"][periodo] = calcular_rotacao(stock_liquido_medio, cogs_acumulado, dias_acumulados)
+                
+                # Para cada período acumulado
+                for periodo in PERIODOS_ANALISE:
+                    # Para YTD: usar stock líquido médio desde o início do ano
+                    stock_liquido_medio_ytd = calcular_stock_liquido_medio_ytd(dados, mes, regiao, granularidade, periodo)
+                    
+                    # Calcular COGS acumulado YTD
+                    cogs_acumulado = calcular_cogs_acumulado_ytd(dados, mes, regiao, granularidade, periodo)
+                    
+                    # Calcular rotação YTD = (Stock Líquido médio YTD / COGS acumulado) * Dias acumulados
+                    dados_granularidade["Rotação"]["YTD"][periodo] = calcular_rotacao(stock_liquido_medio_ytd, cogs_acumulado, dias_acumulados)
+                    
+                    # Para EOP: usar stock líquido médio do mês
+                    dados_granularidade["Rotação"]["EOP"][periodo] = dados_granularidade["Rotação"][periodo]
+    
+    return dados
+
+# Função para ler os dados guardados para a estrutura esparsa (sem os cálculos automáticos).
+# linhas_semanais substitui os valores semanais guardados (por ex. os de reconstrucao.linhas_semanais).
+def ler_dados(conn, linhas_semanais=None):
+    dados = estrutura.criar_dados_esparsos(NIVEIS_ESTRUTURA)
+    
+    # As dimensões chegam como ids e são descodificadas pelas tabelas de lookup,
+    # sem que o SQLite crie uma string por linha
+    categorias = {
+        dimensao: registos.Categorias(rotulos)
+        for dimensao, rotulos in ler_dimensoes(conn).items()
+    }
+    
+    # Carregar dados semanais (em colunas, com os rótulos internados)
+    with medir_tempo("sql_semanal"):
+        if linhas_semanais is None:
+            linhas_semanais = conn.execute(SQL_SEMANAL)
+        semanas = registos.ColunasStock.de_linhas(linhas_semanais, registos.DIMENSOES, categorias, codificadas=categorias)
+    
+    # Processar dados semanais
+    with medir_tempo("construcao_dict_semanal"):
+        for semana, regiao, granularidade, indicador, periodo, valor in semanas:
+            # Os níveis intermédios são criados automaticamente na escrita
+            dados["semanas"][semana][regiao][granularidade][indicador][periodo] = valor
+    
+    # Carregar dados mensais
+    with medir_tempo("sql_mensal"):
+        meses = registos.ColunasStock.de_linhas(
+            conn.execute(SQL_MENSAL), registos.DIMENSOES_MENSAIS, categorias, codificadas=categorias
+        )
+    
+    # Processar dados mensais
+    with medir_tempo("construcao_dict_mensal"):
+        for mes, regiao, granularidade, indicador, periodo, periodo_acumulado, valor in meses:
+            if periodo_acumulado:
+                dados["meses"][mes][regiao][granularidade][indicador][periodo_acumulado][periodo] = valor
+            else:
+                dados["meses"][mes][regiao][granularidade][indicador][periodo] = valor
+    
+    return dados
+
+# Função para aplicar os cálculos automáticos (COGS, rotação, janelas móveis e variações)
+def calcular_dados(dados):
+    dados = atualizar_cogs(dados)
+    dados = atualizar_rotacao(dados)
+    with medir_tempo("calcular_janelas"):
+        dados = janelas.calcular_janelas(dados)
+    with medir_tempo("calcular_variacoes"):
+        dados = variacoes.calcular_variacoes(dados)
+    return dados
+
+# Função para carregar os dados com todos os cálculos, tal como são apresentados pela aplicação
+@medir_tempo("carregar_dados")
+def carregar_dados(conn, linhas_semanais=None):
+    return calcular_dados(ler_dados(conn, linhas_semanais))
@@ -0,0 +1,254 @@
+import numpy as np
+import pandas as pd
+
+import escrita
+import janelas
+import leitura
+import variacoes
+from db_setup import DB_PATH, GRANULARIDADES, PERIODOS_ANALISE, REGIOES, ler_dimensoes
+from rotacao import EixoSemanas
+from tendencias import COMPOSICAO_INDICADORES
+
+# Comparação de cenários: períodos dos dados reais comparados e período simulado nos cenários
+PERIODOS_COMPARACAO = ["Budget", "Real + Projeção", "Introduzido"]
+PERIODO_CENARIO = "Introduzido"
+
+# Indicadores guardados usados na comparação (a Rotação e o COGS são calculados a partir deles)
+INDICADORES_BASE_COMPARACAO = ["Stock Liquido", *COMPOSICAO_INDICADORES["COGS"]]
+INDICADORES_COMPARACAO = ["Stock Liquido", "COGS", "Rotação"]
+
+SQL_LISTAR_CENARIOS = '''
+SELECT nome, COUNT(*) AS celulas, MAX(data_atualizacao) AS data_atualizacao
+FROM cenarios
+GROUP BY nome
+ORDER BY nome
+'''
+
+SQL_LER_CENARIO = '''
+SELECT c.semana, r.nome, g.nome, i.nome, p.nome, c.valor
+FROM cenarios c
+JOIN dim_regiao r ON r.id = c.regiao_id
+JOIN dim_granularidade g ON g.id = c.granularidade_id
+JOIN dim_indicador i ON i.id = c.indicador_id
+JOIN dim_periodo p ON p.id = c.periodo_id
+WHERE c.nome = ?
+ORDER BY c.semana, c.regiao_id, c.granularidade_id, c.indicador_id, c.periodo_id
+'''
+
+SQL_GRAVAR_CELULA_CENARIO = f'''
+INSERT INTO cenarios (nome, semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor, usuario, data_atualizacao)
+VALUES (
+    ?,
+    ?,
+    (SELECT id FROM dim_regiao WHERE nome = ?),
+    (SELECT id FROM dim_granularidade WHERE nome = ?),
+    (SELECT id FROM dim_indicador WHERE nome = ?),
+    (SELECT id FROM dim_periodo WHERE nome = ?),
+    ?,
+    ?,
+    {escrita.SQL_AGORA}
+)
+ON CONFLICT(nome, semana, regiao_id, granularidade_id, indicador_id, periodo_id)
+DO UPDATE SET valor = excluded.valor, usuario = excluded.usuario, data_atualizacao = excluded.data_atualizacao
+WHERE cenarios.valor IS NOT excluded.valor
+'''
+
+SQL_VALORES_COMPARACAO = '''
+SELECT semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor
+FROM dados_stock
+WHERE periodo_id IN ({periodos}) AND indicador_id IN ({indicadores})
+'''
+
+SQL_CELULAS_COMPARACAO = '''
+SELECT nome, semana, regiao_id, granularidade_id, indicador_id, valor
+FROM cenarios
+WHERE periodo_id = ? AND indicador_id IN ({indicadores}) AND nome IN ({nomes})
+'''
+
+def listar_cenarios(db_path=DB_PATH, conn=None):
+    """Cenários guardados: dicts com o nome, o número de células sobrepostas e a última alteração."""
+    with leitura.ligacao(db_path, conn) as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = lambda cursor, linha: {d[0]: v for d, v in zip(cursor.description, linha)}
+        return cursor.execute(SQL_LISTAR_CENARIOS).fetchall()
+
+def ler_cenario(nome, db_path=DB_PATH, conn=None):
+    """Células sobrepostas de um cenário, como tuplos (semana, regiao, granularidade, indicador, periodo, valor)."""
+    with leitura.ligacao(db_path, conn) as conn:
+        return conn.execute(SQL_LER_CENARIO, (nome,)).fetchall()
+
+def _gravar_cenario(nome, celulas, usuario, db_path):
+    conn = escrita.ligar(db_path)
+    try:
+        with escrita.transacao_imediata(conn):
+            conn.executemany(SQL_GRAVAR_CELULA_CENARIO, [(nome, *celula, usuario) for celula in celulas])
+    finally:
+        conn.close()
+
+def gravar_cenario(nome, celulas, usuario='sistema', db_path=DB_PATH):
+    """Grava células (semana, regiao, granularidade, indicador, periodo, valor) num cenário, numa transação.
+
+    Os dados reais (dados_stock) não são alterados: o cenário guarda apenas as células nele alteradas.
+    """
+    escrita.executar_na_fila(_gravar_cenario, nome, celulas, usuario, db_path)
+
+def _apagar_cenario(nome, db_path):
+    conn = escrita.ligar(db_path)
+    try:
+        with escrita.transacao_imediata(conn):
+            return conn.execute('DELETE FROM cenarios WHERE nome = ?', (nome,)).rowcount
+    finally:
+        conn.close()
+
+def apagar_cenario(nome, db_path=DB_PATH):
+    """Apaga todas as células de um cenário; devolve o número de células apagadas."""
+    return escrita.executar_na_fila(_apagar_cenario, nome, db_path)
+
+def recalcular_series(dados, series):
+    """Recalcula COGS, Rotação, janelas móveis e variações semanais das séries (regiao, granularidade) indicadas.
+
+    Tem a mesma semântica que atualizar_cogs e atualizar_rotacao (em carregamento), mas vetorizada e
+    apenas para as séries pedidas, em todas as semanas (a rotação usa o COGS acumulado no ano).
+    """
+    series = sorted(series)
+    eixo = EixoSemanas(dados["semanas"])
+    if not series or not len(eixo):
+        return dados
+
+    # dict.get não passa pelo __missing__ da estrutura esparsa: semanas sem a série ficam None
+    nos = [
+        [dados["semanas"][semana].get(regiao, {}).get(granularidade) for semana in eixo.semanas]
+        for regiao, granularidade in series
+    ]
+
+    def matriz(indicador):
+        # Série × período × semana, com 0 nas células em falta
+        return np.array([
+            [[no[indicador][periodo] if no is not None else 0.0 for no in nos_serie] for periodo in PERIODOS_ANALISE]
+            for nos_serie in nos
+        ])
+
+    componentes = COMPOSICAO_INDICADORES["COGS"]
+    cogs = sum(sinal * matriz(indicador) for indicador, sinal in componentes.items())
+    rotacao = eixo.rotacao(matriz("Stock Liquido"), cogs)
+
+    # Todas as semanas, para que as janelas móveis usem o mesmo eixo que nos dados completos
+    regioes = {regiao for regiao, _ in series}
+    subconjunto = {"semanas": {semana: {regiao: {} for regiao in regioes} for semana in eixo.semanas}, "meses": {}}
+    for s, ((regiao, granularidade), nos_serie) in enumerate(zip(series, nos)):
+        for t, no in enumerate(nos_serie):
+            if no is None:
+                continue
+            if any(componente in no for componente in componentes):
+                no["COGS"].update(zip(PERIODOS_ANALISE, cogs[s, :, t].tolist()))
+            if "Stock Liquido" in no:
+                no["Rotação"].update(zip(PERIODOS_ANALISE, rotacao[s, :, t].tolist()))
+            subconjunto["semanas"][eixo.semanas[t]][regiao][granularidade] = no
+
+    # As janelas móveis e as variações são calculadas sobre os nós das séries afetadas (partilhados com `dados`)
+    janelas.calcular_janelas(subconjunto)
+    variacoes.calcular_variacoes(subconjunto)
+    return dados
+
+def aplicar_cenario(dados, celulas):
+    """Sobrepõe as células de um cenário aos dados carregados e recalcula só as séries afetadas.
+
+    `celulas` são tuplos (semana, regiao, granularidade, indicador, periodo, valor) de regiões e
+    granularidades de base. Os agregados Ibérica e Total das células sobrepostas são somados de
+    novo (como nas views) e COGS, Rotação, janelas e variações recalculados para as séries
+    afetadas, incluindo esses agregados. Os dados mensais não dependem das semanas e não mudam.
+    """
+    afetadas = set()
+    for semana, regiao, granularidade, indicador, periodo, valor in celulas:
+        dados_semana = dados["semanas"][semana]
+        dados_semana[regiao][granularidade][indicador][periodo] = valor
+
+        # Os valores em falta valem 0 (e não são criados pela leitura)
+        dados_semana["Ibérica"][granularidade][indicador][periodo] = sum(
+            dados_semana[r][granularidade][indicador][periodo] for r in REGIOES
+        )
+        dados_semana[regiao]["Total"][indicador][periodo] = sum(
+            dados_semana[regiao][g][indicador][periodo] for g in GRANULARIDADES
+        )
+        afetadas.update([(regiao, granularidade), ("Ibérica", granularidade), (regiao, "Total")])
+
+    return recalcular_series(dados, afetadas)
+
+def _com_agregados(valores):
+    # Acrescenta Ibérica (soma das regiões) e Total (soma das granularidades) aos eixos [..., região, granularidade, semana]
+    valores = np.concatenate([valores, valores.sum(axis=-3, keepdims=True)], axis=-3)
+    return np.concatenate([valores, valores.sum(axis=-2, keepdims=True)], axis=-2)
+
+def comparar_cenarios(nomes, db_path=DB_PATH, conn=None):
+    """Compara o Introduzido de N cenários com Budget, Real + Projeção e o Introduzido dos dados reais.
+
+    As versões (os três períodos e os N cenários) são empilhadas num eixo adicional de uma
+    matriz versão × região × granularidade × indicador × semana; cada cenário parte do Introduzido
+    dos dados reais com as suas células sobrepostas. COGS, agregados Ibérica/Total e Rotação
+    (com a semântica de calcular_rotacao) são calculados para todas as versões de uma só vez,
+    pelo que o custo cresce linearmente com N. Só as células do Introduzido dos cenários contam.
+
+    Devolve um DataFrame (versao, regiao, granularidade, semana) com uma coluna por indicador
+    de INDICADORES_COMPARACAO.
+    """
+    nomes = list(nomes)
+    with leitura.ligacao(db_path, conn) as conn:
+        dimensoes = ler_dimensoes(conn)
+        ids_indicadores = [dimensoes["indicador"].index(indicador) for indicador in INDICADORES_BASE_COMPARACAO]
+        ids_periodos = [dimensoes["periodo"].index(periodo) for periodo in PERIODOS_COMPARACAO]
+        base = conn.execute(
+            SQL_VALORES_COMPARACAO.format(
+                periodos=", ".join("?" for _ in ids_periodos), indicadores=", ".join("?" for _ in ids_indicadores)
+            ),
+            (*ids_periodos, *ids_indicadores)
+        ).fetchall()
+        celulas = conn.execute(
+            SQL_CELULAS_COMPARACAO.format(
+                indicadores=", ".join("?" for _ in ids_indicadores), nomes=", ".join("?" for _ in nomes)
+            ),
+            (dimensoes["periodo"].index(PERIODO_CENARIO), *ids_indicadores, *nomes)
+        ).fetchall() if nomes else []
+
+    # Posições nos eixos a partir dos ids das tabelas de lookup (só regiões e granularidades de base)
+    posicao_regiao = {dimensoes["regiao"].index(regiao): k for k, regiao in enumerate(REGIOES)}
+    posicao_granularidade = {dimensoes["granularidade"].index(granularidade): k for k, granularidade in enumerate(GRANULARIDADES)}
+    posicao_indicador = {id_indicador: k for k, id_indicador in enumerate(ids_indicadores)}
+    posicao_periodo = {id_periodo: k for k, id_periodo in enumerate(ids_periodos)}
+    posicao_cenario = {nome: len(PERIODOS_COMPARACAO) + k for k, nome in enumerate(nomes)}
+
+    eixo = EixoSemanas({linha[0] for linha in base} | {linha[1] for linha in celulas})
+    versoes = PERIODOS_COMPARACAO + [f"{PERIODO_CENARIO} ({nome})" for nome in nomes]
+    valores = np.zeros((len(versoes), len(REGIOES), len(GRANULARIDADES), len(ids_indicadores), len(eixo)))
+
+    def preencher(linhas):
+        # Linhas (versão, semana, regiao_id, granularidade_id, indicador_id, valor), escritas de uma vez
+        celulas = [
+            (versao, posicao_regiao[regiao_id], posicao_granularidade[granularidade_id],
+             posicao_indicador[indicador_id], eixo.posicao[semana], valor)
+            for versao, semana, regiao_id, granularidade_id, indicador_id, valor in linhas
+            if regiao_id in posicao_regiao and granularidade_id in posicao_granularidade
+        ]
+        if celulas:
+            *indices, valores_celulas = zip(*celulas)
+            valores[tuple(np.array(indice) for indice in indices)] = valores_celulas
+
+    preencher((posicao_periodo[p], s, r, g, i, v) for s, r, g, i, p, v in base)
+    # Cada cenário parte do Introduzido dos dados reais
+    valores[len(PERIODOS_COMPARACAO):] = valores[PERIODOS_COMPARACAO.index(PERIODO_CENARIO)]
+    preencher((posicao_cenario[nome], s, r, g, i, v) for nome, s, r, g, i, v in celulas)
+
+    # Todas as versões, regiões, granularidades e semanas de uma vez
+    stock = _com_agregados(valores[..., INDICADORES_BASE_COMPARACAO.index("Stock Liquido"), :])
+    cogs = _com_agregados(sum(
+        sinal * valores[..., INDICADORES_BASE_COMPARACAO.index(indicador), :]
+        for indicador, sinal in COMPOSICAO_INDICADORES["COGS"].items()
+    ))
+    rotacao = eixo.rotacao(stock, cogs)
+
+    indice = pd.MultiIndex.from_product(
+        [versoes, REGIOES + ["Ibérica"], GRANULARIDADES + ["Total"], eixo.semanas],
+        names=["versao", "regiao", "granularidade", "semana"]
+    )
+    return pd.DataFrame(
+        {"Stock Liquido": stock.ravel(), "COGS": cogs.ravel(), "Rotação": rotacao.ravel()}, index=indice
+    ).reset_index()
@@ -2,48 +2,292 @@ import sqlite3
 import os
 import json
 from datetime import datetime, timedelta, date
+from itertools import islice
 import sys
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 # Caminho para o banco de dados
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stock_monitor.db')
 
+# Linhas por chamada a executemany durante a migração
+TAMANHO_LOTE_MIGRACAO = 10000
+
+# Dimensões dos dados introduzidos (Ibérica e Total são calculados pelas views)
+REGIOES = ["PT", "ES Mainland", "ES Canárias"]
+GRANULARIDADES = ["Core", "New Business", "Services + Others", "B2B"]
+INDICADORES = ["Rotação", "Stock Liquido", "Stock Provision", "Stock in Transit", "Stock Bruto", "Vendas", "MFO", "Quebra", "COGS"]
+INDICADORES_CALCULADOS = ["Rotação", "COGS"]
+PERIODOS_ANALISE = ["Budget", "Last Year", "Real + Projeção", "Introduzido"]
+PERIODOS_ACUMULADOS = ["YTD", "EOP"]
+
+# Origem dos valores de Real + Projeção gerados pelo motor de projeção (ver projecao.py); ao
+# contrário das restantes origens, estes valores são substituídos por qualquer valor real
+ORIGEM_PROJECAO = 'projecao'
+
+# Dimensões guardadas como inteiros em dados_stock/dados_stock_mensal, com a tabela de lookup
+# e os rótulos iniciais. O id de cada rótulo é a sua posição (a partir de 0), pelo que serve
+# diretamente de código de categoria (registos.Categorias, pandas.Categorical).
+DIMENSOES_CODIFICADAS = {
+    "regiao": ("dim_regiao", REGIOES + ["Ibérica"]),
+    "granularidade": ("dim_granularidade", GRANULARIDADES + ["Total"]),
+    "indicador": ("dim_indicador", INDICADORES),
+    "periodo": ("dim_periodo", PERIODOS_ANALISE),
+    "periodo_acumulado": ("dim_periodo_acumulado", PERIODOS_ACUMULADOS),
+}
+
+# Posição das dimensões nos tuplos gerados pela migração do JSON
+POSICOES_SEMANAIS = {1: "regiao", 2: "granularidade", 3: "indicador", 4: "periodo"}
+POSICOES_MENSAIS = {1: "regiao", 2: "granularidade", 3: "indicador", 4: "periodo", 5: "periodo_acumulado"}
+
+# Trigger de auditoria de dados_stock (também recriado pela importação em massa)
+SQL_TRIGGER_HISTORICO = '''
+CREATE TRIGGER IF NOT EXISTS tr_dados_stock_alterados
+AFTER UPDATE ON dados_stock
+FOR EACH ROW
+BEGIN
+    INSERT INTO historico_alteracoes (
+        tabela, id_registro, semana_ou_mes, regiao, granularidade, 
+        indicador, periodo, valor_antigo, valor_novo
+    ) VALUES (
+        'dados_stock', NEW.id, NEW.semana,
+        (SELECT nome FROM dim_regiao WHERE id = NEW.regiao_id),
+        (SELECT nome FROM dim_granularidade WHERE id = NEW.granularidade_id),
+        (SELECT nome FROM dim_indicador WHERE id = NEW.indicador_id),
+        (SELECT nome FROM dim_periodo WHERE id = NEW.periodo_id),
+        OLD.valor, NEW.valor
+    );
+END;
+'''
+
+# Inserções e remoções também ficam no histórico (valor antigo ou novo a NULL), para que o estado
+# de dados_stock num instante passado possa ser reconstruído a partir dele (ver reconstrucao.py)
+SQL_TRIGGER_HISTORICO_INSERCAO = '''
+CREATE TRIGGER IF NOT EXISTS tr_dados_stock_inseridos
+AFTER INSERT ON dados_stock
+FOR EACH ROW
+BEGIN
+    INSERT INTO historico_alteracoes (
+        tabela, id_registro, semana_ou_mes, regiao, granularidade,
+        indicador, periodo, valor_antigo, valor_novo
+    ) VALUES (
+        'dados_stock', NEW.id, NEW.semana,
+        (SELECT nome FROM dim_regiao WHERE id = NEW.regiao_id),
+        (SELECT nome FROM dim_granularidade WHERE id = NEW.granularidade_id),
+        (SELECT nome FROM dim_indicador WHERE id = NEW.indicador_id),
+        (SELECT nome FROM dim_periodo WHERE id = NEW.periodo_id),
+        NULL, NEW.valor
+    );
+END;
+'''
+
+SQL_TRIGGER_HISTORICO_REMOCAO = '''
+CREATE TRIGGER IF NOT EXISTS tr_dados_stock_apagados
+AFTER DELETE ON dados_stock
+FOR EACH ROW
+BEGIN
+    INSERT INTO historico_alteracoes (
+        tabela, id_registro, semana_ou_mes, regiao, granularidade,
+        indicador, periodo, valor_antigo, valor_novo
+    ) VALUES (
+        'dados_stock', OLD.id, OLD.semana,
+        (SELECT nome FROM dim_regiao WHERE id = OLD.regiao_id),
+        (SELECT nome FROM dim_granularidade WHERE id = OLD.granularidade_id),
+        (SELECT nome FROM dim_indicador WHERE id = OLD.indicador_id),
+        (SELECT nome FROM dim_periodo WHERE id = OLD.periodo_id),
+        OLD.valor, NULL
+    );
+END;
+'''
+
+# Versão dos dados: uma única linha, incrementada a cada escrita em dados_stock/dados_stock_mensal
+# (pelos triggers seguintes, que ao contrário dos de auditoria nunca são suspensos) e quando o
+# histórico é arquivado ou compactado. É a chave de cache dos leitores (ler_versao_dados), lida
+# sem percorrer nenhuma tabela; `geracao` distingue bases de dados recriadas com o mesmo contador.
+SQL_TABELA_VERSAO_DADOS = '''
+CREATE TABLE IF NOT EXISTS versao_dados (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    geracao TEXT NOT NULL,
+    versao INTEGER NOT NULL DEFAULT 0
+)
+'''
+
+SQL_INCREMENTAR_VERSAO = 'UPDATE versao_dados SET versao = versao + 1 WHERE id = 1'
+
+TRIGGERS_VERSAO = {
+    f"tr_versao_{tabela}_{evento.lower()}": f'''
+CREATE TRIGGER IF NOT EXISTS tr_versao_{tabela}_{evento.lower()}
+AFTER {evento} ON {tabela}
+BEGIN
+    {SQL_INCREMENTAR_VERSAO};
+END;
+'''
+    for tabela in ("dados_stock", "dados_stock_mensal")
+    for evento in ("INSERT", "UPDATE", "DELETE")
+}
+
+# Tabelas com as dimensões codificadas e a respetiva cópia a partir do esquema antigo (em texto)
+SQL_TABELA_DADOS_STOCK = '''
+CREATE TABLE IF NOT EXISTS dados_stock (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    semana TEXT NOT NULL,
+    regiao_id INTEGER NOT NULL REFERENCES dim_regiao(id),
+    granularidade_id INTEGER NOT NULL REFERENCES dim_granularidade(id),
+    indicador_id INTEGER NOT NULL REFERENCES dim_indicador(id),
+    periodo_id INTEGER NOT NULL REFERENCES dim_periodo(id),
+    valor REAL NOT NULL,
+    origem TEXT DEFAULT 'manual',
+    data_atualizacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(semana, regiao_id, granularidade_id, indicador_id, periodo_id)
+)
+'''
+
+SQL_COPIA_DADOS_STOCK = '''
+INSERT INTO dados_stock (id, semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor, origem, data_atualizacao)
+SELECT t.id, t.semana, r.id, g.id, i.id, p.id, t.valor, t.origem, t.data_atualizacao
+FROM dados_stock_texto t
+JOIN dim_regiao r ON r.nome = t.regiao
+JOIN dim_granularidade g ON g.nome = t.granularidade
+JOIN dim_indicador i ON i.nome = t.indicador
+JOIN dim_periodo p ON p.nome = t.periodo
+'''
+
+SQL_TABELA_DADOS_STOCK_MENSAL = '''
+CREATE TABLE IF NOT EXISTS dados_stock_mensal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    mes TEXT NOT NULL,
+    regiao_id INTEGER NOT NULL REFERENCES dim_regiao(id),
+    granularidade_id INTEGER NOT NULL REFERENCES dim_granularidade(id),
+    indicador_id INTEGER NOT NULL REFERENCES dim_indicador(id),
+    periodo_id INTEGER NOT NULL REFERENCES dim_periodo(id),
+    periodo_acumulado_id INTEGER REFERENCES dim_periodo_acumulado(id),
+    valor REAL NOT NULL,
+    calculado BOOLEAN DEFAULT 1,
+    data_atualizacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(mes, regiao_id, granularidade_id, indicador_id, periodo_id, periodo_acumulado_id)
+)
+'''
+
+SQL_COPIA_DADOS_STOCK_MENSAL = '''
+INSERT INTO dados_stock_mensal (id, mes, regiao_id, granularidade_id, indicador_id, periodo_id,
+                                periodo_acumulado_id, valor, calculado, data_atualizacao)
+SELECT t.id, t.mes, r.id, g.id, i.id, p.id, a.id, t.valor, t.calculado, t.data_atualizacao
+FROM dados_stock_mensal_texto t
+JOIN dim_regiao r ON r.nome = t.regiao
+JOIN dim_granularidade g ON g.nome = t.granularidade
+JOIN dim_indicador i ON i.nome = t.indicador
+JOIN dim_periodo p ON p.nome = t.periodo
+LEFT JOIN dim_periodo_acumulado a ON a.nome = t.periodo_acumulado
+'''
+
+def adicionar_coluna_se_ausente(cursor, tabela, coluna, definicao):
+    """Adiciona uma coluna a uma tabela existente (migração de bases de dados antigas)."""
+    colunas = [linha[1] for linha in cursor.execute(f'PRAGMA table_info({tabela})')]
+    if coluna not in colunas:
+        cursor.execute(f'ALTER TABLE {tabela} ADD COLUMN {coluna} {definicao}')
+
+def registar_rotulo(cursor, dimensao, rotulo):
+    """Devolve o id de um rótulo, acrescentando-o à tabela de lookup (com o id seguinte) se não existir."""
+    tabela = DIMENSOES_CODIFICADAS[dimensao][0]
+    cursor.execute(f'INSERT OR IGNORE INTO {tabela} (id, nome) SELECT COUNT(*), ? FROM {tabela}', (rotulo,))
+    return cursor.execute(f'SELECT id FROM {tabela} WHERE nome = ?', (rotulo,)).fetchone()[0]
+
+def ler_dimensoes(conn):
+    """Devolve {dimensão: [rótulos]}, em que a posição de cada rótulo na lista é o seu id."""
+    dimensoes = {}
+    for dimensao, (tabela, _) in DIMENSOES_CODIFICADAS.items():
+        linhas = conn.execute(f'SELECT id, nome FROM {tabela} ORDER BY id').fetchall()
+        if any(id_rotulo != posicao for posicao, (id_rotulo, _) in enumerate(linhas)):
+            raise ValueError(f"Os ids de {tabela} não são contíguos a partir de 0")
+        dimensoes[dimensao] = [nome for _, nome in linhas]
+    return dimensoes
+
+def ler_versao_dados(conn):
+    """Identifica o estado atual dos dados (muda sempre que uma célula semanal ou mensal é escrita
+    ou apagada, e quando o histórico é arquivado ou compactado).
+
+    Serve de chave de cache para agregados calculados a partir da base de dados. Lê só a linha de
+    versao_dados: (geracao, versao).
+    """
+    return conn.execute('SELECT geracao, versao FROM versao_dados WHERE id = 1').fetchone()
+
+def _renomear_tabelas_em_texto(cursor):
+    """Prepara a conversão de bases de dados antigas, com as dimensões guardadas como texto.
+
+    As tabelas antigas passam a <tabela>_texto (as views e o trigger que dependem delas são
+    removidos e recriados depois) e os rótulos que ainda não existam são registados.
+    """
+    tabelas = []
+    for tabela in ('dados_stock', 'dados_stock_mensal'):
+        colunas = [linha[1] for linha in cursor.execute(f'PRAGMA table_info({tabela})')]
+        if 'regiao' in colunas:
+            tabelas.append(tabela)
+    
+    if not tabelas:
+        return tabelas
+    
+    cursor.execute('DROP VIEW IF EXISTS view_iberica_semanal')
+    cursor.execute('DROP VIEW IF EXISTS view_total_semanal')
+    cursor.execute('DROP TRIGGER IF EXISTS tr_dados_stock_alterados')
+    cursor.execute('DROP TRIGGER IF EXISTS tr_dados_stock_inseridos')
+    cursor.execute('DROP TRIGGER IF EXISTS tr_dados_stock_apagados')
+    for nome_trigger in TRIGGERS_VERSAO:
+        cursor.execute(f'DROP TRIGGER IF EXISTS {nome_trigger}')
+    
+    for tabela in tabelas:
+        cursor.execute(f'ALTER TABLE {tabela} RENAME TO {tabela}_texto')
+        colunas = [linha[1] for linha in cursor.execute(f'PRAGMA table_info({tabela}_texto)')]
+        for dimensao in DIMENSOES_CODIFICADAS:
+            if dimensao in colunas:
+                for (rotulo,) in cursor.execute(f'SELECT DISTINCT {dimensao} FROM {tabela}_texto WHERE {dimensao} IS NOT NULL').fetchall():
+                    registar_rotulo(cursor, dimensao, rotulo)
+    
+    return tabelas
+
 def criar_tabelas():
     """Cria as tabelas no banco de dados SQLite."""
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
+    # auto_vacuum incremental permite libertar espaço após a retenção do histórico
+    # (só tem efeito numa base de dados nova, antes de criar a primeira tabela)
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    
+    # WAL: as leituras não bloqueiam a escrita (nem o contrário); o modo fica gravado na base de dados
+    cursor.execute('PRAGMA journal_mode = WAL')
+    
+    # Tudo numa transação: uma conversão do esquema antigo não fica a meio
+    cursor.execute('BEGIN')
+    
+    # Tabelas de lookup das dimensões
+    for dimensao, (tabela, rotulos) in DIMENSOES_CODIFICADAS.items():
+        cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {tabela} (
+            id INTEGER PRIMARY KEY,
+            nome TEXT NOT NULL UNIQUE
+        )
+        ''')
+        for rotulo in rotulos:
+            registar_rotulo(cursor, dimensao, rotulo)
+    
+    tabelas_em_texto = _renomear_tabelas_em_texto(cursor)
+    
     # Tabela dados_stock
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS dados_stock (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        semana TEXT NOT NULL,
-        regiao TEXT NOT NULL,
-        granularidade TEXT NOT NULL,
-        indicador TEXT NOT NULL,
-        periodo TEXT NOT NULL,
-        valor REAL NOT NULL,
-        origem TEXT DEFAULT 'manual',
-        data_atualizacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        UNIQUE(semana, regiao, granularidade, indicador, periodo)
-    )
-    ''')
+    cursor.execute(SQL_TABELA_DADOS_STOCK)
     
     # Tabela dados_stock_mensal
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS dados_stock_mensal (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        mes TEXT NOT NULL,
-        regiao TEXT NOT NULL,
-        granularidade TEXT NOT NULL,
-        indicador TEXT NOT NULL,
-        periodo TEXT NOT NULL,
-        periodo_acumulado TEXT,
-        valor REAL NOT NULL,
-        calculado BOOLEAN DEFAULT 1,
-        data_atualizacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        UNIQUE(mes, regiao, granularidade, indicador, periodo, periodo_acumulado)
-    )
-    ''')
+    cursor.execute(SQL_TABELA_DADOS_STOCK_MENSAL)
+    
+    # Copiar os dados das tabelas antigas (os ids mantêm-se, por causa do histórico)
+    if 'dados_stock' in tabelas_em_texto:
+        cursor.execute(SQL_COPIA_DADOS_STOCK)
+        cursor.execute('DROP TABLE dados_stock_texto')
+    if 'dados_stock_mensal' in tabelas_em_texto:
+        cursor.execute(SQL_COPIA_DADOS_STOCK_MENSAL)
+        cursor.execute('DROP TABLE dados_stock_mensal_texto')
     
     # Tabela historico_alteracoes
     cursor.execute('''
@@ -60,7 +304,89 @@ def criar_tabelas():
         valor_antigo REAL,
         valor_novo REAL,
         usuario TEXT DEFAULT 'sistema',
-        data_alteracao TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        data_alteracao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        lote_id INTEGER REFERENCES lotes_importacao(id)
+    )
+    ''')
+    adicionar_coluna_se_ausente(cursor, 'historico_alteracoes', 'lote_id', 'INTEGER REFERENCES lotes_importacao(id)')
+    
+    # Tabela lotes_importacao (uma entrada por importação em massa)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS lotes_importacao (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        origem TEXT NOT NULL,
+        usuario TEXT DEFAULT 'sistema',
+        linhas_recebidas INTEGER DEFAULT 0,
+        linhas_inseridas INTEGER DEFAULT 0,
+        linhas_alteradas INTEGER DEFAULT 0,
+        data_importacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    
+    # Tabela projecoes_series (estado da última projeção de cada série, ver projecao.py)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS projecoes_series (
+        regiao_id INTEGER NOT NULL REFERENCES dim_regiao(id),
+        granularidade_id INTEGER NOT NULL REFERENCES dim_granularidade(id),
+        indicador_id INTEGER NOT NULL REFERENCES dim_indicador(id),
+        metodo TEXT NOT NULL,
+        assinatura TEXT NOT NULL,
+        ultima_semana_real TEXT,
+        data_projecao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (regiao_id, granularidade_id, indicador_id)
+    )
+    ''')
+    
+    # Tabela cenarios (células de simulação sobrepostas aos dados reais, por cenário, ver cenarios.py)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS cenarios (
+        nome TEXT NOT NULL,
+        semana TEXT NOT NULL,
+        regiao_id INTEGER NOT NULL REFERENCES dim_regiao(id),
+        granularidade_id INTEGER NOT NULL REFERENCES dim_granularidade(id),
+        indicador_id INTEGER NOT NULL REFERENCES dim_indicador(id),
+        periodo_id INTEGER NOT NULL REFERENCES dim_periodo(id),
+        valor REAL NOT NULL,
+        usuario TEXT DEFAULT 'sistema',
+        data_atualizacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (nome, semana, regiao_id, granularidade_id, indicador_id, periodo_id)
+    )
+    ''')
+    
+    # Tabelas pontos_controlo e pontos_controlo_valores (cópias periódicas de dados_stock, a partir
+    # das quais o histórico é revertido para reconstruir um instante passado, ver reconstrucao.py)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS pontos_controlo (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        data_ponto_controlo TIMESTAMP NOT NULL,
+        ultimo_historico INTEGER NOT NULL,
+        celulas INTEGER DEFAULT 0
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS pontos_controlo_valores (
+        ponto_controlo_id INTEGER NOT NULL REFERENCES pontos_controlo(id),
+        id INTEGER NOT NULL,
+        semana TEXT NOT NULL,
+        regiao_id INTEGER NOT NULL,
+        granularidade_id INTEGER NOT NULL,
+        indicador_id INTEGER NOT NULL,
+        periodo_id INTEGER NOT NULL,
+        valor REAL NOT NULL,
+        data_atualizacao TIMESTAMP,
+        PRIMARY KEY (ponto_controlo_id, id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pontos_controlo_data ON pontos_controlo(data_ponto_controlo)')
+    
+    # Tabela compactacoes_historico (limites das compactações do histórico, ver retencao.py: antes do
+    # limite só resta a última alteração de cada célula em cada dia, e a reconstrução é por dia)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS compactacoes_historico (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        data_compactacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        data_limite TIMESTAMP NOT NULL,
+        colapsadas INTEGER DEFAULT 0
     )
     ''')
     
@@ -77,7 +403,7 @@ def criar_tabelas():
     )
     ''')
     
-    # Tabela configuracao_excel (para fase futura)
+    # Tabela configuracao_excel (folhas importadas / sincronizadas, ver sincronizacao.py)
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS configuracao_excel (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -89,77 +415,91 @@ def criar_tabelas():
         mapeamento_colunas TEXT,
         ultima_sincronizacao TIMESTAMP,
         intervalo_sincronizacao INTEGER DEFAULT 604800,
-        ativo BOOLEAN DEFAULT 1
+        ativo BOOLEAN DEFAULT 1,
+        assinatura_arquivo TEXT,
+        hash_arquivo TEXT
     )
     ''')
+    # Assinatura (mtime e tamanho) e hash do ficheiro na última sincronização
+    adicionar_coluna_se_ausente(cursor, 'configuracao_excel', 'assinatura_arquivo', 'TEXT')
+    adicionar_coluna_se_ausente(cursor, 'configuracao_excel', 'hash_arquivo', 'TEXT')
     
     # Criar índices
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_dados_stock_semana ON dados_stock(semana)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dados_stock_regiao ON dados_stock(regiao)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dados_stock_indicador ON dados_stock(indicador)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dados_stock_regiao ON dados_stock(regiao_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dados_stock_indicador ON dados_stock(indicador_id)')
     
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_dados_stock_mensal_mes ON dados_stock_mensal(mes)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dados_stock_mensal_regiao ON dados_stock_mensal(regiao)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dados_stock_mensal_indicador ON dados_stock_mensal(indicador)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dados_stock_mensal_regiao ON dados_stock_mensal(regiao_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dados_stock_mensal_indicador ON dados_stock_mensal(indicador_id)')
     
+    # O id (rowid) é a última coluna implícita de cada índice, pelo que estes índices
+    # cobrem a ordenação (data_alteracao, id) usada na paginação por keyset do histórico
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_historico_alteracoes_data ON historico_alteracoes(data_alteracao)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_historico_alteracoes_usuario ON historico_alteracoes(usuario)')
+    cursor.execute('DROP INDEX IF EXISTS idx_historico_alteracoes_usuario')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_historico_alteracoes_usuario_data ON historico_alteracoes(usuario, data_alteracao)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_historico_alteracoes_semana_data ON historico_alteracoes(semana_ou_mes, data_alteracao)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_historico_alteracoes_regiao_data ON historico_alteracoes(regiao, data_alteracao)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_historico_alteracoes_indicador_data ON historico_alteracoes(indicador, data_alteracao)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_historico_alteracoes_lote ON historico_alteracoes(lote_id)')
     
-    # Criar trigger para histórico de alterações
-    cursor.execute('''
-    CREATE TRIGGER IF NOT EXISTS tr_dados_stock_alterados
-    AFTER UPDATE ON dados_stock
-    FOR EACH ROW
-    BEGIN
-        INSERT INTO historico_alteracoes (
-            tabela, id_registro, semana_ou_mes, regiao, granularidade, 
-            indicador, periodo, valor_antigo, valor_novo
-        ) VALUES (
-            'dados_stock', NEW.id, NEW.semana, NEW.regiao, NEW.granularidade,
-            NEW.indicador, NEW.periodo, OLD.valor, NEW.valor
-        );
-    END;
-    ''')
+    # Criar triggers para histórico de alterações (recriados, para acompanhar alterações ao esquema)
+    cursor.execute('DROP TRIGGER IF EXISTS tr_dados_stock_alterados')
+    cursor.execute(SQL_TRIGGER_HISTORICO)
+    cursor.execute('DROP TRIGGER IF EXISTS tr_dados_stock_inseridos')
+    cursor.execute(SQL_TRIGGER_HISTORICO_INSERCAO)
+    cursor.execute('DROP TRIGGER IF EXISTS tr_dados_stock_apagados')
+    cursor.execute(SQL_TRIGGER_HISTORICO_REMOCAO)
     
-    # Criar views
+    # Versão dos dados e triggers que a incrementam
+    cursor.execute(SQL_TABELA_VERSAO_DADOS)
+    cursor.execute("INSERT OR IGNORE INTO versao_dados (id, geracao) VALUES (1, lower(hex(randomblob(8))))")
+    for nome_trigger, sql_trigger in TRIGGERS_VERSAO.items():
+        cursor.execute(f'DROP TRIGGER IF EXISTS {nome_trigger}')
+        cursor.execute(sql_trigger)
+    
+    # Criar views (recriadas sempre, para acompanharem alterações ao esquema)
+    # As views devolvem ids, tal como dados_stock; os rótulos só são descodificados na apresentação
     # View para Região Ibérica
+    cursor.execute('DROP VIEW IF EXISTS view_iberica_semanal')
     cursor.execute('''
-    CREATE VIEW IF NOT EXISTS view_iberica_semanal AS
+    CREATE VIEW view_iberica_semanal AS
     SELECT 
         semana,
-        'Ibérica' AS regiao,
-        granularidade,
-        indicador,
-        periodo,
+        (SELECT id FROM dim_regiao WHERE nome = 'Ibérica') AS regiao_id,
+        granularidade_id,
+        indicador_id,
+        periodo_id,
         SUM(valor) AS valor,
         'calculado' AS origem,
         MAX(data_atualizacao) AS data_atualizacao
     FROM 
         dados_stock
     WHERE 
-        regiao IN ('PT', 'ES Mainland', 'ES Canárias')
+        regiao_id IN (SELECT id FROM dim_regiao WHERE nome IN ('PT', 'ES Mainland', 'ES Canárias'))
     GROUP BY 
-        semana, granularidade, indicador, periodo
+        semana, granularidade_id, indicador_id, periodo_id
     ''')
     
     # View para Granularidade Total
+    cursor.execute('DROP VIEW IF EXISTS view_total_semanal')
     cursor.execute('''
-    CREATE VIEW IF NOT EXISTS view_total_semanal AS
+    CREATE VIEW view_total_semanal AS
     SELECT 
         semana,
-        regiao,
-        'Total' AS granularidade,
-        indicador,
-        periodo,
+        regiao_id,
+        (SELECT id FROM dim_granularidade WHERE nome = 'Total') AS granularidade_id,
+        indicador_id,
+        periodo_id,
         SUM(valor) AS valor,
         'calculado' AS origem,
         MAX(data_atualizacao) AS data_atualizacao
     FROM 
         dados_stock
     WHERE 
-        granularidade IN ('Core', 'New Business', 'Services + Others', 'B2B')
+        granularidade_id IN (SELECT id FROM dim_granularidade WHERE nome IN ('Core', 'New Business', 'Services + Others', 'B2B'))
     GROUP BY 
-        semana, regiao, indicador, periodo
+        semana, regiao_id, indicador_id, periodo_id
     ''')
     
     conn.commit()
@@ -167,24 +507,24 @@ def criar_tabelas():
     
     print("Tabelas, índices, triggers e views criados com sucesso!")
 
-def migrar_dados_json_para_sqlite(json_path):
-    """Migra os dados do arquivo JSON para o banco de dados SQLite."""
-    if not os.path.exists(json_path):
-        print(f"Arquivo JSON não encontrado: {json_path}")
-        return False
-    
-    try:
+def _iterar_secao_json(json_path, secao):
+    """Gera pares (chave, valor) de uma secção de topo do JSON ("semanas" ou "meses").
+
+    Com ijson o ficheiro é lido incrementalmente (uma semana/mês de cada vez);
+    sem ijson recorre a json.load.
+    """
+    if ijson is not None:
+        with open(json_path, 'rb') as f:
+            # use_float evita Decimals e mantém os valores como float
+            yield from ijson.kvitems(f, secao, use_float=True)
+    else:
         with open(json_path, 'r') as f:
             dados = json.load(f)
-    except Exception as e:
-        print(f"Erro ao ler arquivo JSON: {e}")
-        return False
-    
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Migrar dados semanais
-    for semana, dados_semana in dados.get("semanas", {}).items():
+        yield from dados.get(secao, {}).items()
+
+def _linhas_semanais(pares_semanas):
+    """Gera tuplos (semana, regiao, granularidade, indicador, periodo, valor, origem)."""
+    for semana, dados_semana in pares_semanas:
         for regiao, dados_regiao in dados_semana.items():
             if regiao == "Ibérica":
                 continue  # Ibérica é calculada automaticamente via view
@@ -195,24 +535,13 @@ def migrar_dados_json_para_sqlite(json_path):
                 
                 for indicador, dados_indicador in dados_granularidade.items():
                     for periodo, valor in dados_indicador.items():
-                        if isinstance(valor, dict):
-                            # Pular valores aninhados (como períodos acumulados)
-                            continue
-                        
-                        if isinstance(valor, (int, float)):
-                            try:
-                                cursor.execute('''
-                                INSERT INTO dados_stock (semana, regiao, granularidade, indicador, periodo, valor, origem)
-                                VALUES (?, ?, ?, ?, ?, ?, ?)
-                                ON CONFLICT(semana, regiao, granularidade, indicador, periodo) 
-                                DO UPDATE SET valor = excluded.valor, data_atualizacao = CURRENT_TIMESTAMP
-                                ''', (semana, regiao, granularidade, indicador, periodo, valor, 'migrado'))
-                            except Exception as e:
-                                print(f"Erro ao inserir dado semanal: {e}")
-                                print(f"Dados: {semana}, {regiao}, {granularidade}, {indicador}, {periodo}, {valor}")
-    
-    # Migrar dados mensais
-    for mes, dados_mes in dados.get("meses", {}).items():
+                        # Pular valores aninhados (como períodos acumulados) e não numéricos
+                        if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+                            yield (semana, regiao, granularidade, indicador, periodo, float(valor), 'migrado')
+
+def _linhas_mensais(pares_meses):
+    """Gera tuplos (mes, regiao, granularidade, indicador, periodo, periodo_acumulado, valor)."""
+    for mes, dados_mes in pares_meses:
         for regiao, dados_regiao in dados_mes.items():
             if regiao == "Ibérica":
                 continue  # Ibérica é calculada automaticamente
@@ -222,35 +551,111 @@ def migrar_dados_json_para_sqlite(json_path):
                     continue  # Total é calculado automaticamente
                 
                 for indicador, dados_indicador in dados_granularidade.items():
-                    for periodo, valor in dados_indicador.items():
+                    for chave, valor in dados_indicador.items():
                         if isinstance(valor, dict):
-                            # Processar períodos acumulados (YTD, EOP)
-                            for periodo_acumulado, valor_acumulado in valor.items():
-                                if isinstance(valor_acumulado, (int, float)):
-                                    try:
-                                        cursor.execute('''
-                                        INSERT INTO dados_stock_mensal (mes, regiao, granularidade, indicador, periodo, periodo_acumulado, valor)
-                                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                                        ON CONFLICT(mes, regiao, granularidade, indicador, periodo, periodo_acumulado) 
-                                        DO UPDATE SET valor = excluded.valor, data_atualizacao = CURRENT_TIMESTAMP
-                                        ''', (mes, regiao, granularidade, indicador, periodo, periodo_acumulado, valor_acumulado))
-                                    except Exception as e:
-                                        print(f"Erro ao inserir dado mensal acumulado: {e}")
-                        elif isinstance(valor, (int, float)):
-                            try:
-                                cursor.execute('''
-                                INSERT INTO dados_stock_mensal (mes, regiao, granularidade, indicador, periodo, valor)
-                                VALUES (?, ?, ?, ?, ?, ?)
-                                ON CONFLICT(mes, regiao, granularidade, indicador, periodo, periodo_acumulado) 
-                                DO UPDATE SET valor = excluded.valor, data_atualizacao = CURRENT_TIMESTAMP
-                                ''', (mes, regiao, granularidade, indicador, periodo, valor))
-                            except Exception as e:
-                                print(f"Erro ao inserir dado mensal: {e}")
+                            # Períodos acumulados: {"YTD": {"Budget": 1.0, ...}}
+                            for periodo, valor_acumulado in valor.items():
+                                if isinstance(valor_acumulado, (int, float)) and not isinstance(valor_acumulado, bool):
+                                    yield (mes, regiao, granularidade, indicador, periodo, chave, float(valor_acumulado))
+                        elif isinstance(valor, (int, float)) and not isinstance(valor, bool):
+                            yield (mes, regiao, granularidade, indicador, chave, None, float(valor))
+
+def _codificar_linhas(cursor, linhas, posicoes):
+    """Substitui nos tuplos os rótulos das dimensões (dadas por {posição: dimensão}) pelos ids."""
+    codigos = {dimensao: {rotulo: id_rotulo for id_rotulo, rotulo in enumerate(rotulos)}
+               for dimensao, rotulos in ler_dimensoes(cursor.connection).items()}
+    for linha in linhas:
+        linha = list(linha)
+        for posicao, dimensao in posicoes.items():
+            rotulo = linha[posicao]
+            if rotulo is None:
+                continue
+            codigo = codigos[dimensao].get(rotulo)
+            if codigo is None:
+                codigo = codigos[dimensao][rotulo] = registar_rotulo(cursor, dimensao, rotulo)
+            linha[posicao] = codigo
+        yield linha
+
+def _executar_em_lotes(cursor, sql, linhas, tamanho_lote, progresso, descricao):
+    total = 0
+    while True:
+        lote = list(islice(linhas, tamanho_lote))
+        if not lote:
+            break
+        cursor.executemany(sql, lote)
+        total += len(lote)
+        if progresso:
+            progresso(descricao, total)
+    return total
+
+def _imprimir_progresso(descricao, total):
+    print(f"  {descricao}: {total} valores migrados", end="\r")
+
+def _migrar_json(json_path, progresso, tamanho_lote, db_path):
+    # Importado aqui: o escrita importa o db_setup
+    import escrita
     
-    conn.commit()
-    conn.close()
+    conn = escrita.ligar(db_path)
+    cursor = conn.cursor()
+    try:
+        with escrita.transacao_imediata(conn):
+            # Os valores migrados são o estado inicial: as inserções não ficam no histórico
+            cursor.execute('DROP TRIGGER IF EXISTS tr_dados_stock_inseridos')
+            try:
+                # Migrar dados semanais
+                total_semanal = _executar_em_lotes(cursor, '''
+                    INSERT INTO dados_stock (semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor, origem)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(semana, regiao_id, granularidade_id, indicador_id, periodo_id) 
+                    DO UPDATE SET valor = excluded.valor, data_atualizacao = CURRENT_TIMESTAMP
+                    ''', _codificar_linhas(cursor, _linhas_semanais(_iterar_secao_json(json_path, "semanas")), POSICOES_SEMANAIS),
+                    tamanho_lote, progresso, "Dados semanais")
+                
+                # Migrar dados mensais
+                total_mensal = _executar_em_lotes(cursor, '''
+                    INSERT INTO dados_stock_mensal (mes, regiao_id, granularidade_id, indicador_id, periodo_id, periodo_acumulado_id, valor)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(mes, regiao_id, granularidade_id, indicador_id, periodo_id, periodo_acumulado_id) 
+                    DO UPDATE SET valor = excluded.valor, data_atualizacao = CURRENT_TIMESTAMP
+                    ''', _codificar_linhas(cursor, _linhas_mensais(_iterar_secao_json(json_path, "meses")), POSICOES_MENSAIS),
+                    tamanho_lote, progresso, "Dados mensais")
+            finally:
+                cursor.execute(SQL_TRIGGER_HISTORICO_INSERCAO)
+        
+        # Verificação final de integridade
+        integridade = cursor.execute('PRAGMA integrity_check').fetchall()
+    finally:
+        conn.close()
+    
+    return total_semanal, total_mensal, integridade
+
+def migrar_dados_json_para_sqlite(json_path, progresso=_imprimir_progresso, tamanho_lote=TAMANHO_LOTE_MIGRACAO):
+    """Migra os dados do arquivo JSON para o banco de dados SQLite.
+
+    O JSON é lido de forma incremental e os valores são escritos com executemany em lotes, numa
+    única transação (escrita.transacao_imediata) na fila de escrita: as escritas concorrentes
+    esperam pelo fim da migração e, se algo falhar, nada é gravado. No final é executado um
+    PRAGMA integrity_check.
+    """
+    import escrita
+    
+    if not os.path.exists(json_path):
+        print(f"Arquivo JSON não encontrado: {json_path}")
+        return False
+    
+    try:
+        total_semanal, total_mensal, integridade = escrita.executar_na_fila(
+            _migrar_json, json_path, progresso, tamanho_lote, DB_PATH
+        )
+    except Exception as e:
+        print(f"\nErro ao migrar dados do arquivo JSON: {e}")
+        return False
+    
+    if integridade != [("ok",)]:
+        print(f"\nVerificação de integridade falhou: {integridade[:10]}")
+        return False
     
-    print("Migração de dados concluída com sucesso!")
+    print(f"\nMigração de dados concluída com sucesso! ({total_semanal} valores semanais, {total_mensal} valores mensais)")
     return True
 
 def adicionar_usuario_padrao():
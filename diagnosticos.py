@@ -0,0 +1,132 @@
+import json
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+# Capacidade dos buffers circulares em memória
+CAPACIDADE_TEMPOS = 5000
+CAPACIDADE_EXECUCOES = 50
+
+# Buffers partilhados por todas as sessões do processo Streamlit
+_tempos = deque(maxlen=CAPACIDADE_TEMPOS)
+_execucoes = deque(maxlen=CAPACIDADE_EXECUCOES)
+_lock = threading.Lock()
+
+# Cada sessão Streamlit executa o script na sua própria thread
+_local = threading.local()
+_contador_execucoes = 0
+
+def iniciar_execucao(pagina=None):
+    """Marca o início de uma execução (rerun) do script na thread atual."""
+    global _contador_execucoes
+    with _lock:
+        _contador_execucoes += 1
+        execucao_id = _contador_execucoes
+    _local.execucao = {
+        "id": execucao_id,
+        "pagina": pagina,
+        "inicio": datetime.now().isoformat(timespec="seconds"),
+        "inicio_perf": time.perf_counter(),
+        "etapas": {},
+    }
+    return execucao_id
+
+def terminar_execucao(pagina=None):
+    """Fecha a execução atual e guarda-a no buffer de execuções."""
+    execucao = getattr(_local, "execucao", None)
+    if execucao is None:
+        return None
+    _local.execucao = None
+
+    registo = {
+        "id": execucao["id"],
+        "pagina": pagina or execucao["pagina"],
+        "inicio": execucao["inicio"],
+        "total_ms": round((time.perf_counter() - execucao["inicio_perf"]) * 1000, 3),
+        "etapas": {etapa: round(ms, 3) for etapa, ms in execucao["etapas"].items()},
+    }
+    with _lock:
+        _execucoes.append(registo)
+    return registo
+
+def registar_tempo(etapa, duracao_ms):
+    """Regista a duração de uma etapa no buffer circular."""
+    execucao = getattr(_local, "execucao", None)
+    execucao_id = None
+    if execucao is not None:
+        execucao_id = execucao["id"]
+        execucao["etapas"][etapa] = execucao["etapas"].get(etapa, 0.0) + duracao_ms
+    with _lock:
+        _tempos.append((etapa, duracao_ms, execucao_id, time.time()))
+
+@contextmanager
+def medir_tempo(etapa):
+    """Mede a duração de um bloco; pode ser usado como `with` ou como decorador."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registar_tempo(etapa, (time.perf_counter() - inicio) * 1000)
+
+def _percentil(valores_ordenados, percentil):
+    # Método nearest-rank sobre uma lista já ordenada
+    if not valores_ordenados:
+        return 0.0
+    indice = max(0, math.ceil(percentil / 100 * len(valores_ordenados)) - 1)
+    return valores_ordenados[indice]
+
+def estatisticas_por_etapa():
+    """Devolve chamadas, p50, p95, média e total (ms) para cada etapa medida."""
+    with _lock:
+        tempos = list(_tempos)
+
+    por_etapa = {}
+    for etapa, duracao_ms, _, _ in tempos:
+        por_etapa.setdefault(etapa, []).append(duracao_ms)
+
+    estatisticas = []
+    for etapa, duracoes in por_etapa.items():
+        duracoes.sort()
+        total = sum(duracoes)
+        estatisticas.append({
+            "Etapa": etapa,
+            "Chamadas": len(duracoes),
+            "p50 (ms)": round(_percentil(duracoes, 50), 3),
+            "p95 (ms)": round(_percentil(duracoes, 95), 3),
+            "Média (ms)": round(total / len(duracoes), 3),
+            "Total (ms)": round(total, 3),
+        })
+
+    estatisticas.sort(key=lambda e: e["Total (ms)"], reverse=True)
+    return estatisticas
+
+def ultimas_execucoes(n=10):
+    """Devolve as últimas n execuções, da mais recente para a mais antiga."""
+    with _lock:
+        execucoes = list(_execucoes)
+    return execucoes[::-1][:n]
+
+def exportar_json():
+    """Exporta estatísticas, execuções e tempos brutos em JSON."""
+    with _lock:
+        tempos = list(_tempos)
+        execucoes = list(_execucoes)
+
+    return json.dumps({
+        "gerado_em": datetime.now().isoformat(timespec="seconds"),
+        "estatisticas": estatisticas_por_etapa(),
+        "execucoes": execucoes,
+        "tempos": [
+            {"etapa": etapa, "duracao_ms": round(duracao_ms, 3), "execucao": execucao_id, "timestamp": timestamp}
+            for etapa, duracao_ms, execucao_id, timestamp in tempos
+        ],
+    }, indent=4, ensure_ascii=False)
+
+def limpar():
+    """Esvazia os buffers de tempos e execuções."""
+    with _lock:
+        _tempos.clear()
+        _execucoes.clear()
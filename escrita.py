@@ -0,0 +1,167 @@
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import tarefas
+from db_setup import DB_PATH, ORIGEM_PROJECAO
+
+# Tempo (segundos) que uma ligação espera por um lock antes de falhar (busy_timeout)
+TEMPO_ESPERA_OCUPADO = 10.0
+
+# Tentativas de BEGIN IMMEDIATE quando a base de dados continua ocupada após o busy_timeout
+TENTATIVAS_ESCRITA = 5
+ESPERA_INICIAL_S = 0.05
+
+# Chave da fila de escrita do processo (todas as escritas na base de dados passam por ela)
+CHAVE_ESCRITA_BD = f"escrita:{DB_PATH}"
+
+# Versão gravada em data_atualizacao (com milissegundos, para distinguir edições próximas)
+SQL_AGORA = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+SQL_VERSAO_CELULA = '''
+SELECT d.valor, d.data_atualizacao
+FROM dados_stock d
+JOIN dim_regiao r ON r.id = d.regiao_id
+JOIN dim_granularidade g ON g.id = d.granularidade_id
+JOIN dim_indicador i ON i.id = d.indicador_id
+JOIN dim_periodo p ON p.id = d.periodo_id
+WHERE d.semana = ? AND r.nome = ? AND g.nome = ? AND i.nome = ? AND p.nome = ?
+'''
+
+SQL_GRAVAR_CELULA = f'''
+INSERT INTO dados_stock (semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor, data_atualizacao)
+VALUES (
+    ?,
+    (SELECT id FROM dim_regiao WHERE nome = ?),
+    (SELECT id FROM dim_granularidade WHERE nome = ?),
+    (SELECT id FROM dim_indicador WHERE nome = ?),
+    (SELECT id FROM dim_periodo WHERE nome = ?),
+    ?,
+    {SQL_AGORA}
+)
+ON CONFLICT(semana, regiao_id, granularidade_id, indicador_id, periodo_id)
+DO UPDATE SET valor = excluded.valor, origem = excluded.origem, data_atualizacao = excluded.data_atualizacao
+WHERE dados_stock.valor IS NOT excluded.valor OR dados_stock.origem = '{ORIGEM_PROJECAO}'
+'''
+
+class ConflitoEdicao(Exception):
+    """Uma ou mais células foram alteradas por outro utilizador depois de terem sido lidas."""
+
+    def __init__(self, conflitos):
+        super().__init__(f"{len(conflitos)} célula(s) alterada(s) por outro utilizador")
+        # Lista de dicts com a célula, o valor lido, o valor atual e o valor que se pretendia gravar
+        self.conflitos = conflitos
+
+def ligar(db_path=DB_PATH):
+    """Abre uma ligação em modo autocommit, com busy_timeout, para ser usada com transacao_imediata."""
+    return sqlite3.connect(db_path, timeout=TEMPO_ESPERA_OCUPADO, isolation_level=None)
+
+def _base_ocupada(erro):
+    mensagem = str(erro).lower()
+    return "locked" in mensagem or "busy" in mensagem
+
+@contextmanager
+def transacao_imediata(conn, tentativas=TENTATIVAS_ESCRITA):
+    """Transação BEGIN IMMEDIATE (o lock de escrita é obtido logo no início).
+
+    Se a base de dados continuar ocupada depois do busy_timeout, o BEGIN é repetido com
+    espera exponencial (com jitter). Faz COMMIT no fim do bloco e ROLLBACK em caso de erro.
+    """
+    espera = ESPERA_INICIAL_S
+    for tentativa in range(1, tentativas + 1):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            break
+        except sqlite3.OperationalError as e:
+            if not _base_ocupada(e) or tentativa == tentativas:
+                raise
+            time.sleep(espera + random.uniform(0, espera))
+            espera *= 2
+
+    try:
+        yield conn
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+
+def executar_na_fila(funcao, *args, chave=CHAVE_ESCRITA_BD, **kwargs):
+    """Executa funcao(*args, **kwargs) na fila de escrita de `chave` e espera pelo resultado.
+
+    As escritas das várias sessões do processo ficam assim serializadas (sem competirem pelo
+    lock do SQLite); as exceções da função são relançadas na thread que a chamou.
+    """
+    if tarefas.na_fila(chave):
+        # Já estamos na thread da fila (escrita chamada a partir de outra escrita)
+        return funcao(*args, **kwargs)
+
+    # O resultado fica do lado de quem submete: o registo de tarefas pode já ter descartado a
+    # tarefa (CAPACIDADE_TERMINADAS) quando esta thread a vai ler
+    saida = {}
+    terminada = threading.Event()
+
+    def executar(progresso):
+        try:
+            saida["resultado"] = funcao(*args, **kwargs)
+        except Exception as e:
+            saida["excecao"] = e
+            raise
+        finally:
+            terminada.set()
+
+    tarefas.submeter(chave, executar, descricao=getattr(funcao, "__name__", "escrita"))
+    terminada.wait()
+    if "excecao" in saida:
+        raise saida["excecao"]
+    return saida["resultado"]
+
+def ler_versoes(conn, celulas):
+    """Devolve {célula: (valor, data_atualizacao)} para tuplos (semana, regiao, granularidade, indicador, periodo).
+
+    Células que ainda não existem ficam com (None, None).
+    """
+    versoes = {}
+    for celula in celulas:
+        linha = conn.execute(SQL_VERSAO_CELULA, celula).fetchone()
+        versoes[celula] = tuple(linha) if linha else (None, None)
+    return versoes
+
+def _gravar_celulas(celulas, db_path):
+    conn = ligar(db_path)
+    try:
+        with transacao_imediata(conn):
+            # Verificação otimista: a versão atual tem de ser a que foi lida, a não ser que o
+            # valor atual já seja o que se pretende gravar (edições iguais não entram em conflito)
+            conflitos = []
+            for *celula, valor, versao_lida in celulas:
+                valor_atual, versao_atual = ler_versoes(conn, [tuple(celula)])[tuple(celula)]
+                if versao_atual != versao_lida and valor_atual != valor:
+                    conflitos.append({
+                        "celula": tuple(celula),
+                        "versao_lida": versao_lida,
+                        "versao_atual": versao_atual,
+                        "valor_atual": valor_atual,
+                        "valor_novo": valor,
+                    })
+
+            if conflitos:
+                raise ConflitoEdicao(conflitos)
+
+            conn.executemany(SQL_GRAVAR_CELULA, [(*celula, valor) for *celula, valor, _ in celulas])
+
+        return ler_versoes(conn, [tuple(celula) for *celula, _, _ in celulas])
+
+    finally:
+        conn.close()
+
+def gravar_celulas(celulas, db_path=DB_PATH):
+    """Grava células (semana, regiao, granularidade, indicador, periodo, valor, versao_lida) numa transação.
+
+    `versao_lida` é o data_atualizacao visto quando o valor foi mostrado ao utilizador (None para
+    células que não existiam). Se alguma célula tiver mudado entretanto, nada é gravado e é
+    lançado ConflitoEdicao. Devolve as novas versões das células gravadas.
+    """
+    return executar_na_fila(_gravar_celulas, celulas, db_path)
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+
+PERIODOS_ACUMULADOS = ["YTD", "EOP"]
+
+class NoEsparso(dict):
+    """Nível da estrutura de dados que só materializa células quando são escritas.
+
+    Ler uma chave inexistente devolve um nó vazio desligado (ou 0.0 no último nível),
+    sem alterar a estrutura; o nó só é ligado ao pai quando lhe é atribuído um valor.
+    Assim, dados["semanas"][s][r][g][i][p] devolve 0.0 para células em falta e
+    a atribuição dados["semanas"][s][r][g][i][p] = v cria apenas o caminho necessário.
+
+    Nota: duas leituras da mesma chave em falta devolvem nós desligados distintos;
+    escrever em ambos faz prevalecer o último a ser ligado.
+    """
+
+    __slots__ = ("profundidade", "_pai", "_chave")
+
+    def __init__(self, profundidade, *args, pai=None, chave=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Número de níveis de dicionário abaixo deste (0 = nível do indicador, com valores float)
+        self.profundidade = profundidade
+        self._pai = pai
+        self._chave = chave
+
+    def __missing__(self, chave):
+        if self.profundidade > 0:
+            return NoEsparso(self.profundidade - 1, pai=self, chave=chave)
+        if chave in PERIODOS_ACUMULADOS:
+            # Períodos acumulados (YTD/EOP) são um dicionário de períodos dentro do indicador
+            return NoEsparso(0, pai=self, chave=chave)
+        return 0.0
+
+    def _ligar(self):
+        if self._pai is not None:
+            pai, self._pai = self._pai, None
+            pai[self._chave] = self
+
+    def __setitem__(self, chave, valor):
+        super().__setitem__(chave, valor)
+        self._ligar()
+
+    def setdefault(self, chave, valor=None):
+        if chave not in self:
+            self[chave] = valor
+        return dict.__getitem__(self, chave)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        if len(self):
+            self._ligar()
+
+    def __reduce__(self):
+        return (self.__class__, (self.profundidade, dict(self)))
+
+def para_esparso(valor, profundidade):
+    """Converte (recursivamente) dicionários simples, por ex. lidos de JSON, em NoEsparso."""
+    if not isinstance(valor, dict):
+        return valor
+    filhos_profundidade = max(profundidade - 1, 0)
+    return NoEsparso(profundidade, {chave: para_esparso(filho, filhos_profundidade) for chave, filho in valor.items()})
+
+def criar_dados_esparsos(niveis, dados=None):
+    """Cria (ou converte) a estrutura {"semanas": ..., "meses": ...} com `niveis` níveis até ao indicador."""
+    dados = dados or {}
+    return {
+        "semanas": para_esparso(dados.get("semanas", {}), niveis),
+        "meses": para_esparso(dados.get("meses", {}), niveis),
+    }
+
+def semanas_do_ano(ano=None):
+    """Lista as chaves de semana (YYYY-WXX) de um ano, sem alocar dados."""
+    ano = ano or datetime.now().year
+    return [f"{ano}-W{semana:02d}" for semana in range(1, 53)]
+
+def meses_do_ano(ano=None):
+    """Lista as chaves de mês (YYYY-MM) de um ano, sem alocar dados."""
+    ano = ano or datetime.now().year
+    return [f"{ano}-{mes:02d}" for mes in range(1, 13)]
+
+def proximas_semanas(n, inicio=None):
+    """Lista as chaves das próximas n semanas a partir de hoje."""
+    inicio = inicio or datetime.now()
+    return [(inicio + timedelta(weeks=i)).strftime("%Y-W%W") for i in range(n)]
+
+def proximos_meses(n, inicio=None):
+    """Lista as chaves dos próximos n meses a partir do mês atual."""
+    inicio = inicio or datetime.now()
+    # Por mês de calendário (somar dias desliza e acaba por saltar meses)
+    meses = [divmod(inicio.year * 12 + inicio.month - 1 + i, 12) for i in range(n)]
+    return [f"{ano}-{mes + 1:02d}" for ano, mes in meses]
+
+def segunda_feira(semana):
+    """Data da segunda-feira de uma semana YYYY-WXX (semanas %W, como em calcular_dias_acumulados)."""
+    ano, numero = semana.split("-W")
+    return datetime.strptime(f"{ano}-{numero}-1", "%Y-%W-%w").date()
+
+def opcoes_periodo(dados_periodo, chaves_padrao):
+    """Chaves de semana/mês para seleção: as que têm dados e as do calendário por omissão."""
+    return sorted(set(dados_periodo) | set(chaves_padrao))
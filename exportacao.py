@@ -0,0 +1,231 @@
+import csv
+import io
+import tempfile
+from itertools import islice
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # opcional: só é necessário para exportar em Parquet
+    pa = pq = None
+
+try:
+    import xlsxwriter
+except ImportError:  # opcional: só é necessário para exportar em Excel
+    xlsxwriter = None
+
+import leitura
+from db_setup import DB_PATH, INDICADORES, INDICADORES_CALCULADOS, PERIODOS_ACUMULADOS, PERIODOS_ANALISE
+from janelas import INDICADORES_JANELA
+from variacoes import PERIODOS_VARIACAO
+
+# Linhas lidas do cursor (e escritas no ficheiro) de cada vez
+TAMANHO_LOTE = 5000
+
+# Formatos de exportação e respetivos tipos MIME
+FORMATOS = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+COLUNAS = {
+    "semanas": ["Semana", "Região", "Granularidade", "Indicador", "Periodo", "Valor"],
+    "meses": ["Mês", "Região", "Granularidade", "Indicador", "Periodo", "Periodo Acumulado", "Valor"],
+}
+
+# Dados semanais (incluindo os agregados Ibérica e Total das views) com os rótulos descodificados
+SQL_SEMANAL = '''
+SELECT d.semana, r.nome, g.nome, i.nome, p.nome, d.valor
+FROM (
+    SELECT semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor FROM dados_stock
+    UNION ALL
+    SELECT semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor FROM view_iberica_semanal
+    UNION ALL
+    SELECT semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor FROM view_total_semanal
+) d
+JOIN dim_regiao r ON r.id = d.regiao_id
+JOIN dim_granularidade g ON g.id = d.granularidade_id
+JOIN dim_indicador i ON i.id = d.indicador_id
+JOIN dim_periodo p ON p.id = d.periodo_id
+{where}
+ORDER BY d.semana, d.regiao_id, d.granularidade_id, d.indicador_id, d.periodo_id
+'''
+
+SQL_MENSAL = '''
+SELECT d.mes, r.nome, g.nome, i.nome, p.nome, a.nome, d.valor
+FROM dados_stock_mensal d
+JOIN dim_regiao r ON r.id = d.regiao_id
+JOIN dim_granularidade g ON g.id = d.granularidade_id
+JOIN dim_indicador i ON i.id = d.indicador_id
+JOIN dim_periodo p ON p.id = d.periodo_id
+LEFT JOIN dim_periodo_acumulado a ON a.id = d.periodo_acumulado_id
+{where}
+ORDER BY d.mes, d.regiao_id, d.granularidade_id, d.indicador_id, d.periodo_id, d.periodo_acumulado_id
+'''
+
+def formatos_disponiveis():
+    """Formatos que podem ser gerados com as bibliotecas instaladas (CSV está sempre disponível)."""
+    disponiveis = ["csv"]
+    if pq is not None:
+        disponiveis.append("parquet")
+    if xlsxwriter is not None:
+        disponiveis.append("xlsx")
+    return disponiveis
+
+def _condicoes(tipo, regioes, granularidades, indicadores, periodos, anos):
+    coluna_tempo = "d.semana" if tipo == "semanas" else "d.mes"
+    condicoes = []
+    parametros = []
+
+    # Intervalos por ano (usam o índice da semana/mês em vez de um LIKE por linha)
+    if anos:
+        condicoes.append("(" + " OR ".join(f"({coluna_tempo} >= ? AND {coluna_tempo} < ?)" for _ in anos) + ")")
+        for ano in anos:
+            parametros.extend([f"{ano}-", f"{int(ano) + 1}-"])
+
+    for coluna, valores in [("r.nome", regioes), ("g.nome", granularidades), ("i.nome", indicadores), ("p.nome", periodos)]:
+        if valores:
+            condicoes.append(f"{coluna} IN ({', '.join('?' for _ in valores)})")
+            parametros.extend(valores)
+
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+    return where, parametros
+
+def linhas_bd(tipo, regioes=None, granularidades=None, indicadores=None, periodos=None, anos=None,
+              db_path=DB_PATH, tamanho_lote=TAMANHO_LOTE, conn=None):
+    """Gera as linhas guardadas na base de dados para o recorte pedido, lidas do cursor em lotes.
+
+    `tipo` é "semanas" ou "meses"; filtros a None incluem todos os valores. Os indicadores
+    calculados (COGS, Rotação) não estão guardados: ver linhas_cubo. Com `conn` (por ex. a de um
+    leitura.Instantaneo) a consulta usa essa ligação.
+    """
+    where, parametros = _condicoes(tipo, regioes, granularidades, indicadores, periodos, anos)
+    sql = (SQL_SEMANAL if tipo == "semanas" else SQL_MENSAL).format(where=where)
+
+    with leitura.ligacao(db_path, conn) as conn:
+        cursor = conn.execute(sql, parametros)
+        while True:
+            lote = cursor.fetchmany(tamanho_lote)
+            if not lote:
+                break
+            yield from lote
+
+def linhas_cubo(dados, tipo, regioes=None, granularidades=None, indicadores=None, periodos=None, anos=None,
+                chaves=None):
+    """Gera as linhas do recorte pedido a partir da estrutura em memória (incluindo indicadores calculados).
+
+    Só são devolvidas as células existentes (as que faltam na estrutura esparsa valem 0 e são omitidas).
+    `chaves` limita o recorte a algumas semanas ou meses.
+    """
+    anos = {str(ano) for ano in anos} if anos else None
+    for chave in sorted(dados[tipo] if chaves is None else set(chaves) & set(dados[tipo])):
+        if anos and chave[:4] not in anos:
+            continue
+        dados_chave = dados[tipo][chave]
+        for regiao in regioes or list(dados_chave):
+            if regiao not in dados_chave:
+                continue
+            for granularidade in granularidades or list(dados_chave[regiao]):
+                if granularidade not in dados_chave[regiao]:
+                    continue
+                dados_granularidade = dados_chave[regiao][granularidade]
+                for indicador in indicadores or list(dados_granularidade):
+                    if indicador not in dados_granularidade:
+                        continue
+                    dados_indicador = dados_granularidade[indicador]
+                    for periodo in periodos or [p for p in dados_indicador if p not in PERIODOS_ACUMULADOS]:
+                        if periodo not in dados_indicador:
+                            continue
+                        if tipo == "semanas":
+                            yield (chave, regiao, granularidade, indicador, periodo, dados_indicador[periodo])
+                        else:
+                            yield (chave, regiao, granularidade, indicador, periodo, None, dados_indicador[periodo])
+                    if tipo == "meses":
+                        for periodo_acumulado in PERIODOS_ACUMULADOS:
+                            if periodo_acumulado not in dados_indicador:
+                                continue
+                            for periodo in periodos or list(dados_indicador[periodo_acumulado]):
+                                if periodo in dados_indicador[periodo_acumulado]:
+                                    valor = dados_indicador[periodo_acumulado][periodo]
+                                    yield (chave, regiao, granularidade, indicador, periodo, periodo_acumulado, valor)
+
+def linhas_recorte(dados, tipo, regioes=None, granularidades=None, indicadores=None, periodos=None, anos=None,
+                   db_path=DB_PATH, conn=None):
+    """Linhas guardadas lidas da base de dados em streaming, seguidas das calculadas em memória.
+
+    COGS, Rotação, as janelas móveis e as variações (PERIODOS_VARIACAO) não estão guardados e vêm de `dados`.
+    """
+    # Indicadores que só existem em memória: COGS, Rotação e as janelas móveis (semanais)
+    calculados = INDICADORES_CALCULADOS + (INDICADORES_JANELA if tipo == "semanas" else [])
+    indicadores_guardados = [i for i in indicadores if i not in calculados] if indicadores else None
+    indicadores_calculados = [i for i in (indicadores or calculados) if i in calculados]
+    periodos_guardados = [p for p in (periodos or PERIODOS_ANALISE) if p in PERIODOS_ANALISE]
+    periodos_variacao = [p for p in (periodos or PERIODOS_VARIACAO) if p in PERIODOS_VARIACAO]
+
+    if periodos_guardados and (indicadores_guardados is None or indicadores_guardados):
+        linhas = linhas_bd(tipo, regioes, granularidades, indicadores_guardados, periodos_guardados, anos, db_path, conn=conn)
+        for linha in linhas:
+            # Sem filtro de indicadores, os calculados guardados (mensais) vêm da memória
+            if linha[3] not in INDICADORES_CALCULADOS:
+                yield linha
+
+    if dados is None:
+        return
+    if indicadores_calculados:
+        yield from linhas_cubo(
+            dados, tipo, regioes, granularidades, indicadores_calculados, periodos_guardados + periodos_variacao, anos
+        )
+    if periodos_variacao and (indicadores_guardados is None or indicadores_guardados):
+        yield from linhas_cubo(
+            dados, tipo, regioes, granularidades,
+            indicadores_guardados or [i for i in INDICADORES if i not in INDICADORES_CALCULADOS],
+            periodos_variacao, anos
+        )
+
+def _lotes(linhas, tamanho):
+    linhas = iter(linhas)
+    while lote := list(islice(linhas, tamanho)):
+        yield lote
+
+def escrever_csv(linhas, colunas, destino, tamanho_lote=TAMANHO_LOTE):
+    texto = io.TextIOWrapper(destino, encoding="utf-8", newline="")
+    escritor = csv.writer(texto)
+    escritor.writerow(colunas)
+    for lote in _lotes(linhas, tamanho_lote):
+        escritor.writerows(lote)
+    texto.flush()
+    texto.detach()
+
+def escrever_parquet(linhas, colunas, destino, tamanho_lote=TAMANHO_LOTE):
+    if pq is None:
+        raise RuntimeError("A exportação em Parquet requer o pyarrow (pip install pyarrow).")
+    esquema = pa.schema([(coluna, pa.string()) for coluna in colunas[:-1]] + [(colunas[-1], pa.float64())])
+    # Um row group por lote: só um lote está em memória de cada vez
+    with pq.ParquetWriter(destino, esquema) as escritor:
+        for lote in _lotes(linhas, tamanho_lote):
+            escritor.write_table(pa.Table.from_arrays([pa.array(coluna) for coluna in zip(*lote)], schema=esquema))
+
+def escrever_xlsx(linhas, colunas, destino, tamanho_lote=TAMANHO_LOTE):
+    if xlsxwriter is None:
+        raise RuntimeError("A exportação em Excel requer o xlsxwriter (pip install xlsxwriter).")
+    # constant_memory: cada linha é escrita no ficheiro temporário da folha assim que a seguinte começa
+    livro = xlsxwriter.Workbook(destino, {"constant_memory": True, "in_memory": False})
+    folha = livro.add_worksheet("Dados")
+    folha.write_row(0, 0, colunas)
+    for numero, linha in enumerate(linhas, start=1):
+        folha.write_row(numero, 0, linha)
+    livro.close()
+
+ESCRITORES = {"csv": escrever_csv, "parquet": escrever_parquet, "xlsx": escrever_xlsx}
+
+def exportar(linhas, tipo, formato):
+    """Escreve as linhas num ficheiro temporário, lote a lote, e devolve-o aberto no início.
+
+    A memória usada não depende do número de linhas: os lotes vão para o disco à medida que são
+    lidos. O ficheiro pode ser passado diretamente a st.download_button.
+    """
+    destino = tempfile.TemporaryFile()
+    ESCRITORES[formato](linhas, COLUNAS[tipo], destino)
+    destino.seek(0)
+    return destino
@@ -0,0 +1,401 @@
+import csv
+import io
+import json
+import re
+import sqlite3
+
+import pandas as pd
+
+from db_setup import (
+    DB_PATH, REGIOES, GRANULARIDADES, INDICADORES, INDICADORES_CALCULADOS,
+    ORIGEM_PROJECAO, PERIODOS_ANALISE, SQL_TRIGGER_HISTORICO, SQL_TRIGGER_HISTORICO_INSERCAO
+)
+from registos import ColunasStock
+import escrita
+
+# Linhas enviadas de cada vez para a tabela de staging
+TAMANHO_LOTE = 5000
+
+FORMATO_SEMANA = re.compile(r"^\d{4}-W\d{2}$")
+
+INDICADORES_IMPORTAVEIS = [i for i in INDICADORES if i not in INDICADORES_CALCULADOS]
+
+# Formato largo: o que representam os cabeçalhos das colunas de valores
+#   semanas_em_colunas: "2025-W22", "2025-W23", ...
+#   indicadores_em_colunas: "Vendas", ... ou "Vendas | Budget", ... (indicador e período)
+FORMATOS_LARGOS = ["semanas_em_colunas", "indicadores_em_colunas"]
+
+# Dimensões de uma linha importada (pela ordem dos tuplos) e cabeçalhos do formato longo
+DIMENSOES_IMPORTACAO = ["semana", "regiao", "granularidade", "indicador", "periodo"]
+COLUNAS_FORMATO_LONGO = {
+    "Semana": "semana", "Região": "regiao", "Granularidade": "granularidade",
+    "Indicador": "indicador", "Periodo": "periodo"
+}
+
+SEPARADOR_PADRAO = " | "
+
+FORMATO_INTERVALO = re.compile(r"^([A-Z]+)(\d+)(?::([A-Z]+)(\d*))?$")
+
+def validar_linha(semana, regiao, granularidade, indicador, periodo):
+    """Indica se uma linha de importação corresponde a uma célula editável."""
+    return bool(
+        semana and FORMATO_SEMANA.match(semana) and
+        regiao in REGIOES and
+        granularidade in GRANULARIDADES and
+        indicador in INDICADORES_IMPORTAVEIS and
+        periodo in PERIODOS_ANALISE
+    )
+
+def ler_csv_importacao(conteudo_csv, invalidas=None):
+    """Gera tuplos (semana, regiao, granularidade, indicador, periodo, valor) a partir de um CSV longo.
+
+    As linhas inválidas são ignoradas e, se for passada uma lista em `invalidas`, acrescentadas a ela.
+    """
+    csv_reader = csv.DictReader(io.StringIO(conteudo_csv))
+    for numero, row in enumerate(csv_reader, start=2):
+        semana = (row.get("Semana") or "").strip()
+        regiao = (row.get("Região") or "").strip()
+        granularidade = (row.get("Granularidade") or "").strip()
+        indicador = (row.get("Indicador") or "").strip()
+        periodo = (row.get("Periodo") or "").strip()
+
+        try:
+            valor = float(row.get("Valor") or 0)
+        except ValueError:
+            valor = None
+
+        if valor is None or not validar_linha(semana, regiao, granularidade, indicador, periodo):
+            if invalidas is not None:
+                invalidas.append(numero)
+            continue
+
+        yield (semana, regiao, granularidade, indicador, periodo, valor)
+
+def _indice_coluna(letras):
+    indice = 0
+    for letra in letras:
+        indice = indice * 26 + (ord(letra) - ord("A") + 1)
+    return indice - 1
+
+def interpretar_intervalo(intervalo):
+    """Converte um intervalo de células ("B3:N40", "B3:N" ou "B3") em (coluna, linha, coluna_final, linha_final).
+
+    Índices a partir de 0; as posições finais em falta ficam a None (até ao fim da folha).
+    Sem intervalo devolve None.
+    """
+    if not intervalo or not intervalo.strip():
+        return None
+    correspondencia = FORMATO_INTERVALO.match(intervalo.strip().upper().replace("$", ""))
+    if not correspondencia:
+        raise ValueError(f"Intervalo de células inválido: {intervalo}")
+    coluna, linha, coluna_final, linha_final = correspondencia.groups()
+    return (
+        _indice_coluna(coluna),
+        int(linha) - 1,
+        _indice_coluna(coluna_final) if coluna_final else None,
+        int(linha_final) - 1 if linha_final else None,
+    )
+
+def ler_mapeamento(mapeamento):
+    """Lê o mapeamento de colunas (JSON de configuracao_excel.mapeamento_colunas ou dict).
+
+    Chaves: "formato" (um de FORMATOS_LARGOS), "colunas" ({cabeçalho: dimensão} das colunas fixas;
+    por omissão os cabeçalhos do formato longo), "constantes" ({dimensão: valor} para dimensões
+    que não estão na folha) e "separador" (entre indicador e período nos cabeçalhos).
+    """
+    if isinstance(mapeamento, str):
+        mapeamento = json.loads(mapeamento) if mapeamento.strip() else {}
+    mapeamento = dict(mapeamento or {})
+    mapeamento.setdefault("formato", FORMATOS_LARGOS[0])
+    if mapeamento["formato"] not in FORMATOS_LARGOS:
+        raise ValueError(f"Formato largo desconhecido: {mapeamento['formato']}")
+    mapeamento["colunas"] = mapeamento.get("colunas") or COLUNAS_FORMATO_LONGO
+    mapeamento.setdefault("constantes", {})
+    mapeamento.setdefault("separador", SEPARADOR_PADRAO)
+    return mapeamento
+
+def ler_grelha(conteudo, nome_ficheiro, planilha=None, intervalo=None):
+    """Lê uma folha (CSV ou Excel) como texto, limitada ao intervalo; a primeira linha dá os cabeçalhos."""
+    limites = interpretar_intervalo(intervalo)
+    coluna, linha, coluna_final, linha_final = limites or (0, 0, None, None)
+    linhas = None if linha_final is None else linha_final - linha + 1
+
+    if nome_ficheiro.lower().endswith((".xlsx", ".xlsm")):
+        # Com intervalo, só as colunas e linhas configuradas são convertidas pelo pandas
+        usecols = None
+        if limites and coluna_final is not None:
+            usecols = list(range(coluna, coluna_final + 1))
+        grelha = pd.read_excel(
+            io.BytesIO(conteudo), sheet_name=planilha or 0, header=None, dtype=str,
+            skiprows=linha, nrows=linhas, usecols=usecols
+        )
+        if usecols is None:
+            grelha = grelha.iloc[:, coluna:]
+    else:
+        if isinstance(conteudo, bytes):
+            conteudo = conteudo.decode("utf-8")
+        grelha = pd.read_csv(io.StringIO(conteudo), header=None, dtype=str, skiprows=linha, nrows=linhas)
+        grelha = grelha.iloc[:, coluna:None if coluna_final is None else coluna_final + 1]
+
+    return grelha_com_cabecalhos(grelha)
+
+def grelha_com_cabecalhos(grelha):
+    """Remove as linhas vazias e usa a primeira linha (do intervalo) como cabeçalhos."""
+    grelha = grelha.dropna(how="all")
+    if grelha.empty:
+        return pd.DataFrame()
+    cabecalhos = [str(c).strip() if pd.notna(c) else f"_coluna_{i}" for i, c in enumerate(grelha.iloc[0])]
+    grelha = grelha.iloc[1:].set_axis(cabecalhos, axis=1)
+    return grelha.reset_index(drop=True)
+
+def derreter_formato_largo(grelha, mapeamento):
+    """Converte uma grelha larga em linhas longas (DIMENSOES_IMPORTACAO + "valor"), com operações vetoriais.
+
+    Células vazias são ignoradas; devolve (DataFrame, número de valores não numéricos).
+    """
+    mapeamento = ler_mapeamento(mapeamento)
+    colunas_fixas = {c: d for c, d in mapeamento["colunas"].items() if c in grelha.columns}
+    colunas_valores = [c for c in grelha.columns if c not in colunas_fixas and not c.startswith("_coluna_")]
+    if not colunas_valores:
+        raise ValueError("A folha não tem colunas de valores para o mapeamento indicado.")
+
+    longo = grelha.melt(
+        id_vars=list(colunas_fixas), value_vars=colunas_valores,
+        var_name="_cabecalho", value_name="valor"
+    ).rename(columns=colunas_fixas)
+
+    cabecalho = longo.pop("_cabecalho").str.strip()
+    if mapeamento["formato"] == "semanas_em_colunas":
+        longo["semana"] = cabecalho
+    else:
+        partes = cabecalho.str.split(mapeamento["separador"].strip(), n=1, expand=True, regex=False)
+        longo["indicador"] = partes[0].str.strip()
+        if partes.shape[1] > 1:
+            periodo = partes[1].str.strip()
+            longo["periodo"] = periodo.where(periodo.notna(), longo["periodo"]) if "periodo" in longo else periodo
+
+    for dimensao, valor in mapeamento["constantes"].items():
+        if dimensao in longo:
+            longo[dimensao] = longo[dimensao].fillna(valor)
+        else:
+            longo[dimensao] = valor
+
+    for dimensao in DIMENSOES_IMPORTACAO:
+        if dimensao in longo:
+            longo[dimensao] = longo[dimensao].str.strip()
+        else:
+            longo[dimensao] = None
+
+    texto = longo["valor"].str.strip()
+    longo = longo[texto.notna() & (texto != "")]
+    longo = longo.assign(valor=pd.to_numeric(longo["valor"], errors="coerce").astype(float))
+    nao_numericos = int(longo["valor"].isna().sum())
+
+    return longo.dropna(subset=["valor"])[DIMENSOES_IMPORTACAO + ["valor"]].reset_index(drop=True), nao_numericos
+
+def filtrar_linhas_validas(longo):
+    """Separa (vetorialmente) as linhas que correspondem a células editáveis; devolve (válidas, n.º inválidas)."""
+    mascara = (
+        longo["semana"].str.match(FORMATO_SEMANA.pattern, na=False) &
+        longo["regiao"].isin(REGIOES) &
+        longo["granularidade"].isin(GRANULARIDADES) &
+        longo["indicador"].isin(INDICADORES_IMPORTAVEIS) &
+        longo["periodo"].isin(PERIODOS_ANALISE)
+    )
+    return longo[mascara], int((~mascara).sum())
+
+def ler_configuracoes_excel(db_path=DB_PATH, apenas_ativas=True):
+    """Devolve as configurações de folhas (configuracao_excel) como dicts."""
+    conn = escrita.ligar(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        filtro = 'WHERE ativo = 1' if apenas_ativas else ''
+        return [dict(linha) for linha in conn.execute(f'SELECT * FROM configuracao_excel {filtro} ORDER BY id')]
+    finally:
+        conn.close()
+
+def _guardar_configuracao_excel(configuracao_id, campos, db_path):
+    conn = escrita.ligar(db_path)
+    try:
+        with escrita.transacao_imediata(conn):
+            if configuracao_id is None:
+                colunas = ", ".join(campos)
+                marcadores = ", ".join("?" for _ in campos)
+                cursor = conn.execute(f'INSERT INTO configuracao_excel ({colunas}) VALUES ({marcadores})', list(campos.values()))
+                configuracao_id = cursor.lastrowid
+            else:
+                atribuicoes = ", ".join(f"{coluna} = ?" for coluna in campos)
+                conn.execute(f'UPDATE configuracao_excel SET {atribuicoes} WHERE id = ?', [*campos.values(), configuracao_id])
+        return configuracao_id
+    finally:
+        conn.close()
+
+def guardar_configuracao_excel(configuracao_id=None, db_path=DB_PATH, **campos):
+    """Cria (sem id) ou atualiza uma configuração; `mapeamento_colunas` pode ser um dict. Devolve o id."""
+    if isinstance(campos.get("mapeamento_colunas"), dict):
+        campos["mapeamento_colunas"] = json.dumps(campos["mapeamento_colunas"], ensure_ascii=False)
+    return escrita.executar_na_fila(_guardar_configuracao_excel, configuracao_id, campos, db_path)
+
+def _lotes(linhas, tamanho):
+    # Um único buffer em colunas, reutilizado entre lotes (as categorias mantêm-se)
+    lote = ColunasStock()
+    for linha in linhas:
+        lote.acrescentar(*linha)
+        if len(lote) >= tamanho:
+            yield lote
+            lote.limpar()
+    if lote:
+        yield lote
+
+def importar_na_transacao(conn, linhas, usuario='importacao', origem='importacao', preservar_outras_origens=False):
+    """Como importar_em_massa, mas dentro de uma transação já aberta em `conn` (por ex. por
+    escrita.transacao_imediata), para que a importação seja atómica com outras escritas.
+
+    A tabela de staging é temporária (PRAGMA temp_store = MEMORY deve ser definido antes da transação).
+    """
+    cursor = conn.cursor()
+
+    # Tabela de staging (a última linha repetida para a mesma célula prevalece)
+    cursor.execute('''
+    CREATE TEMP TABLE staging_dados_stock (
+        semana TEXT NOT NULL,
+        regiao TEXT NOT NULL,
+        granularidade TEXT NOT NULL,
+        indicador TEXT NOT NULL,
+        periodo TEXT NOT NULL,
+        valor REAL NOT NULL,
+        regiao_id INTEGER,
+        granularidade_id INTEGER,
+        indicador_id INTEGER,
+        periodo_id INTEGER,
+        nova INTEGER DEFAULT 0,
+        PRIMARY KEY (semana, regiao, granularidade, indicador, periodo)
+    ) WITHOUT ROWID
+    ''')
+
+    recebidas = 0
+    for lote in _lotes(linhas, TAMANHO_LOTE):
+        cursor.executemany('''
+        INSERT OR REPLACE INTO temp.staging_dados_stock (semana, regiao, granularidade, indicador, periodo, valor)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', lote)
+        recebidas += len(lote)
+
+    cursor.execute('INSERT INTO lotes_importacao (origem, usuario, linhas_recebidas) VALUES (?, ?, ?)',
+                   (origem, usuario, recebidas))
+    lote_id = cursor.lastrowid
+
+    # Codificar as dimensões com os ids das tabelas de lookup (as linhas já foram validadas)
+    cursor.execute('''
+    UPDATE temp.staging_dados_stock SET
+        regiao_id = (SELECT id FROM dim_regiao WHERE nome = staging_dados_stock.regiao),
+        granularidade_id = (SELECT id FROM dim_granularidade WHERE nome = staging_dados_stock.granularidade),
+        indicador_id = (SELECT id FROM dim_indicador WHERE nome = staging_dados_stock.indicador),
+        periodo_id = (SELECT id FROM dim_periodo WHERE nome = staging_dados_stock.periodo)
+    ''')
+
+    if preservar_outras_origens:
+        cursor.execute('''
+        DELETE FROM temp.staging_dados_stock
+        WHERE EXISTS (
+            SELECT 1 FROM dados_stock d
+            WHERE d.semana = staging_dados_stock.semana AND d.regiao_id = staging_dados_stock.regiao_id
+              AND d.granularidade_id = staging_dados_stock.granularidade_id AND d.indicador_id = staging_dados_stock.indicador_id
+              AND d.periodo_id = staging_dados_stock.periodo_id AND d.origem IS NOT ?
+        )
+        ''', (origem,))
+
+    # Marcar as células que ainda não existem em dados_stock
+    cursor.execute('''
+    UPDATE temp.staging_dados_stock SET nova = 1
+    WHERE NOT EXISTS (
+        SELECT 1 FROM dados_stock d
+        WHERE d.semana = staging_dados_stock.semana AND d.regiao_id = staging_dados_stock.regiao_id
+          AND d.granularidade_id = staging_dados_stock.granularidade_id AND d.indicador_id = staging_dados_stock.indicador_id
+          AND d.periodo_id = staging_dados_stock.periodo_id
+    )
+    ''')
+
+    # Auditoria das células alteradas, antes de escrever (valor antigo ainda disponível); as
+    # projeções substituídas pelo mesmo valor também contam, porque a célula é reescrita
+    cursor.execute(f'''
+    INSERT INTO historico_alteracoes (
+        tabela, id_registro, semana_ou_mes, regiao, granularidade,
+        indicador, periodo, valor_antigo, valor_novo, usuario, lote_id
+    )
+    SELECT 'dados_stock', d.id, s.semana, s.regiao, s.granularidade,
+           s.indicador, s.periodo, d.valor, s.valor, ?, ?
+    FROM temp.staging_dados_stock s
+    JOIN dados_stock d
+      ON d.semana = s.semana AND d.regiao_id = s.regiao_id AND d.granularidade_id = s.granularidade_id
+     AND d.indicador_id = s.indicador_id AND d.periodo_id = s.periodo_id
+    WHERE d.valor IS NOT s.valor
+       OR (d.origem = '{ORIGEM_PROJECAO}' AND d.origem IS NOT ?)
+    ''', (usuario, lote_id, origem))
+    alteradas = cursor.rowcount
+
+    # Suspender a auditoria por linha (o DROP/CREATE é transacional e invisível a outras ligações)
+    cursor.execute('DROP TRIGGER IF EXISTS tr_dados_stock_alterados')
+    cursor.execute('DROP TRIGGER IF EXISTS tr_dados_stock_inseridos')
+
+    cursor.execute(f'''
+    INSERT INTO dados_stock (semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor, origem, data_atualizacao)
+    SELECT semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor, ?, {escrita.SQL_AGORA}
+    FROM temp.staging_dados_stock
+    WHERE true
+    ON CONFLICT(semana, regiao_id, granularidade_id, indicador_id, periodo_id)
+    DO UPDATE SET valor = excluded.valor, origem = excluded.origem, data_atualizacao = excluded.data_atualizacao
+    WHERE dados_stock.valor IS NOT excluded.valor
+       OR (dados_stock.origem = '{ORIGEM_PROJECAO}' AND excluded.origem IS NOT dados_stock.origem)
+    ''', (origem,))
+
+    cursor.execute(SQL_TRIGGER_HISTORICO)
+    cursor.execute(SQL_TRIGGER_HISTORICO_INSERCAO)
+
+    # Auditoria das células novas (sem valor antigo)
+    cursor.execute('''
+    INSERT INTO historico_alteracoes (
+        tabela, id_registro, semana_ou_mes, regiao, granularidade,
+        indicador, periodo, valor_antigo, valor_novo, usuario, lote_id
+    )
+    SELECT 'dados_stock', d.id, s.semana, s.regiao, s.granularidade,
+           s.indicador, s.periodo, NULL, s.valor, ?, ?
+    FROM temp.staging_dados_stock s
+    JOIN dados_stock d
+      ON d.semana = s.semana AND d.regiao_id = s.regiao_id AND d.granularidade_id = s.granularidade_id
+     AND d.indicador_id = s.indicador_id AND d.periodo_id = s.periodo_id
+    WHERE s.nova = 1
+    ''', (usuario, lote_id))
+    inseridas = cursor.rowcount
+
+    cursor.execute('''
+    UPDATE lotes_importacao SET linhas_inseridas = ?, linhas_alteradas = ? WHERE id = ?
+    ''', (inseridas, alteradas, lote_id))
+
+    cursor.execute('DROP TABLE temp.staging_dados_stock')
+
+    return {"lote_id": lote_id, "recebidas": recebidas, "inseridas": inseridas, "alteradas": alteradas}
+
+def importar_em_massa(linhas, usuario='importacao', origem='importacao', db_path=DB_PATH,
+                      preservar_outras_origens=False):
+    """Importa linhas (semana, regiao, granularidade, indicador, periodo, valor) em modo massivo.
+
+    Os triggers de auditoria por linha são suspensos durante a importação; em vez deles, o histórico
+    é escrito de uma só vez por INSERT...SELECT a partir do diff entre a staging e dados_stock,
+    ligado a uma entrada em lotes_importacao. Tudo corre numa única transação (ver
+    importar_na_transacao). Os pontos de controlo para a reconstrução de instantes passados não são
+    criados aqui (copiam dados_stock inteira): correm periodicamente com python reconstrucao.py.
+
+    Com `preservar_outras_origens`, as células que já existem com outra origem não são alteradas
+    (usado pela projeção, que nunca substitui valores reais).
+    """
+    conn = escrita.ligar(db_path)
+    conn.execute('PRAGMA temp_store = MEMORY')
+
+    try:
+        with escrita.transacao_imediata(conn):
+            resultado = importar_na_transacao(conn, linhas, usuario, origem, preservar_outras_origens)
+    finally:
+        conn.close()
+
+    return resultado
@@ -0,0 +1,87 @@
+import numpy as np
+
+from db_setup import PERIODOS_ANALISE
+from estrutura import segunda_feira
+
+# Janelas móveis, em semanas
+JANELAS_SEMANAS = [4, 13, 52]
+
+# Indicadores acrescentados às semanas (um de rotação e um de stock médio por janela)
+INDICADORES_JANELA = [
+    nome
+    for janela in JANELAS_SEMANAS
+    for nome in (f"Rotação {janela}S", f"Stock Liquido Médio {janela}S")
+]
+
+def _somas_moveis(valores, janela):
+    # Soma das últimas `janela` posições do eixo do tempo (último eixo), por diferença de somas acumuladas
+    acumulado = np.concatenate([np.zeros(valores.shape[:-1] + (1,)), np.cumsum(valores, axis=-1)], axis=-1)
+    fim = np.arange(1, valores.shape[-1] + 1)
+    return acumulado[..., fim] - acumulado[..., np.maximum(fim - janela, 0)]
+
+def calcular_janelas(dados, janelas=JANELAS_SEMANAS):
+    """Calcula a rotação e o stock líquido médio em janelas móveis de N semanas para todas as séries.
+
+    Cada série (região × granularidade × período) é colocada num eixo de tempo contínuo de semanas,
+    que atravessa a mudança de ano, e as somas móveis são obtidas em O(N) por diferença de somas
+    acumuladas, para todas as séries de uma vez:
+
+        Rotação NS = (stock líquido médio nas N semanas / COGS das N semanas) × dias das N semanas
+
+    Só as semanas com dados contam para a média e para os dias (no início da série, ou com semanas
+    em falta no calendário, a janela tem menos semanas). Os resultados são gravados em cada
+    semana como indicadores adicionais (INDICADORES_JANELA), tal como o COGS e a Rotação.
+    """
+    semanas = sorted(dados["semanas"], key=segunda_feira)
+    series = sorted({
+        (regiao, granularidade)
+        for dados_semana in dados["semanas"].values()
+        for regiao, dados_regiao in dados_semana.items()
+        for granularidade, dados_granularidade in dados_regiao.items()
+        if "Stock Liquido" in dados_granularidade or "COGS" in dados_granularidade
+    })
+    if not semanas or not series:
+        return dados
+
+    # Posição de cada semana no eixo contínuo
+    inicio = segunda_feira(semanas[0])
+    posicoes = [(segunda_feira(semana) - inicio).days // 7 for semana in semanas]
+    posicao_serie = {serie: i for i, serie in enumerate(series)}
+
+    forma = (len(series), len(PERIODOS_ANALISE), posicoes[-1] + 1)
+    stock = np.zeros(forma)
+    cogs = np.zeros(forma)
+    for semana, posicao in zip(semanas, posicoes):
+        for regiao, dados_regiao in dados["semanas"][semana].items():
+            for granularidade, dados_granularidade in dados_regiao.items():
+                i = posicao_serie.get((regiao, granularidade))
+                if i is None:
+                    continue
+                stock[i, :, posicao] = [dados_granularidade["Stock Liquido"][p] for p in PERIODOS_ANALISE]
+                cogs[i, :, posicao] = [dados_granularidade["COGS"][p] for p in PERIODOS_ANALISE]
+
+    # Semanas com dados no eixo contínuo (as que faltam, por ex. W53/W00 na mudança de ano, não contam)
+    presentes = np.zeros(forma[-1])
+    presentes[posicoes] = 1.0
+    for janela in janelas:
+        n = np.maximum(_somas_moveis(presentes, janela), 1.0)
+        stock_medio = _somas_moveis(stock, janela) / n
+        cogs_janela = _somas_moveis(cogs, janela)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rotacao = np.where(
+                (stock_medio != 0) & (cogs_janela != 0), stock_medio / cogs_janela * (n * 7), 0.0
+            )
+
+        # Gravar apenas nas semanas e séries com dados
+        rotacoes = rotacao[:, :, posicoes].transpose(2, 0, 1).tolist()
+        stocks = stock_medio[:, :, posicoes].transpose(2, 0, 1).tolist()
+        for semana, rotacao_semana, stock_semana in zip(semanas, rotacoes, stocks):
+            dados_semana = dados["semanas"][semana]
+            for (regiao, granularidade), valores_rotacao, valores_stock in zip(series, rotacao_semana, stock_semana):
+                if granularidade not in dados_semana[regiao]:
+                    continue
+                dados_granularidade = dados_semana[regiao][granularidade]
+                dados_granularidade[f"Rotação {janela}S"].update(zip(PERIODOS_ANALISE, valores_rotacao))
+                dados_granularidade[f"Stock Liquido Médio {janela}S"].update(zip(PERIODOS_ANALISE, valores_stock))
+
+    return dados
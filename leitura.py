@@ -0,0 +1,87 @@
+import hashlib
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+import escrita
+from db_setup import DB_PATH, ler_versao_dados
+
+class Instantaneo:
+    """Transação de leitura aberta sobre a base de dados: todas as leituras feitas com `conn` veem
+    o mesmo snapshot do WAL, mesmo que outra ligação grave entretanto.
+
+    `id` identifica o estado dos dados (igual em instantâneos dos mesmos dados) e serve de chave
+    de cache para os agregados calculados a partir dele.
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.conn = escrita.ligar(db_path)
+        # BEGIN diferido: o snapshot é fixado pela primeira leitura e mantém-se até ao fim da transação
+        self.conn.execute('BEGIN')
+        self.versao = tuple(ler_versao_dados(self.conn))
+        self.id = hashlib.sha1(repr(self.versao).encode()).hexdigest()[:12]
+        self.lido_em = datetime.now()
+
+    def fechar(self):
+        if self.conn.in_transaction:
+            self.conn.execute('ROLLBACK')
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excecao):
+        self.fechar()
+
+@contextmanager
+def ligacao(db_path=DB_PATH, conn=None):
+    """Usa a ligação indicada (por ex. a de um Instantaneo) ou abre uma nova, fechada no fim do bloco."""
+    if conn is not None:
+        yield conn
+        return
+    conn = escrita.ligar(db_path)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+SQL_HISTORICO = '''
+SELECT id, tabela, semana_ou_mes, regiao, granularidade, indicador, periodo, periodo_acumulado,
+       valor_antigo, valor_novo, usuario, data_alteracao, lote_id
+FROM historico_alteracoes
+{where}
+ORDER BY data_alteracao DESC, id DESC
+LIMIT ?
+'''
+
+def ler_historico(conn, limite=100, cursor=None, semana=None, regiao=None, indicador=None, usuario=None):
+    """Página do histórico de alterações, da mais recente para a mais antiga.
+
+    Paginação por keyset: o cursor é o par (data_alteracao, id) da última linha da página anterior.
+    Devolve (DataFrame, cursor da página seguinte ou None).
+    """
+    # Filtros aplicados no servidor (cobertos pelos índices compostos com data_alteracao)
+    condicoes = []
+    parametros = []
+    for coluna, valor_filtro in [("semana_ou_mes", semana), ("regiao", regiao), ("indicador", indicador), ("usuario", usuario)]:
+        if valor_filtro:
+            condicoes.append(f"{coluna} = ?")
+            parametros.append(valor_filtro)
+
+    if cursor is not None:
+        condicoes.append("(data_alteracao, id) < (?, ?)")
+        parametros.extend(cursor)
+
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+
+    # Pedir uma linha extra para saber se existe página seguinte
+    parametros.append(int(limite) + 1)
+    df = pd.read_sql(SQL_HISTORICO.format(where=where), conn, params=parametros)
+
+    proximo_cursor = None
+    if len(df) > limite:
+        df = df.iloc[:limite]
+        ultima = df.iloc[-1]
+        proximo_cursor = (ultima["data_alteracao"], int(ultima["id"]))
+    return df, proximo_cursor
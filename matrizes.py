@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+import leitura
+from db_setup import DB_PATH, GRANULARIDADES, REGIOES
+from tendencias import COMPOSICAO_INDICADORES
+
+REGIOES_COM_IBERICA = REGIOES + ["Ibérica"]
+GRANULARIDADES_COM_TOTAL = GRANULARIDADES + ["Total"]
+
+# Valores de base (regiões × granularidades) de uma semana, num único GROUP BY
+SQL_MATRIZ_SEMANA = '''
+WITH componentes(nome, sinal) AS (VALUES {componentes})
+SELECT d.regiao_id, d.granularidade_id, SUM(d.valor * c.sinal)
+FROM dados_stock d
+JOIN dim_indicador i ON i.id = d.indicador_id
+JOIN componentes c ON c.nome = i.nome
+WHERE d.semana = ? AND d.periodo_id = (SELECT id FROM dim_periodo WHERE nome = ?)
+GROUP BY d.regiao_id, d.granularidade_id
+'''
+
+def _com_agregados(matriz):
+    # Acrescenta a linha Ibérica (soma das regiões) e a coluna Total (soma das granularidades)
+    matriz = np.vstack([matriz, matriz.sum(axis=0, keepdims=True)])
+    return np.hstack([matriz, matriz.sum(axis=1, keepdims=True)])
+
+def matriz_regiao_granularidade(semana, indicador, periodo, db_path=DB_PATH, conn=None):
+    """Matriz região × granularidade (com Ibérica e Total) de um indicador numa semana.
+
+    As células de base vêm de uma única consulta e os agregados são somas da matriz,
+    como nas views view_iberica_semanal e view_total_semanal.
+    """
+    componentes = list(COMPOSICAO_INDICADORES.get(indicador, {indicador: 1}).items())
+    sql = SQL_MATRIZ_SEMANA.format(componentes=", ".join("(?, ?)" for _ in componentes))
+
+    with leitura.ligacao(db_path, conn) as conn:
+        ids_regioes = dict(conn.execute('SELECT id, nome FROM dim_regiao'))
+        ids_granularidades = dict(conn.execute('SELECT id, nome FROM dim_granularidade'))
+        linhas = conn.execute(sql, [*(valor for par in componentes for valor in par), semana, periodo]).fetchall()
+
+    matriz = np.zeros((len(REGIOES), len(GRANULARIDADES)))
+    posicao_regiao = {nome: i for i, nome in enumerate(REGIOES)}
+    posicao_granularidade = {nome: i for i, nome in enumerate(GRANULARIDADES)}
+    for regiao_id, granularidade_id, valor in linhas:
+        linha = posicao_regiao.get(ids_regioes[regiao_id])
+        coluna = posicao_granularidade.get(ids_granularidades[granularidade_id])
+        if linha is not None and coluna is not None:
+            matriz[linha, coluna] = valor
+
+    return pd.DataFrame(_com_agregados(matriz), index=REGIOES_COM_IBERICA, columns=GRANULARIDADES_COM_TOTAL)
+
+def matriz_regiao_granularidade_cubo(dados, semana, indicador, periodo):
+    """Como matriz_regiao_granularidade, a partir da estrutura em memória (para indicadores calculados).
+
+    Os agregados são lidos da estrutura e não somados: a Rotação de Ibérica/Total não é a soma das parcelas.
+    """
+    dados_semana = dados["semanas"][semana]
+    matriz = np.array([
+        [dados_semana[regiao][granularidade][indicador][periodo] for granularidade in GRANULARIDADES_COM_TOTAL]
+        for regiao in REGIOES_COM_IBERICA
+    ])
+    return pd.DataFrame(matriz, index=REGIOES_COM_IBERICA, columns=GRANULARIDADES_COM_TOTAL)
+
+def matriz_semana_regiao(tendencia):
+    """Converte uma série de tendencias (chave, regiao, periodo, valor) de um período numa matriz semana × região."""
+    matriz = tendencia.pivot_table(index="chave", columns="regiao", values="valor", aggfunc="sum", fill_value=0.0)
+    return matriz.reindex(columns=[r for r in REGIOES_COM_IBERICA if r in matriz.columns])
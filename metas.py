@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from matrizes import GRANULARIDADES_COM_TOTAL, REGIOES_COM_IBERICA
+from rotacao import EixoSemanas
+from tendencias import COMPOSICAO_INDICADORES
+
+# Período cuja rotação serve de meta por omissão
+PERIODO_META = "Budget"
+
+COLUNAS_METAS = [
+    "regiao", "granularidade", "semana", "Rotação", "Meta", "Stock Liquido", "Stock Liquido necessário",
+    "COGS", "COGS necessário", "Vendas", "Vendas necessárias",
+]
+
+def resolver_metas(dados, periodo, meta=None, periodo_meta=PERIODO_META):
+    """Inverte a rotação para atingir uma meta, em todas as séries e semanas de uma vez.
+
+    Com Rotação = (stock líquido / COGS acumulado no ano) × dias acumulados (calcular_rotacao),
+    para cada semana do `periodo`:
+
+        Stock Liquido necessário = meta × COGS acumulado / dias (mantendo o COGS)
+        COGS necessário = stock líquido × dias / meta − COGS acumulado até à semana anterior
+                          (mantendo o stock e o COGS das outras semanas)
+
+    e as Vendas necessárias são as que dão esse COGS com o MFO e a Quebra atuais. A meta é um
+    valor fixo (`meta`) ou, por omissão, a rotação do `periodo_meta` na mesma semana e série.
+    Sem solução (meta, COGS acumulado ou stock a 0) o valor necessário fica NaN.
+
+    Devolve um DataFrame com as COLUNAS_METAS, uma linha por série com dados e semana.
+    """
+    eixo = EixoSemanas(dados["semanas"])
+    series = [(regiao, granularidade) for regiao in REGIOES_COM_IBERICA for granularidade in GRANULARIDADES_COM_TOTAL]
+    if not len(eixo):
+        return pd.DataFrame(columns=COLUNAS_METAS)
+
+    # dict.get não passa pelo __missing__ da estrutura esparsa: semanas sem a série ficam None
+    nos = [[dados["semanas"][semana].get(regiao, {}).get(granularidade) for semana in eixo.semanas] for regiao, granularidade in series]
+    presentes = np.array([[no is not None for no in nos_serie] for nos_serie in nos])
+
+    def matriz(indicador, periodo_matriz=periodo):
+        # Série × semana, com 0 nas células em falta
+        return np.array([[no[indicador][periodo_matriz] if no is not None else 0.0 for no in nos_serie] for nos_serie in nos])
+
+    stock = matriz("Stock Liquido")
+    vendas = matriz("Vendas")
+    cogs = sum(sinal * matriz(indicador) for indicador, sinal in COMPOSICAO_INDICADORES["COGS"].items())
+    cogs_acumulado = eixo.cogs_acumulado(cogs)
+    rotacao = eixo.rotacao(stock, cogs)
+    metas = np.full(stock.shape, float(meta)) if meta is not None else matriz("Rotação", periodo_meta)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stock_necessario = np.where((metas != 0) & (cogs_acumulado != 0), metas * cogs_acumulado / eixo.dias, np.nan)
+        cogs_necessario = np.where(
+            (metas != 0) & (stock != 0), stock * eixo.dias / metas - (cogs_acumulado - cogs), np.nan
+        )
+    # COGS = Vendas − MFO − Quebra: a diferença de COGS passa toda para as Vendas
+    vendas_necessarias = vendas + (cogs_necessario - cogs)
+
+    linhas, semanas = np.nonzero(presentes)
+    return pd.DataFrame({
+        "regiao": [series[s][0] for s in linhas],
+        "granularidade": [series[s][1] for s in linhas],
+        "semana": [eixo.semanas[t] for t in semanas],
+        "Rotação": rotacao[linhas, semanas],
+        "Meta": metas[linhas, semanas],
+        "Stock Liquido": stock[linhas, semanas],
+        "Stock Liquido necessário": stock_necessario[linhas, semanas],
+        "COGS": cogs[linhas, semanas],
+        "COGS necessário": cogs_necessario[linhas, semanas],
+        "Vendas": vendas[linhas, semanas],
+        "Vendas necessárias": vendas_necessarias[linhas, semanas],
+    }, columns=COLUNAS_METAS)
@@ -0,0 +1,115 @@
+import cProfile
+import os
+import pstats
+import re
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+
+try:
+    from pyinstrument import Profiler as PyinstrumentProfiler
+except ImportError:
+    PyinstrumentProfiler = None
+
+# Perfilagem opcional: STOCK_PERFIL=1 (ou ?perfil=1) captura a execução do script
+VARIAVEL_AMBIENTE = "STOCK_PERFIL"
+PARAMETRO_QUERY = "perfil"
+
+# Diretório onde os perfis são guardados (pode ser alterado com STOCK_PERFIL_DIR)
+DIRETORIO_PERFIS = os.environ.get(
+    "STOCK_PERFIL_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "perfis")
+)
+
+# Intervalo de amostragem (segundos) usado para gerar as pilhas colapsadas
+INTERVALO_AMOSTRAGEM = 0.001
+
+class _Amostrador(threading.Thread):
+    """Amostra periodicamente a pilha de uma thread para o formato colapsado."""
+
+    def __init__(self, thread_id, intervalo=INTERVALO_AMOSTRAGEM):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.intervalo = intervalo
+        self.pilhas = Counter()
+        self._parar = threading.Event()
+
+    def run(self):
+        while not self._parar.wait(self.intervalo):
+            frame = sys._current_frames().get(self.thread_id)
+            pilha = []
+            while frame is not None:
+                codigo = frame.f_code
+                nome = codigo.co_name.replace(";", ":")
+                pilha.append(f"{nome} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+                frame = frame.f_back
+            if pilha:
+                self.pilhas[";".join(reversed(pilha))] += 1
+
+    def parar(self):
+        self._parar.set()
+        self.join()
+
+def perfil_ativo(query_params=None):
+    """Indica se esta execução deve ser perfilada (variável de ambiente ou parâmetro da query)."""
+    if os.environ.get(VARIAVEL_AMBIENTE, "0") not in ("", "0"):
+        return True
+    if query_params is not None and query_params.get(PARAMETRO_QUERY) == "1":
+        return True
+    return False
+
+def iniciar_perfil():
+    """Começa a perfilar a thread atual; devolve o estado a passar a terminar_perfil."""
+    amostrador = _Amostrador(threading.get_ident())
+    amostrador.start()
+
+    pyinstrument = None
+    if PyinstrumentProfiler is not None and os.environ.get(VARIAVEL_AMBIENTE) == "pyinstrument":
+        pyinstrument = PyinstrumentProfiler()
+        pyinstrument.start()
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    return {"cprofile": profiler, "amostrador": amostrador, "pyinstrument": pyinstrument}
+
+def _nome_ficheiro(pagina, selecoes):
+    partes = [datetime.now().strftime("%Y%m%d_%H%M%S"), pagina or "script"]
+    partes += [str(valor) for valor in (selecoes or {}).values() if valor is not None]
+    nome = "_".join(partes)
+    # Manter apenas caracteres seguros para nomes de ficheiros
+    return re.sub(r"[^\w.-]+", "-", nome).strip("-")[:150]
+
+def terminar_perfil(estado, pagina=None, selecoes=None):
+    """Para a perfilagem e guarda .prof (pstats) e .collapsed (flamegraph) no diretório de perfis."""
+    if estado is None:
+        return None
+
+    estado["cprofile"].disable()
+    estado["amostrador"].parar()
+    if estado["pyinstrument"] is not None:
+        estado["pyinstrument"].stop()
+
+    os.makedirs(DIRETORIO_PERFIS, exist_ok=True)
+    base = os.path.join(DIRETORIO_PERFIS, _nome_ficheiro(pagina, selecoes))
+
+    # Estatísticas do cProfile (abrir com pstats, snakeviz, etc.)
+    caminho_prof = base + ".prof"
+    pstats.Stats(estado["cprofile"]).dump_stats(caminho_prof)
+
+    # Pilhas colapsadas (compatível com flamegraph.pl, speedscope, inferno)
+    caminho_collapsed = base + ".collapsed"
+    with open(caminho_collapsed, "w", encoding="utf-8") as f:
+        for pilha, contagem in estado["amostrador"].pilhas.most_common():
+            f.write(f"{pilha} {contagem}\n")
+
+    ficheiros = [caminho_prof, caminho_collapsed]
+
+    if estado["pyinstrument"] is not None:
+        caminho_html = base + ".html"
+        with open(caminho_html, "w", encoding="utf-8") as f:
+            f.write(estado["pyinstrument"].output_html())
+        ficheiros.append(caminho_html)
+
+    return ficheiros
@@ -0,0 +1,247 @@
+import argparse
+
+import numpy as np
+
+import escrita
+import importacao
+from db_setup import DB_PATH, INDICADORES, INDICADORES_CALCULADOS, ORIGEM_PROJECAO, ler_dimensoes
+from estrutura import semanas_do_ano
+
+# Período projetado e período de referência sazonal
+PERIODO_PROJECAO = "Real + Projeção"
+PERIODO_REFERENCIA = "Last Year"
+
+# Indicadores projetados: os guardados (COGS e Rotação são calculados a partir deles ao carregar)
+INDICADORES_PROJECAO = [i for i in INDICADORES if i not in INDICADORES_CALCULADOS]
+
+# Métodos de projeção (código guardado em projecoes_series: descrição)
+METODOS_PROJECAO = {
+    "sazonal": "Sazonal ingénuo (mesma semana do ano anterior)",
+    "suavizacao": "Suavização exponencial",
+    "ly_escalado": "Last Year escalado pela tendência recente",
+}
+METODO_PADRAO = "ly_escalado"
+
+# Constante de suavização (suavizacao) e semanas reais usadas no fator de escala (ly_escalado)
+ALFA_SUAVIZACAO = 0.3
+SEMANAS_ESCALA = 13
+
+# Assinatura dos valores reais e de referência de cada série (muda sempre que um deles é escrito
+# ou apagado); as projeções já gravadas não contam
+SQL_ASSINATURAS = '''
+SELECT regiao_id, granularidade_id, indicador_id,
+       COUNT(*) || '|' || MAX(data_atualizacao) AS assinatura,
+       MAX(CASE WHEN periodo_id = ? THEN semana END) AS ultima_semana_real
+FROM dados_stock
+WHERE periodo_id IN (?, ?) AND indicador_id IN ({indicadores}) AND origem IS NOT ?
+GROUP BY regiao_id, granularidade_id, indicador_id
+'''
+
+SQL_VALORES = '''
+SELECT semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor
+FROM dados_stock
+WHERE periodo_id IN (?, ?) AND origem IS NOT ?
+  AND (regiao_id, granularidade_id, indicador_id) IN (VALUES {series})
+'''
+
+# Projeções de uma série que deixaram de estar no horizonte (já há valores reais a seguir)
+SQL_REMOVER_OBSOLETAS = '''
+DELETE FROM dados_stock
+WHERE regiao_id = ? AND granularidade_id = ? AND indicador_id = ? AND periodo_id = ?
+  AND origem = ? AND (semana <= ? OR semana > ?)
+'''
+
+SQL_REGISTAR_PROJECAO = '''
+INSERT INTO projecoes_series (regiao_id, granularidade_id, indicador_id, metodo, assinatura, ultima_semana_real, data_projecao)
+VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+ON CONFLICT(regiao_id, granularidade_id, indicador_id) DO UPDATE SET
+    metodo = excluded.metodo, assinatura = excluded.assinatura,
+    ultima_semana_real = excluded.ultima_semana_real, data_projecao = excluded.data_projecao
+'''
+
+def _fim_horizonte(ultima_semana_real, ate_semana=None):
+    # Por omissão, até à última semana do ano da última semana real
+    return ate_semana or semanas_do_ano(int(ultima_semana_real[:4]))[-1]
+
+def _semanas_horizonte(ultima_semana_real, fim):
+    anos = range(int(ultima_semana_real[:4]), int(fim[:4]) + 1)
+    return [semana for ano in anos for semana in semanas_do_ano(ano) if ultima_semana_real < semana <= fim]
+
+def _projetar_sazonal(real, referencia, futuro, anterior):
+    # Valor real (ou já projetado) da mesma semana do ano anterior; sem ele, o Last Year da semana
+    valores = real.copy()
+    for t in np.flatnonzero(futuro.any(axis=0)):
+        candidato = valores[:, anterior[t]] if anterior[t] >= 0 else np.full(len(valores), np.nan)
+        candidato = np.where(np.isnan(candidato), referencia[:, t], candidato)
+        valores[:, t] = np.where(futuro[:, t], candidato, valores[:, t])
+    return valores
+
+def _projetar_suavizacao(real, alfa=ALFA_SUAVIZACAO):
+    # Nível da suavização exponencial simples no fim dos valores reais (projeção constante)
+    nivel = np.full(len(real), np.nan)
+    for coluna in real.T:
+        atualizado = np.where(np.isnan(nivel), coluna, alfa * coluna + (1 - alfa) * nivel)
+        nivel = np.where(np.isnan(coluna), nivel, atualizado)
+    return np.repeat(nivel[:, None], real.shape[1], axis=1)
+
+def _projetar_ly_escalado(real, referencia, ultima, semanas_escala=SEMANAS_ESCALA):
+    # Last Year de cada semana × (real / Last Year) das últimas semanas reais
+    posicoes = np.arange(real.shape[1])
+    janela = (
+        (posicoes <= ultima[:, None]) & (posicoes > ultima[:, None] - semanas_escala)
+        & ~np.isnan(real) & ~np.isnan(referencia)
+    )
+    soma_real = np.where(janela, real, 0.0).sum(axis=1)
+    soma_referencia = np.where(janela, referencia, 0.0).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fator = np.where(soma_referencia != 0, soma_real / soma_referencia, 1.0)
+    return referencia * fator[:, None]
+
+def calcular_projecoes(valores_reais, valores_referencia, ultimas_semanas, fins, metodo=METODO_PADRAO):
+    """Projeta várias séries de uma vez (uma linha de matriz por série, uma coluna por semana).
+
+    `valores_reais` e `valores_referencia` são listas de {semana: valor} por série; `ultimas_semanas`
+    e `fins` delimitam o horizonte de cada série (da semana a seguir à última real até ao fim,
+    inclusive). Devolve, por série, {semana: valor projetado} para as semanas do horizonte.
+    """
+    if metodo not in METODOS_PROJECAO:
+        raise ValueError(f"Método de projeção desconhecido: {metodo}")
+
+    horizontes = [_semanas_horizonte(ultima, fim) for ultima, fim in zip(ultimas_semanas, fins)]
+    semanas = sorted(
+        {semana for valores in valores_reais for semana in valores}
+        | {semana for valores in valores_referencia for semana in valores}
+        | {semana for horizonte in horizontes for semana in horizonte}
+    )
+    posicao = {semana: t for t, semana in enumerate(semanas)}
+
+    real = np.full((len(valores_reais), len(semanas)), np.nan)
+    referencia = np.full_like(real, np.nan)
+    futuro = np.zeros(real.shape, dtype=bool)
+    for s, (valores, valores_ref, horizonte) in enumerate(zip(valores_reais, valores_referencia, horizontes)):
+        real[s, [posicao[semana] for semana in valores]] = list(valores.values())
+        referencia[s, [posicao[semana] for semana in valores_ref]] = list(valores_ref.values())
+        futuro[s, [posicao[semana] for semana in horizonte]] = True
+
+    if metodo == "sazonal":
+        anterior = np.array([posicao.get(f"{int(semana[:4]) - 1}{semana[4:]}", -1) for semana in semanas])
+        projecao = _projetar_sazonal(real, referencia, futuro, anterior)
+    elif metodo == "suavizacao":
+        projecao = _projetar_suavizacao(real)
+    else:
+        ultima = np.array([posicao[semana] for semana in ultimas_semanas])
+        projecao = _projetar_ly_escalado(real, referencia, ultima)
+
+    projecao = np.round(projecao, 2)
+    validas = futuro & ~np.isnan(projecao)
+    return [
+        {semanas[t]: projecao[s, t] for t in np.flatnonzero(validas[s]).tolist()}
+        for s in range(len(valores_reais))
+    ]
+
+def _projetar(metodo, ate_semana, forcar, db_path):
+    conn = escrita.ligar(db_path)
+    try:
+        dimensoes = ler_dimensoes(conn)
+        id_real = dimensoes["periodo"].index(PERIODO_PROJECAO)
+        id_referencia = dimensoes["periodo"].index(PERIODO_REFERENCIA)
+        ids_indicadores = [dimensoes["indicador"].index(indicador) for indicador in INDICADORES_PROJECAO]
+
+        assinaturas = conn.execute(
+            SQL_ASSINATURAS.format(indicadores=", ".join("?" for _ in ids_indicadores)),
+            (id_real, id_real, id_referencia, *ids_indicadores, ORIGEM_PROJECAO)
+        ).fetchall()
+        estado = {
+            tuple(linha[:3]): tuple(linha[3:])
+            for linha in conn.execute('SELECT regiao_id, granularidade_id, indicador_id, metodo, assinatura FROM projecoes_series')
+        }
+
+        # Só as séries com valores reais cujos dados (ou método/horizonte) mudaram desde a última projeção
+        series = [
+            (serie, f"{assinatura}|{ate_semana or ''}", ultima)
+            for *serie, assinatura, ultima in assinaturas
+            if ultima is not None
+            and (forcar or estado.get(tuple(serie)) != (metodo, f"{assinatura}|{ate_semana or ''}"))
+        ]
+        resultado = {"series": len(assinaturas), "ajustadas": len(series), "lote_id": None,
+                     "inseridas": 0, "alteradas": 0, "removidas": 0}
+        if not series:
+            return resultado
+
+        posicao_serie = {tuple(serie): s for s, (serie, _, _) in enumerate(series)}
+        valores_reais = [{} for _ in series]
+        valores_referencia = [{} for _ in series]
+        linhas = conn.execute(
+            SQL_VALORES.format(series=", ".join("(?, ?, ?)" for _ in series)),
+            (id_real, id_referencia, ORIGEM_PROJECAO, *(valor for serie, _, _ in series for valor in serie))
+        )
+        for semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor in linhas:
+            s = posicao_serie[(regiao_id, granularidade_id, indicador_id)]
+            (valores_reais if periodo_id == id_real else valores_referencia)[s][semana] = valor
+    finally:
+        conn.close()
+
+    ultimas = [ultima for _, _, ultima in series]
+    fins = [_fim_horizonte(ultima, ate_semana) for ultima in ultimas]
+    projecoes = calcular_projecoes(valores_reais, valores_referencia, ultimas, fins, metodo)
+
+    # Remoção das projeções obsoletas, gravação das novas e registo das séries numa única transação:
+    # os leitores nunca veem as séries sem projeção e, se a gravação falhar, nada muda
+    conn = escrita.ligar(db_path)
+    conn.execute('PRAGMA temp_store = MEMORY')
+    try:
+        with escrita.transacao_imediata(conn):
+            cursor = conn.executemany(SQL_REMOVER_OBSOLETAS, [
+                (*serie, id_real, ORIGEM_PROJECAO, ultima, fim)
+                for (serie, _, ultima), fim in zip(series, fins)
+            ])
+            resultado["removidas"] = cursor.rowcount
+
+            # Células que entretanto passaram a ter valores reais ficam como estão
+            resultado.update(importacao.importar_na_transacao(
+                conn,
+                (
+                    (semana, dimensoes["regiao"][regiao_id], dimensoes["granularidade"][granularidade_id],
+                     dimensoes["indicador"][indicador_id], PERIODO_PROJECAO, valor)
+                    for ((regiao_id, granularidade_id, indicador_id), _, _), projecao in zip(series, projecoes)
+                    for semana, valor in projecao.items()
+                ),
+                usuario="projecao", origem=ORIGEM_PROJECAO, preservar_outras_origens=True
+            ))
+
+            conn.executemany(SQL_REGISTAR_PROJECAO, [
+                (*serie, metodo, assinatura, ultima) for serie, assinatura, ultima in series
+            ])
+    finally:
+        conn.close()
+
+    return resultado
+
+def projetar(metodo=METODO_PADRAO, ate_semana=None, forcar=False, db_path=DB_PATH):
+    """Projeta o Real + Projeção das semanas seguintes à última semana real de cada série.
+
+    As séries (região × granularidade × indicador guardado) são projetadas todas de uma vez e
+    gravadas com origem ORIGEM_PROJECAO, num lote de importação; valores reais nunca são
+    substituídos. Só são reajustadas as séries com novos valores reais (ou Last Year) desde a
+    última projeção, ou todas com `forcar`. O horizonte vai até ao fim do ano da última semana
+    real ou até `ate_semana`.
+    """
+    return escrita.executar_na_fila(_projetar, metodo, ate_semana, forcar, db_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Projeção do Real + Projeção das semanas restantes.")
+    parser.add_argument("--metodo", choices=list(METODOS_PROJECAO), default=METODO_PADRAO, help="Método de projeção")
+    parser.add_argument("--ate-semana", help="Última semana projetada (YYYY-WXX); por omissão, o fim do ano")
+    parser.add_argument("--forcar", action="store_true", help="Reajustar todas as séries, mesmo sem novos valores reais")
+    args = parser.parse_args()
+
+    print("Iniciando projeção...")
+    resultado = projetar(args.metodo, args.ate_semana, args.forcar)
+    if resultado["ajustadas"]:
+        print(
+            f"{resultado['ajustadas']} de {resultado['series']} séries reajustadas (lote {resultado['lote_id']}): "
+            f"{resultado['inseridas']} novos valores, {resultado['alteradas']} alterados, "
+            f"{resultado['removidas']} projeções obsoletas removidas"
+        )
+    else:
+        print(f"Nenhuma das {resultado['series']} séries tem novos valores reais")
@@ -0,0 +1,185 @@
+import argparse
+from datetime import datetime
+
+import escrita
+from db_setup import DB_PATH, GRANULARIDADES, REGIOES, ler_dimensoes
+
+# Alterações registadas no histórico a partir das quais é criado um novo ponto de controlo
+# (os pontos de controlo correm periodicamente, fora das importações: python reconstrucao.py)
+ALTERACOES_POR_PONTO_CONTROLO = 5000
+
+# Pontos de controlo mantidos (os mais antigos são apagados quando é criado um novo)
+MAX_PONTOS_CONTROLO = 12
+
+# Formato de data_alteracao (CURRENT_TIMESTAMP, em UTC)
+FORMATO_INSTANTE = "%Y-%m-%d %H:%M:%S"
+
+SQL_BASE_ATUAL = '''
+SELECT id, semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor, data_atualizacao
+FROM dados_stock
+'''
+
+SQL_BASE_PONTO_CONTROLO = '''
+SELECT id, semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor, data_atualizacao
+FROM pontos_controlo_valores
+WHERE ponto_controlo_id = :ponto_controlo
+'''
+
+# Ponto de controlo mais próximo a seguir ao instante: só as alterações entre os dois são revertidas
+SQL_ESCOLHER_PONTO_CONTROLO = '''
+SELECT id, data_ponto_controlo, ultimo_historico
+FROM pontos_controlo
+WHERE data_ponto_controlo >= ?
+ORDER BY data_ponto_controlo, id
+LIMIT 1
+'''
+
+# Valores semanais (com os agregados Ibérica e Total, como as views) num instante passado. Para cada
+# registo, o valor_antigo da primeira alteração depois do instante é o valor nesse instante (NULL:
+# o registo ainda não existia); registos sem alterações depois do instante mantêm o valor da base,
+# salvo se foram escritos depois dele sem passar pelo histórico (valores migrados). Os registos
+# apagados entretanto só existem no histórico e são recuperados a partir dos rótulos. A escolha é
+# feita por uma única ordenação (alterações e base juntas, por registo), sem junções por id.
+SQL_RECONSTRUIR = '''
+WITH candidatos AS (
+    SELECT h.id_registro AS id, h.semana_ou_mes AS semana, r.id AS regiao_id, g.id AS granularidade_id,
+           i.id AS indicador_id, pe.id AS periodo_id, h.valor_antigo AS valor, NULL AS data_atualizacao,
+           h.data_alteracao AS data_alteracao, h.id AS id_alteracao
+    FROM historico_alteracoes h
+    JOIN dim_regiao r ON r.nome = h.regiao
+    JOIN dim_granularidade g ON g.nome = h.granularidade
+    JOIN dim_indicador i ON i.nome = h.indicador
+    JOIN dim_periodo pe ON pe.nome = h.periodo
+    -- +h.id: a pesquisa deve usar o índice por data_alteracao (só as alterações depois do instante)
+    WHERE h.tabela = 'dados_stock' AND h.data_alteracao > :instante AND +h.id <= :ultimo_historico
+    UNION ALL
+    SELECT id, semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor, data_atualizacao, NULL, NULL
+    FROM ({base})
+),
+escolhidos AS (
+    SELECT semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor, data_atualizacao, data_alteracao,
+           ROW_NUMBER() OVER (
+               PARTITION BY id ORDER BY data_alteracao IS NULL, data_alteracao, id_alteracao
+           ) AS ordem
+    FROM candidatos
+),
+reconstruidos AS (
+    SELECT semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor
+    FROM escolhidos
+    WHERE ordem = 1 AND valor IS NOT NULL
+      AND (data_alteracao IS NOT NULL OR data_atualizacao IS NULL OR datetime(data_atualizacao) <= :instante)
+)
+SELECT semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor
+FROM reconstruidos
+UNION ALL
+SELECT semana, :iberica, granularidade_id, indicador_id, periodo_id, SUM(valor)
+FROM reconstruidos
+WHERE regiao_id IN ({regioes})
+GROUP BY semana, granularidade_id, indicador_id, periodo_id
+UNION ALL
+SELECT semana, regiao_id, :total, indicador_id, periodo_id, SUM(valor)
+FROM reconstruidos
+WHERE granularidade_id IN ({granularidades})
+GROUP BY semana, regiao_id, indicador_id, periodo_id
+'''
+
+SQL_REGISTAR_PONTO_CONTROLO = '''
+INSERT INTO pontos_controlo (data_ponto_controlo, ultimo_historico, celulas)
+VALUES (CURRENT_TIMESTAMP, (SELECT IFNULL(MAX(id), 0) FROM historico_alteracoes), (SELECT COUNT(*) FROM dados_stock))
+'''
+
+SQL_COPIAR_PONTO_CONTROLO = '''
+INSERT INTO pontos_controlo_valores (ponto_controlo_id, id, semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor, data_atualizacao)
+SELECT ?, id, semana, regiao_id, granularidade_id, indicador_id, periodo_id, valor, data_atualizacao
+FROM dados_stock
+'''
+
+SQL_PONTOS_CONTROLO_ANTIGOS = 'SELECT id FROM pontos_controlo ORDER BY id DESC LIMIT -1 OFFSET ?'
+
+def formatar_instante(instante):
+    """Instante no formato de data_alteracao (um datetime em UTC ou já uma string)."""
+    return instante.strftime(FORMATO_INSTANTE) if isinstance(instante, datetime) else str(instante)
+
+def linhas_semanais(conn, instante):
+    """Reconstrói os valores semanais de dados_stock tal como estavam no `instante` (UTC).
+
+    O histórico de alterações é revertido a partir do ponto de controlo mais próximo depois do
+    instante (ou dos dados atuais, se não houver nenhum), pelo que só as alterações entre os dois
+    são lidas. Devolve (cursor, informação): o cursor dá tuplos (semana, regiao_id,
+    granularidade_id, indicador_id, periodo_id, valor), com os agregados Ibérica e Total, tal como
+    a consulta de carregar_dados_bd; a informação indica o ponto de controlo usado, a data da
+    alteração mais antiga ainda no histórico (antes dela a reconstrução pode estar incompleta) e
+    o limite da última compactação (antes dele, só resta a última alteração de cada célula em cada
+    dia: um instante a meio de um dia com várias alterações vê o valor do início desse dia).
+    """
+    instante = formatar_instante(instante)
+    dimensoes = ler_dimensoes(conn)
+    ponto_controlo = conn.execute(SQL_ESCOLHER_PONTO_CONTROLO, (instante,)).fetchone()
+    parametros = {
+        "instante": instante,
+        "ultimo_historico": ponto_controlo[2] if ponto_controlo else 2 ** 63 - 1,
+        "ponto_controlo": ponto_controlo[0] if ponto_controlo else None,
+        "iberica": dimensoes["regiao"].index("Ibérica"),
+        "total": dimensoes["granularidade"].index("Total"),
+    }
+    sql = SQL_RECONSTRUIR.format(
+        base=SQL_BASE_PONTO_CONTROLO if ponto_controlo else SQL_BASE_ATUAL,
+        regioes=", ".join(str(dimensoes["regiao"].index(regiao)) for regiao in REGIOES),
+        granularidades=", ".join(str(dimensoes["granularidade"].index(granularidade)) for granularidade in GRANULARIDADES),
+    )
+    informacao = {
+        "instante": instante,
+        "ponto_controlo": ponto_controlo[0] if ponto_controlo else None,
+        "data_ponto_controlo": ponto_controlo[1] if ponto_controlo else None,
+        "historico_desde": conn.execute('SELECT MIN(data_alteracao) FROM historico_alteracoes').fetchone()[0],
+        "compactado_ate": conn.execute('SELECT MAX(data_limite) FROM compactacoes_historico').fetchone()[0],
+    }
+    return conn.execute(sql, parametros), informacao
+
+def _criar_ponto_controlo(db_path, maximo):
+    conn = escrita.ligar(db_path)
+    try:
+        with escrita.transacao_imediata(conn):
+            ponto_controlo = conn.execute(SQL_REGISTAR_PONTO_CONTROLO).lastrowid
+            conn.execute(SQL_COPIAR_PONTO_CONTROLO, (ponto_controlo,))
+            antigos = [(id_antigo,) for id_antigo, in conn.execute(SQL_PONTOS_CONTROLO_ANTIGOS, (maximo,))]
+            conn.executemany('DELETE FROM pontos_controlo_valores WHERE ponto_controlo_id = ?', antigos)
+            conn.executemany('DELETE FROM pontos_controlo WHERE id = ?', antigos)
+        return ponto_controlo
+    finally:
+        conn.close()
+
+def _criar_ponto_controlo_se_necessario(intervalo, db_path, maximo):
+    conn = escrita.ligar(db_path)
+    try:
+        pendentes = conn.execute('''
+        SELECT COUNT(*) FROM historico_alteracoes
+        WHERE id > (SELECT IFNULL(MAX(ultimo_historico), 0) FROM pontos_controlo)
+        ''').fetchone()[0]
+    finally:
+        conn.close()
+    return _criar_ponto_controlo(db_path, maximo) if pendentes >= intervalo else None
+
+def criar_ponto_controlo(db_path=DB_PATH, maximo=MAX_PONTOS_CONTROLO):
+    """Copia dados_stock para um novo ponto de controlo (mantendo os `maximo` mais recentes). Devolve o id."""
+    return escrita.executar_na_fila(_criar_ponto_controlo, db_path, maximo)
+
+def criar_ponto_controlo_se_necessario(intervalo=ALTERACOES_POR_PONTO_CONTROLO, db_path=DB_PATH,
+                                       maximo=MAX_PONTOS_CONTROLO):
+    """Cria um ponto de controlo se o histórico tiver `intervalo` alterações desde o último.
+
+    Devolve o id do ponto de controlo criado ou None.
+    """
+    return escrita.executar_na_fila(_criar_ponto_controlo_se_necessario, intervalo, db_path, maximo)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pontos de controlo para a reconstrução de instantes passados.")
+    parser.add_argument("--intervalo", type=int, default=ALTERACOES_POR_PONTO_CONTROLO, help="Alterações no histórico entre pontos de controlo")
+    parser.add_argument("--forcar", action="store_true", help="Criar um ponto de controlo mesmo sem alterações suficientes")
+    args = parser.parse_args()
+
+    ponto_controlo = criar_ponto_controlo() if args.forcar else criar_ponto_controlo_se_necessario(args.intervalo)
+    if ponto_controlo is None:
+        print(f"Menos de {args.intervalo} alterações desde o último ponto de controlo")
+    else:
+        print(f"Ponto de controlo {ponto_controlo} criado")
@@ -0,0 +1,111 @@
+import sys
+from array import array
+
+import numpy as np
+import pandas as pd
+
+# Dimensões de uma célula de stock, pela ordem das colunas em dados_stock / dados_stock_mensal
+DIMENSOES = ("chave", "regiao", "granularidade", "indicador", "periodo")
+DIMENSOES_MENSAIS = ("chave", "regiao", "granularidade", "indicador", "periodo", "periodo_acumulado")
+
+class Categorias:
+    """Dicionário de rótulos de uma dimensão: cada rótulo distinto é guardado (internado) uma única vez."""
+
+    __slots__ = ("rotulos", "codigos")
+
+    def __init__(self, rotulos=()):
+        self.rotulos = []
+        self.codigos = {}
+        for rotulo in rotulos:
+            self.codificar(rotulo)
+
+    def codificar(self, rotulo):
+        # None (ex.: período acumulado ausente) fica com o código -1
+        if rotulo is None:
+            return -1
+        codigo = self.codigos.get(rotulo)
+        if codigo is None:
+            if isinstance(rotulo, str):
+                rotulo = sys.intern(rotulo)
+            codigo = self.codigos[rotulo] = len(self.rotulos)
+            self.rotulos.append(rotulo)
+        return codigo
+
+    def descodificador(self):
+        # A posição -1 devolve None, o que evita um teste por linha ao descodificar
+        return self.rotulos + [None]
+
+class ColunasStock:
+    """Registos de células de stock em colunas (struct-of-arrays) com dimensões codificadas.
+
+    Cada registo ocupa um inteiro por dimensão e um double para o valor, em vez de um dict
+    (ou linha de DataFrame) com cópias das strings. Iterar devolve tuplos com os rótulos
+    internados, pela ordem de `dimensoes` seguida do valor, prontos para executemany.
+
+    As dimensões em `codificadas` chegam já como códigos (por ex. os ids das tabelas de lookup
+    da base de dados) e são guardadas sem conversão; as restantes são codificadas a partir do rótulo.
+    """
+
+    __slots__ = ("dimensoes", "categorias", "codificadas", "codigos", "valores")
+
+    def __init__(self, dimensoes=DIMENSOES, categorias=None, codificadas=()):
+        self.dimensoes = tuple(dimensoes)
+        # As categorias podem ser partilhadas entre lotes para manter os mesmos códigos
+        categorias = categorias or {}
+        self.categorias = {dimensao: categorias.get(dimensao) or Categorias() for dimensao in self.dimensoes}
+        self.codificadas = frozenset(codificadas)
+        self.codigos = [array("i") for _ in self.dimensoes]
+        self.valores = array("d")
+
+    @classmethod
+    def de_linhas(cls, linhas, dimensoes=DIMENSOES, categorias=None, codificadas=()):
+        """Constrói as colunas a partir de tuplos (dimensões..., valor), por ex. um cursor sqlite3."""
+        colunas = cls(dimensoes, categorias, codificadas)
+        for linha in linhas:
+            colunas.acrescentar(*linha)
+        return colunas
+
+    @classmethod
+    def de_dataframe(cls, df, dimensoes=DIMENSOES, colunas=None, coluna_valor="valor"):
+        """Constrói as colunas a partir de um DataFrame, codificando cada dimensão de uma só vez."""
+        registos = cls(dimensoes)
+        for posicao, (dimensao, coluna) in enumerate(zip(registos.dimensoes, colunas or registos.dimensoes)):
+            # Valores em falta ficam com o código -1 (None), como em Categorias.codificar
+            categorico = pd.Categorical(df[coluna])
+            for rotulo in categorico.categories:
+                registos.categorias[dimensao].codificar(rotulo)
+            registos.codigos[posicao].frombytes(categorico.codes.astype(np.intc).tobytes())
+        registos.valores.frombytes(df[coluna_valor].to_numpy(dtype=np.float64).tobytes())
+        return registos
+
+    def acrescentar(self, *linha):
+        *rotulos, valor = linha
+        for coluna, dimensao, rotulo in zip(self.codigos, self.dimensoes, rotulos):
+            if dimensao in self.codificadas:
+                coluna.append(-1 if rotulo is None else rotulo)
+            else:
+                coluna.append(self.categorias[dimensao].codificar(rotulo))
+        self.valores.append(valor)
+
+    def limpar(self):
+        for coluna in self.codigos:
+            del coluna[:]
+        del self.valores[:]
+
+    def __len__(self):
+        return len(self.valores)
+
+    def __iter__(self):
+        descodificadores = [self.categorias[dimensao].descodificador() for dimensao in self.dimensoes]
+        for *codigos, valor in zip(*self.codigos, self.valores):
+            yield (*(rotulos[codigo] for rotulos, codigo in zip(descodificadores, codigos)), valor)
+
+    def para_dataframe(self, nomes=None, coluna_valor="valor"):
+        """DataFrame com uma coluna Categorical por dimensão (sem descodificar linha a linha)."""
+        nomes = nomes or self.dimensoes
+        colunas = {
+            nome: pd.Categorical.from_codes(np.asarray(codigos), categories=self.categorias[dimensao].rotulos)
+            for nome, dimensao, codigos in zip(nomes, self.dimensoes, self.codigos)
+        }
+        colunas[coluna_valor] = np.asarray(self.valores)
+        return pd.DataFrame(colunas)
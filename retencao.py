@@ -0,0 +1,248 @@
+import argparse
+import csv
+import gzip
+import os
+from datetime import datetime
+
+import escrita
+from db_setup import DB_PATH, SQL_INCREMENTAR_VERSAO
+
+# Diretório onde ficam os arquivos do histórico (base de dados anexa ou ficheiros .csv.gz)
+DIRETORIO_ARQUIVO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'arquivo')
+ARQUIVO_DB_PATH = os.path.join(DIRETORIO_ARQUIVO, 'historico_arquivo.db')
+
+# Janela de retenção por omissão (dias mantidos na base de dados principal)
+DIAS_RETENCAO = 365
+
+# Linhas lidas de cada vez ao escrever o ficheiro comprimido
+TAMANHO_LOTE = 10000
+
+COLUNAS_HISTORICO = [
+    "id", "tabela", "id_registro", "semana_ou_mes", "regiao", "granularidade",
+    "indicador", "periodo", "periodo_acumulado", "valor_antigo", "valor_novo",
+    "usuario", "data_alteracao", "lote_id"
+]
+
+# Uma "célula" do histórico é identificada pela tabela e pelo registo alterado
+PARTICAO_CELULA = "tabela, id_registro, periodo_acumulado"
+
+def _data_limite(conn, dias):
+    # data_alteracao é gravada com CURRENT_TIMESTAMP (UTC), por isso o limite também é calculado em UTC
+    return conn.execute("SELECT datetime('now', ?)", (f"-{int(dias)} days",)).fetchone()[0]
+
+def compactar_historico(conn, data_limite):
+    """Colapsa alterações consecutivas à mesma célula no mesmo dia e remove alterações sem efeito."""
+    cursor = conn.cursor()
+
+    # Para cada célula e dia, manter apenas a última alteração com o valor_antigo da primeira
+    cursor.execute('DROP TABLE IF EXISTS temp._colapso')
+    cursor.execute(f'''
+    CREATE TEMP TABLE _colapso AS
+    SELECT id, rn, primeiro_antigo FROM (
+        SELECT
+            id,
+            ROW_NUMBER() OVER (
+                PARTITION BY {PARTICAO_CELULA}, date(data_alteracao)
+                ORDER BY data_alteracao DESC, id DESC
+            ) AS rn,
+            FIRST_VALUE(valor_antigo) OVER (
+                PARTITION BY {PARTICAO_CELULA}, date(data_alteracao)
+                ORDER BY data_alteracao, id
+            ) AS primeiro_antigo
+        FROM historico_alteracoes
+        WHERE data_alteracao < ?
+    )
+    ''', (data_limite,))
+
+    cursor.execute('''
+    UPDATE historico_alteracoes
+    SET valor_antigo = (SELECT primeiro_antigo FROM temp._colapso c WHERE c.id = historico_alteracoes.id)
+    WHERE id IN (SELECT id FROM temp._colapso WHERE rn = 1)
+    ''')
+
+    cursor.execute('DELETE FROM historico_alteracoes WHERE id IN (SELECT id FROM temp._colapso WHERE rn > 1)')
+    colapsadas = cursor.rowcount
+
+    # Upserts que não mudaram o valor também disparam o trigger; não têm interesse histórico
+    cursor.execute('''
+    DELETE FROM historico_alteracoes
+    WHERE data_alteracao < ? AND valor_antigo IS valor_novo
+    ''', (data_limite,))
+    sem_efeito = cursor.rowcount
+
+    cursor.execute('DROP TABLE temp._colapso')
+
+    # Antes deste limite a reconstrução de instantes passados só é exata ao dia (ver reconstrucao.py)
+    cursor.execute(
+        'INSERT INTO compactacoes_historico (data_limite, colapsadas) VALUES (?, ?)', (data_limite, colapsadas)
+    )
+
+    return colapsadas, sem_efeito
+
+def _arquivar_em_bd(conn, data_limite, arquivo_db_path):
+    cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS arquivo.historico_alteracoes (
+        id INTEGER PRIMARY KEY,
+        tabela TEXT NOT NULL,
+        id_registro INTEGER NOT NULL,
+        semana_ou_mes TEXT NOT NULL,
+        regiao TEXT NOT NULL,
+        granularidade TEXT NOT NULL,
+        indicador TEXT NOT NULL,
+        periodo TEXT NOT NULL,
+        periodo_acumulado TEXT,
+        valor_antigo REAL,
+        valor_novo REAL,
+        usuario TEXT,
+        data_alteracao TIMESTAMP,
+        lote_id INTEGER
+    )
+    ''')
+    # Arquivos criados antes da coluna lote_id existir
+    colunas_arquivo = [linha[1] for linha in cursor.execute('PRAGMA arquivo.table_info(historico_alteracoes)')]
+    if 'lote_id' not in colunas_arquivo:
+        cursor.execute('ALTER TABLE arquivo.historico_alteracoes ADD COLUMN lote_id INTEGER')
+    cursor.execute('CREATE INDEX IF NOT EXISTS arquivo.idx_historico_arquivo_data ON historico_alteracoes(data_alteracao)')
+
+    colunas = ", ".join(COLUNAS_HISTORICO)
+    cursor.execute(f'''
+    INSERT OR IGNORE INTO arquivo.historico_alteracoes ({colunas})
+    SELECT {colunas} FROM main.historico_alteracoes
+    WHERE data_alteracao < ?
+    ''', (data_limite,))
+
+    return cursor.rowcount
+
+def _arquivar_em_ficheiro(conn, data_limite, caminho):
+    cursor = conn.cursor()
+    cursor.execute(f'''
+    SELECT {", ".join(COLUNAS_HISTORICO)}
+    FROM historico_alteracoes
+    WHERE data_alteracao < ?
+    ORDER BY data_alteracao, id
+    ''', (data_limite,))
+
+    total = 0
+    with gzip.open(caminho, 'wt', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUNAS_HISTORICO)
+        while True:
+            linhas = cursor.fetchmany(TAMANHO_LOTE)
+            if not linhas:
+                break
+            writer.writerows(linhas)
+            total += len(linhas)
+
+    return total
+
+def executar_vacuum(conn, incremental=True):
+    """Liberta as páginas livres: incremental_vacuum se auto_vacuum=INCREMENTAL, senão VACUUM completo."""
+    auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+
+    if incremental and auto_vacuum == 2:
+        # Com execute() o módulo sqlite3 avança o pragma um único passo (uma página);
+        # executescript() corre-o até ao fim e liberta toda a freelist
+        conn.executescript('PRAGMA incremental_vacuum;')
+        return 'incremental'
+
+    if incremental:
+        # Converter a base de dados para auto_vacuum incremental (requer um VACUUM completo uma vez)
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    return 'completo'
+
+def _arquivar_historico(dias_retencao, destino, dias_compactacao, db_path, arquivo_db_path):
+    conn = escrita.ligar(db_path)
+    resultado = {"colapsadas": 0, "sem_efeito": 0, "arquivadas": 0, "ficheiro": None}
+
+    try:
+        if destino == 'bd':
+            conn.execute('ATTACH DATABASE ? AS arquivo', (arquivo_db_path,))
+
+        # Transação única: os dados só saem da base principal depois de estarem no arquivo
+        try:
+            with escrita.transacao_imediata(conn):
+                if dias_compactacao is not None:
+                    limite_compactacao = _data_limite(conn, dias_compactacao)
+                    resultado["colapsadas"], resultado["sem_efeito"] = compactar_historico(conn, limite_compactacao)
+
+                limite_retencao = _data_limite(conn, dias_retencao)
+
+                if destino == 'bd':
+                    resultado["arquivadas"] = _arquivar_em_bd(conn, limite_retencao, arquivo_db_path)
+                    resultado["ficheiro"] = arquivo_db_path
+                else:
+                    nome = f"historico_ate_{limite_retencao[:10]}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv.gz"
+                    resultado["ficheiro"] = os.path.join(DIRETORIO_ARQUIVO, nome)
+                    resultado["arquivadas"] = _arquivar_em_ficheiro(conn, limite_retencao, resultado["ficheiro"])
+
+                conn.execute('DELETE FROM main.historico_alteracoes WHERE data_alteracao < ?', (limite_retencao,))
+
+                # O histórico não tem triggers de versão: a compactação e o arquivo mudam a versão dos
+                # dados explicitamente, para que as caches e os ETags do histórico não fiquem desatualizados
+                if dias_compactacao is not None or resultado["arquivadas"]:
+                    conn.execute(SQL_INCREMENTAR_VERSAO)
+        except Exception:
+            if destino == 'gzip' and resultado["ficheiro"] and os.path.exists(resultado["ficheiro"]):
+                os.remove(resultado["ficheiro"])
+            raise
+
+        if destino == 'bd':
+            conn.execute('DETACH DATABASE arquivo')
+
+    finally:
+        conn.close()
+
+    return resultado
+
+def _vacuum(db_path):
+    conn = escrita.ligar(db_path)
+    try:
+        return executar_vacuum(conn)
+    finally:
+        conn.close()
+
+def executar_retencao(dias_retencao=DIAS_RETENCAO, destino='bd', dias_compactacao=None,
+                      vacuum=True, db_path=DB_PATH, arquivo_db_path=ARQUIVO_DB_PATH):
+    """Arquiva o histórico mais antigo que a janela de retenção e compacta a base de dados principal.
+
+    destino: 'bd' (base de dados de arquivo anexa) ou 'gzip' (ficheiro .csv.gz por execução).
+    dias_compactacao: se indicado, colapsa alterações mais antigas que este número de dias.
+    O arquivo e o VACUUM passam pela fila de escrita (escrita.executar_na_fila), um depois do outro:
+    o VACUUM não pode correr dentro de uma transação.
+    """
+    if destino not in ('bd', 'gzip'):
+        raise ValueError(f"Destino de arquivo inválido: {destino}")
+
+    os.makedirs(DIRETORIO_ARQUIVO, exist_ok=True)
+    tamanho_antes = os.path.getsize(db_path)
+
+    resultado = escrita.executar_na_fila(
+        _arquivar_historico, dias_retencao, destino, dias_compactacao, db_path, arquivo_db_path
+    )
+    resultado["vacuum"] = escrita.executar_na_fila(_vacuum, db_path) if vacuum else None
+
+    resultado["tamanho_antes"] = tamanho_antes
+    resultado["tamanho_depois"] = os.path.getsize(db_path)
+    return resultado
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retenção e arquivo do histórico de alterações.")
+    parser.add_argument("--dias", type=int, default=DIAS_RETENCAO, help="Dias de histórico mantidos na base de dados principal")
+    parser.add_argument("--destino", choices=["bd", "gzip"], default="bd", help="Arquivar numa base de dados anexa ou num ficheiro .csv.gz")
+    parser.add_argument("--compactar-dias", type=int, default=None, help="Colapsar alterações à mesma célula mais antigas que N dias")
+    parser.add_argument("--sem-vacuum", action="store_true", help="Não executar VACUUM no final")
+    args = parser.parse_args()
+
+    print("Iniciando retenção do histórico de alterações...")
+    resultado = executar_retencao(
+        dias_retencao=args.dias,
+        destino=args.destino,
+        dias_compactacao=args.compactar_dias,
+        vacuum=not args.sem_vacuum
+    )
+    print(f"Alterações colapsadas: {resultado['colapsadas']} (sem efeito removidas: {resultado['sem_efeito']})")
+    print(f"Alterações arquivadas: {resultado['arquivadas']} -> {resultado['ficheiro']}")
+    print(f"Tamanho da base de dados: {resultado['tamanho_antes']} -> {resultado['tamanho_depois']} bytes (vacuum: {resultado['vacuum']})")
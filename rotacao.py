@@ -0,0 +1,42 @@
+from datetime import date, timedelta
+
+import numpy as np
+
+from estrutura import segunda_feira
+
+def dias_acumulados(semana):
+    """Dias desde o início do ano até ao domingo da semana (como calcular_dias_acumulados em carregamento)."""
+    domingo = segunda_feira(semana) + timedelta(days=6)
+    return (domingo - date(domingo.year, 1, 1)).days + 1
+
+class EixoSemanas:
+    """Eixo de semanas ordenado para os cálculos vetoriais de COGS acumulado e rotação.
+
+    O COGS acumulado de uma semana soma as semanas do eixo desde o início do ano da sua
+    segunda-feira até ela, como calcular_cogs_acumulado_ytd em carregamento.
+    """
+
+    def __init__(self, semanas):
+        self.semanas = sorted(semanas, key=segunda_feira)
+        self.posicao = {semana: t for t, semana in enumerate(self.semanas)}
+        self.dias = np.array([dias_acumulados(semana) for semana in self.semanas], dtype=float)
+
+        # Primeira posição do ano de cada semana (as semanas de um ano são contíguas no eixo)
+        anos = [segunda_feira(semana).year for semana in self.semanas]
+        self.inicio_ano = np.array([anos.index(ano) for ano in anos], dtype=int)
+
+    def __len__(self):
+        return len(self.semanas)
+
+    def cogs_acumulado(self, cogs):
+        """COGS acumulado no ano, ao longo do último eixo de `cogs` (um valor por semana do eixo)."""
+        acumulado = np.concatenate([np.zeros(cogs.shape[:-1] + (1,)), np.cumsum(cogs, axis=-1)], axis=-1)
+        return acumulado[..., 1:] - acumulado[..., self.inicio_ano]
+
+    def rotacao(self, stock_liquido, cogs):
+        """Rotação de cada semana: (stock líquido / COGS acumulado) × dias acumulados, 0 sem stock ou COGS."""
+        cogs_acumulado = self.cogs_acumulado(cogs)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(
+                (stock_liquido != 0) & (cogs_acumulado != 0), stock_liquido / cogs_acumulado * self.dias, 0.0
+            )
@@ -0,0 +1,163 @@
+import argparse
+import hashlib
+import os
+
+import pandas as pd
+
+try:
+    import openpyxl
+except ImportError:  # opcional: só é necessário para sincronizar livros .xlsx
+    openpyxl = None
+
+import escrita
+import importacao
+from db_setup import DB_PATH
+
+# Bytes lidos de cada vez ao calcular o hash do ficheiro
+TAMANHO_BLOCO_HASH = 1 << 20
+
+# Configurações ativas com ficheiro local cuja sincronização já expirou (intervalo em segundos)
+SQL_CONFIGURACOES_PENDENTES = '''
+SELECT * FROM configuracao_excel
+WHERE ativo = 1 AND caminho_arquivo IS NOT NULL AND caminho_arquivo != ''
+  AND (? OR ultima_sincronizacao IS NULL
+       OR ultima_sincronizacao <= datetime('now', '-' || COALESCE(intervalo_sincronizacao, 0) || ' seconds'))
+ORDER BY id
+'''
+
+def assinatura_arquivo(caminho):
+    """Assinatura barata do ficheiro (mtime em ns e tamanho), comparada antes de calcular o hash."""
+    estado = os.stat(caminho)
+    return f"{estado.st_mtime_ns}:{estado.st_size}"
+
+def hash_arquivo(caminho):
+    """SHA-256 do conteúdo do ficheiro, lido em blocos."""
+    sha = hashlib.sha256()
+    with open(caminho, "rb") as ficheiro:
+        for bloco in iter(lambda: ficheiro.read(TAMANHO_BLOCO_HASH), b""):
+            sha.update(bloco)
+    return sha.hexdigest()
+
+def ler_intervalo_excel(caminho, planilha=None, intervalo=None):
+    """Lê só o intervalo configurado de um livro .xlsx, com o leitor em streaming (read_only) do openpyxl.
+
+    Devolve a grelha como texto, com a primeira linha do intervalo como cabeçalhos (ver importacao.ler_grelha).
+    """
+    if openpyxl is None:
+        raise RuntimeError("A sincronização de livros Excel requer o openpyxl (pip install openpyxl).")
+
+    coluna, linha, coluna_final, linha_final = importacao.interpretar_intervalo(intervalo) or (0, 0, None, None)
+    livro = openpyxl.load_workbook(caminho, read_only=True, data_only=True)
+    try:
+        folha = livro[planilha] if planilha else livro.worksheets[0]
+        # Em modo read_only as linhas são lidas do XML à medida que são pedidas
+        linhas = folha.iter_rows(
+            min_row=linha + 1,
+            max_row=None if linha_final is None else linha_final + 1,
+            min_col=coluna + 1,
+            max_col=None if coluna_final is None else coluna_final + 1,
+            values_only=True
+        )
+        grelha = pd.DataFrame.from_records(list(linhas))
+    finally:
+        livro.close()
+
+    # As células chegam tipadas (números, datas); o formato largo é interpretado a partir do texto
+    grelha = grelha.where(grelha.isna(), grelha.astype(str))
+    return importacao.grelha_com_cabecalhos(grelha)
+
+def ler_folha(configuracao):
+    """Lê a folha de uma configuração (livro Excel ou CSV local), limitada ao intervalo configurado."""
+    caminho = configuracao["caminho_arquivo"]
+    if caminho.lower().endswith((".xlsx", ".xlsm")):
+        return ler_intervalo_excel(caminho, configuracao["planilha"], configuracao["intervalo_celulas"])
+    with open(caminho, "rb") as ficheiro:
+        return importacao.ler_grelha(ficheiro.read(), caminho, intervalo=configuracao["intervalo_celulas"])
+
+def _registar_sincronizacao(configuracao_id, assinatura, hash_conteudo, db_path):
+    conn = escrita.ligar(db_path)
+    try:
+        with escrita.transacao_imediata(conn):
+            conn.execute('''
+            UPDATE configuracao_excel
+            SET assinatura_arquivo = ?, hash_arquivo = ?, ultima_sincronizacao = CURRENT_TIMESTAMP
+            WHERE id = ?
+            ''', (assinatura, hash_conteudo, configuracao_id))
+    finally:
+        conn.close()
+
+def sincronizar_configuracao(configuracao, forcar=False, usuario="sincronizacao", db_path=DB_PATH):
+    """Sincroniza o ficheiro de uma configuração com dados_stock.
+
+    Livros que não mudaram desde a última sincronização (mesma assinatura ou, se esta mudou,
+    mesmo hash) não são lidos. Caso contrário, só o intervalo configurado é lido e convertido
+    do formato largo, e o diff com dados_stock é gravado numa única transação pela importação
+    massiva (apenas as células com valor diferente são escritas e auditadas).
+    """
+    caminho = configuracao["caminho_arquivo"]
+    if not caminho or not os.path.exists(caminho):
+        raise FileNotFoundError(f"Ficheiro não encontrado: {caminho}")
+
+    assinatura = assinatura_arquivo(caminho)
+    if not forcar and assinatura == configuracao["assinatura_arquivo"]:
+        escrita.executar_na_fila(_registar_sincronizacao, configuracao["id"], assinatura, configuracao["hash_arquivo"], db_path)
+        return {"estado": "inalterado"}
+
+    hash_conteudo = hash_arquivo(caminho)
+    if not forcar and hash_conteudo == configuracao["hash_arquivo"]:
+        # Ficheiro gravado de novo sem alterações (só o mtime mudou)
+        escrita.executar_na_fila(_registar_sincronizacao, configuracao["id"], assinatura, hash_conteudo, db_path)
+        return {"estado": "inalterado"}
+
+    grelha = ler_folha(configuracao)
+    longo, nao_numericos = importacao.derreter_formato_largo(grelha, configuracao["mapeamento_colunas"])
+    validas, invalidas = importacao.filtrar_linhas_validas(longo)
+
+    resultado = escrita.executar_na_fila(
+        importacao.importar_em_massa,
+        validas.itertuples(index=False, name=None),
+        usuario=usuario,
+        origem=f"sincronizacao_excel:{configuracao['id']}",
+        db_path=db_path
+    )
+    # Só depois de gravados os dados: se a importação falhar, o ficheiro volta a ser lido na próxima vez
+    escrita.executar_na_fila(_registar_sincronizacao, configuracao["id"], assinatura, hash_conteudo, db_path)
+
+    return {"estado": "sincronizado", "invalidas": invalidas, "nao_numericos": nao_numericos, **resultado}
+
+def sincronizar_pendentes(forcar=False, db_path=DB_PATH):
+    """Sincroniza as configurações ativas cujo intervalo_sincronizacao expirou (todas, com `forcar`).
+
+    Devolve {id da configuração: resultado}; um erro numa configuração não impede as restantes.
+    """
+    conn = escrita.ligar(db_path)
+    conn.row_factory = lambda cursor, linha: {d[0]: v for d, v in zip(cursor.description, linha)}
+    try:
+        configuracoes = conn.execute(SQL_CONFIGURACOES_PENDENTES, (forcar,)).fetchall()
+    finally:
+        conn.close()
+
+    resultados = {}
+    for configuracao in configuracoes:
+        try:
+            resultados[configuracao["id"]] = sincronizar_configuracao(configuracao, forcar=forcar, db_path=db_path)
+        except Exception as e:
+            resultados[configuracao["id"]] = {"estado": "erro", "erro": str(e)}
+    return resultados
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sincronização de livros Excel locais (configuracao_excel).")
+    parser.add_argument("--forcar", action="store_true", help="Sincronizar todas as configurações ativas, mesmo sem alterações")
+    args = parser.parse_args()
+
+    print("Iniciando sincronização de livros Excel...")
+    for configuracao_id, resultado in sincronizar_pendentes(forcar=args.forcar).items():
+        if resultado["estado"] == "sincronizado":
+            print(
+                f"Configuração {configuracao_id}: lote {resultado['lote_id']}, {resultado['inseridas']} novos valores, "
+                f"{resultado['alteradas']} alterados, {resultado['invalidas'] + resultado['nao_numericos']} ignorados"
+            )
+        elif resultado["estado"] == "inalterado":
+            print(f"Configuração {configuracao_id}: ficheiro sem alterações")
+        else:
+            print(f"Configuração {configuracao_id}: erro - {resultado['erro']}")
@@ -0,0 +1,131 @@
+import queue
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime
+
+# Estados de uma tarefa
+EM_ESPERA = "em_espera"
+EM_EXECUCAO = "em_execucao"
+CONCLUIDA = "concluida"
+FALHADA = "falhada"
+ESTADOS_ATIVOS = (EM_ESPERA, EM_EXECUCAO)
+
+# Número de tarefas terminadas mantidas no registo
+CAPACIDADE_TERMINADAS = 100
+
+# Registo partilhado por todas as sessões do processo Streamlit
+_tarefas = {}
+_eventos = {}
+_filas = {}
+_lock = threading.Lock()
+
+class _Trabalhador(threading.Thread):
+    """Executa, por ordem de submissão e uma de cada vez, as tarefas de um conjunto de dados."""
+
+    def __init__(self, chave):
+        super().__init__(daemon=True, name=f"tarefas-{chave}")
+        self.fila = queue.Queue()
+
+    def run(self):
+        while True:
+            tarefa_id, funcao, args, kwargs = self.fila.get()
+            _executar(tarefa_id, funcao, args, kwargs)
+            self.fila.task_done()
+
+def _atualizar(tarefa_id, **campos):
+    with _lock:
+        _tarefas[tarefa_id].update(campos)
+
+def _executar(tarefa_id, funcao, args, kwargs):
+    _atualizar(tarefa_id, estado=EM_EXECUCAO, iniciada=datetime.now().isoformat(timespec="seconds"))
+    inicio = time.perf_counter()
+
+    def progresso(fracao, mensagem=None):
+        campos = {"progresso": max(0.0, min(1.0, fracao))}
+        if mensagem is not None:
+            campos["mensagem"] = mensagem
+        _atualizar(tarefa_id, **campos)
+
+    try:
+        resultado = funcao(progresso, *args, **kwargs)
+        _atualizar(tarefa_id, estado=CONCLUIDA, progresso=1.0, resultado=resultado)
+    except Exception as e:
+        _atualizar(tarefa_id, estado=FALHADA, erro=str(e), detalhe=traceback.format_exc(), excecao=e)
+    finally:
+        _atualizar(
+            tarefa_id,
+            terminada=datetime.now().isoformat(timespec="seconds"),
+            duracao_s=round(time.perf_counter() - inicio, 3)
+        )
+        _eventos[tarefa_id].set()
+        _limpar_terminadas()
+
+def _limpar_terminadas():
+    with _lock:
+        terminadas = [t["id"] for t in _tarefas.values() if t["estado"] not in ESTADOS_ATIVOS]
+        for tarefa_id in terminadas[:max(0, len(terminadas) - CAPACIDADE_TERMINADAS)]:
+            del _tarefas[tarefa_id]
+            del _eventos[tarefa_id]
+
+def submeter(chave, funcao, *args, descricao=None, **kwargs):
+    """Agenda funcao(progresso, *args, **kwargs) numa thread em segundo plano e devolve o id da tarefa.
+
+    `chave` identifica o conjunto de dados: tarefas com a mesma chave são serializadas (uma fila e
+    uma thread por chave), tarefas com chaves diferentes correm em paralelo. A função recebe
+    `progresso(fracao, mensagem=None)` para reportar o avanço; o seu retorno fica em "resultado".
+    """
+    tarefa_id = uuid.uuid4().hex
+    with _lock:
+        _tarefas[tarefa_id] = {
+            "id": tarefa_id,
+            "chave": chave,
+            "descricao": descricao or getattr(funcao, "__name__", "tarefa"),
+            "estado": EM_ESPERA,
+            "progresso": 0.0,
+            "mensagem": None,
+            "criada": datetime.now().isoformat(timespec="seconds"),
+            "iniciada": None,
+            "terminada": None,
+            "duracao_s": None,
+            "resultado": None,
+            "erro": None,
+            "detalhe": None,
+            "excecao": None,
+        }
+        _eventos[tarefa_id] = threading.Event()
+
+        trabalhador = _filas.get(chave)
+        if trabalhador is None:
+            trabalhador = _filas[chave] = _Trabalhador(chave)
+            trabalhador.start()
+
+    trabalhador.fila.put((tarefa_id, funcao, args, kwargs))
+    return tarefa_id
+
+def na_fila(chave):
+    """Indica se a thread atual é a que executa as tarefas de `chave`."""
+    with _lock:
+        trabalhador = _filas.get(chave)
+    return trabalhador is not None and threading.current_thread() is trabalhador
+
+def obter(tarefa_id):
+    """Devolve uma cópia do estado da tarefa (ou None se não existir)."""
+    with _lock:
+        tarefa = _tarefas.get(tarefa_id)
+        return dict(tarefa) if tarefa is not None else None
+
+def listar(chave=None):
+    """Devolve as tarefas registadas (opcionalmente só as de uma chave), das mais recentes para as mais antigas."""
+    with _lock:
+        tarefas = [dict(t) for t in _tarefas.values() if chave is None or t["chave"] == chave]
+    return tarefas[::-1]
+
+def aguardar(tarefa_id, timeout=None):
+    """Espera pelo fim da tarefa; devolve o estado final (ou None se o tempo limite expirar)."""
+    with _lock:
+        evento = _eventos.get(tarefa_id)
+    if evento is None or not evento.wait(timeout):
+        return None
+    return obter(tarefa_id)
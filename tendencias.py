@@ -0,0 +1,106 @@
+import pandas as pd
+
+import leitura
+from db_setup import DB_PATH, GRANULARIDADES, REGIOES
+from estrutura import segunda_feira
+
+# Acima deste número de semanas, a série é agregada por mês no servidor
+MAX_PONTOS = 104
+
+# Indicadores somados ao agregar semanas em meses (os restantes, stocks, são a média das semanas)
+INDICADORES_FLUXO = ["Vendas", "MFO", "Quebra", "COGS"]
+
+# Indicadores que não estão guardados e são obtidos como combinação de outros (indicador: sinal)
+COMPOSICAO_INDICADORES = {"COGS": {"Vendas": 1, "MFO": -1, "Quebra": -1}}
+
+# Mês (YYYY-MM) da segunda-feira da semana YYYY-WNN (semanas %W, como em calcular_dias_acumulados)
+SQL_MES_DA_SEMANA = (
+    "strftime('%Y-%m', date(substr(d.semana, 1, 4) || '-01-01', 'weekday 1', "
+    "'+' || ((CAST(substr(d.semana, 7) AS INTEGER) - 1) * 7) || ' days'))"
+)
+
+# Uma única consulta por intervalo de semanas: os agregados Ibérica e Total são obtidos mapeando
+# cada região/granularidade pedida nas de base. O CROSS JOIN mantém a região depois de dados_stock
+# no plano, evitando uma pesquisa no índice por cada combinação região × granularidade × período
+SQL_TENDENCIA = '''
+WITH
+    regioes_pedidas(rotulo, nome) AS (VALUES {regioes}),
+    componentes(nome, sinal) AS (VALUES {componentes})
+SELECT {chave} AS chave, rp.rotulo AS regiao, p.nome AS periodo, SUM(d.valor * c.sinal) / {divisor} AS valor
+FROM dados_stock d
+CROSS JOIN dim_regiao r ON r.id = d.regiao_id
+JOIN regioes_pedidas rp ON rp.nome = r.nome
+JOIN dim_granularidade g ON g.id = d.granularidade_id
+JOIN dim_indicador i ON i.id = d.indicador_id
+JOIN componentes c ON c.nome = i.nome
+JOIN dim_periodo p ON p.id = d.periodo_id
+WHERE d.semana BETWEEN ? AND ?
+  AND g.nome IN ({granularidades})
+  AND p.nome IN ({periodos})
+GROUP BY chave, rp.rotulo, p.id
+ORDER BY chave, rp.rotulo, p.id
+'''
+
+def _regioes_base(regiao):
+    return REGIOES if regiao == "Ibérica" else [regiao]
+
+def _granularidades_base(granularidade):
+    return GRANULARIDADES if granularidade == "Total" else [granularidade]
+
+def agregar_por_mes(semanas):
+    """Indica se um intervalo com `semanas` semanas deve ser apresentado por mês."""
+    return semanas > MAX_PONTOS
+
+def ler_tendencia(semana_inicio, semana_fim, regioes, granularidade, indicador, periodos,
+                  db_path=DB_PATH, mensal=None, conn=None):
+    """Série de um indicador entre duas semanas, por região e período, lida com uma única consulta.
+
+    Devolve um DataFrame (chave, regiao, periodo, valor) com uma linha por semana ou, se `mensal`
+    (por omissão: mais de MAX_PONTOS semanas no intervalo), por mês: os fluxos são somados e os
+    stocks são a média das semanas do mês. Ibérica e Total são agregados na própria consulta.
+    Com `conn` (por ex. a de um leitura.Instantaneo) a consulta usa essa ligação.
+    """
+    if mensal is None:
+        mensal = agregar_por_mes((segunda_feira(semana_fim) - segunda_feira(semana_inicio)).days // 7 + 1)
+
+    pares_regioes = [(rotulo, nome) for rotulo in regioes for nome in _regioes_base(rotulo)]
+    componentes = list(COMPOSICAO_INDICADORES.get(indicador, {indicador: 1}).items())
+    granularidades = _granularidades_base(granularidade)
+    media = mensal and indicador not in INDICADORES_FLUXO
+
+    sql = SQL_TENDENCIA.format(
+        regioes=", ".join("(?, ?)" for _ in pares_regioes),
+        componentes=", ".join("(?, ?)" for _ in componentes),
+        chave=SQL_MES_DA_SEMANA if mensal else "d.semana",
+        divisor="COUNT(DISTINCT d.semana)" if media else "1",
+        granularidades=", ".join("?" for _ in granularidades),
+        periodos=", ".join("?" for _ in periodos),
+    )
+    parametros = [
+        *(valor for par in pares_regioes for valor in par),
+        *(valor for par in componentes for valor in par),
+        semana_inicio, semana_fim, *granularidades, *periodos,
+    ]
+
+    with leitura.ligacao(db_path, conn) as conn:
+        return pd.read_sql(sql, conn, params=parametros)
+
+def tendencia_cubo(dados, semana_inicio, semana_fim, regioes, granularidade, indicador, periodos, mensal=None):
+    """Como ler_tendencia, mas a partir da estrutura em memória (para indicadores calculados, como a Rotação)."""
+    semanas = [s for s in sorted(dados["semanas"]) if semana_inicio <= s <= semana_fim]
+    if mensal is None:
+        mensal = agregar_por_mes(len(semanas))
+
+    linhas = [
+        (semana, regiao, periodo, dados["semanas"][semana][regiao][granularidade][indicador][periodo])
+        for semana in semanas
+        for regiao in regioes
+        for periodo in periodos
+    ]
+    df = pd.DataFrame(linhas, columns=["chave", "regiao", "periodo", "valor"])
+    if not mensal or df.empty:
+        return df
+
+    df["chave"] = df["chave"].map(lambda semana: segunda_feira(semana).strftime("%Y-%m"))
+    agregacao = "sum" if indicador in INDICADORES_FLUXO else "mean"
+    return df.groupby(["chave", "regiao", "periodo"], sort=True, as_index=False)["valor"].agg(agregacao)
@@ -0,0 +1,56 @@
+import numpy as np
+
+# Período comparado com as referências
+PERIODO_REAL = "Real + Projeção"
+
+# Referências das variações: sufixo do nome -> período
+REFERENCIAS_VARIACAO = {"Budget": "Budget", "LY": "Last Year"}
+
+# Medidas derivadas, guardadas em cada indicador como períodos adicionais (absoluta e percentual)
+PERIODOS_VARIACAO = [
+    nome
+    for sufixo in REFERENCIAS_VARIACAO
+    for nome in (f"Real vs {sufixo}", f"Real vs {sufixo} %")
+]
+
+def _nos_indicador(no):
+    # Os nós de indicador (e os de YTD/EOP dentro deles) são os que têm valores numéricos
+    for filho in no.values():
+        if not isinstance(filho, dict):
+            continue
+        if any(not isinstance(valor, dict) for valor in filho.values()):
+            yield filho
+            yield from (neto for neto in filho.values() if isinstance(neto, dict))
+        else:
+            yield from _nos_indicador(filho)
+
+def calcular_variacoes(dados):
+    """Calcula as variações Real vs Budget e Real vs LY (absolutas e %) de todas as células de uma vez.
+
+    Os valores de todas as semanas, meses, regiões, granularidades e indicadores são reunidos numa
+    matriz (uma linha por célula, uma coluna por período) e as variações calculadas com operações
+    vetoriais. Os resultados são gravados em cada indicador como períodos adicionais
+    (PERIODOS_VARIACAO), ao lado dos valores, tal como o COGS e a rotação; células a que falte
+    o real ou a referência (ou com referência 0, no caso da %) ficam sem variação.
+    """
+    nos = [no for tipo in ("semanas", "meses") for no in _nos_indicador(dados[tipo])]
+    if not nos:
+        return dados
+
+    periodos = [PERIODO_REAL, *REFERENCIAS_VARIACAO.values()]
+    # dict.get não passa pelo __missing__ da estrutura esparsa: células em falta ficam NaN
+    valores = np.array([[no.get(periodo, np.nan) for periodo in periodos] for no in nos], dtype=float)
+    real, referencias = valores[:, :1], valores[:, 1:]
+
+    absolutas = real - referencias
+    with np.errstate(divide="ignore", invalid="ignore"):
+        percentuais = np.where(referencias != 0, absolutas / np.abs(referencias) * 100, np.nan)
+
+    # Colunas pela ordem de PERIODOS_VARIACAO (absoluta e % de cada referência)
+    variacoes = np.stack([absolutas, percentuais], axis=2).reshape(len(nos), -1)
+    presentes = ~np.isnan(variacoes)
+
+    for no, linha, presente in zip(nos, variacoes.tolist(), presentes.tolist()):
+        no.update((periodo, valor) for periodo, valor, p in zip(PERIODOS_VARIACAO, linha, presente) if p)
+
+    return dados